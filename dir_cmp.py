@@ -10,11 +10,63 @@
 import argparse
 import hashlib
 import os, os.path, sys
-import pickle   # for saving intermediate results file as dictionary object
+import pickle   # for reading hashfiles written by older versions
 import enum
+import collections
+import concurrent.futures
+import threading
+import sqlite3
+import heapq
+import bisect
+import mmap
+import re
+import tempfile
+import time
+import stat
+import shutil
+import fcntl
+import errno
+import contextlib
+import fnmatch
+import itertools
+import json
+import struct
+import array
+import ctypes
+import select
+import signal
+import queue
+try :
+   import numpy
+except ImportError :
+   numpy = None
 
 
-BUF_SIZE = 65536  # let's read stuff in 64kb chunks!
+BUF_SIZE = 65536  # let's read stuff in 64kb chunks! (at least; larger files get larger chunks, up to MAX_BUF_SIZE)
+MAX_BUF_SIZE = 1048576
+MMAP_THRESHOLD = 16 * MAX_BUF_SIZE  # files at least this large are mmap'd rather than read
+PARTIAL_BLOCK = BUF_SIZE  # size of head & tail blocks digested to pre-filter files before full hashing
+
+# available digest algorithms: name -> (constructor, is cryptographic)
+HASH_ALGORITHMS = collections.OrderedDict([
+   ("md5", (hashlib.md5,True)),
+   ("sha1", (hashlib.sha1,True)),
+   ("sha256", (hashlib.sha256,True)),
+   ("blake2b", (hashlib.blake2b,True)),
+   ("blake2s", (hashlib.blake2s,True)),
+])
+try :
+   import blake3
+   HASH_ALGORITHMS["blake3"] = (blake3.blake3,True)
+except ImportError :
+   pass
+try :
+   import xxhash
+   HASH_ALGORITHMS["xxh64"] = (xxhash.xxh64,False)
+   HASH_ALGORITHMS["xxh3_64"] = (xxhash.xxh3_64,False)
+   HASH_ALGORITHMS["xxh3_128"] = (xxhash.xxh3_128,False)
+except ImportError :
+   pass
 
 
 def parse_args() :
@@ -33,25 +85,87 @@ def parse_args() :
       "                        : Suggest which copy in repository to keep if several are present\n"
       "  %(prog)s --store-hashes HASHFILE --dir DIRECTORY\n"
       "                        : Compute file hashes and just store them for future analysis\n"
+      "  %(prog)s --store-hashes HASHFILE --dir REPOSITORY --watch --cache\n"
+      "                        : Keep the hashfile of REPOSITORY current as the tree changes (until interrupted)\n"
       "  %(prog)s --dir-hashes HASHFILE --identify-duplicates\n"
       "                        : Load file hashes for a single directory and identify duplicates among them\n"
       "  %(prog)s --dir-hashes HASHFILE0 --repo-hashes HASHFILE1 --all\n"
-      "                        : Load file hashes and do full analysis")
+      "                        : Load file hashes and do full analysis\n"
+      "  %(prog)s --store-hashes HASHFILE --merge-hashes HASHFILE0 HASHFILE1 ...\n"
+      "                        : Merge file hashes computed for several subtrees into one hashfile\n"
+      "  %(prog)s --identify-duplicates --dir DIRECTORY --repository REPOSITORY --chunks --delta DELTADIR\n"
+      "                        : Also report files partially present in repository (e.g. edited in place) and\n"
+      "                          write deltas holding only their changed chunks; rebuild with --apply-delta\n"
+      "  %(prog)s --identify-duplicates --dir DIRECTORY --repository REPOSITORY --sync-to-repository --cache\n"
+      "                        : Copy files missing from repository into it (re-run to resume an interrupted sync)\n"
+      "  %(prog)s --replicas DIRECTORY0 HASHFILE1 DIRECTORY2 ...\n"
+      "                        : Report how many trees (e.g. backup media) hold each content, and which files\n"
+      "                          exist on a single tree only\n"
+      "Hashfiles are text manifests sorted by digest, so comparing two hashfiles needs little memory.")
    parser = argparse.ArgumentParser(description=usage_text,epilog=epilog_text,formatter_class=argparse.RawDescriptionHelpFormatter)
    parser.add_argument("-d","--dir", action="store", dest="dir", help="directory tree potentially with duplicates;\nif repository is also specified: with duplicates w.r.t. storage repository; it will also provide hints which copy in the storage repository to keep")
    parser.add_argument("-r","--repository", action="store", dest="repository", help="permanent storage repository")
-   parser.add_argument("--sha1", action="store_const", const=hashlib.sha1, dest="hasher", default=hashlib.md5)
+   parser.add_argument("--hash", action="store", dest="hash", choices=list(HASH_ALGORITHMS), default="md5", help="Digest algorithm (default: md5); see --benchmark-hashes")
+   parser.add_argument("--sha1", action="store_const", const="sha1", dest="hash", help="Same as --hash sha1")
    parser.add_argument("--store-hashes", action="store", dest="hash_store", help="File to store computed file hashes in; precludes further actions")
+   parser.add_argument("--watch", action="store_true", dest="watch", help="With --store-hashes and --dir: keep running, follow changes of the tree (inotify) and keep the hashfile current, so that it can be used for instant --repo-hashes queries")
+   parser.add_argument("--watch-interval", action="store", type=float, dest="watch_interval", default=60.0, metavar="SECONDS", help="With --watch, minimal interval between rewrites of the hashfile (default: 60)")
    parser.add_argument("--dir-hashes", action="store", dest="dir_hashes", help="File with computed file hashes for directory")
    parser.add_argument("--repo-hashes", action="store", dest="repo_hashes", help="File with computed file hashes for repository")
+   parser.add_argument("--merge-hashes", action="store", nargs="+", dest="merge_hashes", metavar="HASHFILE", help="Hashfiles of several (sub)trees to merge into the --store-hashes file")
+   parser.add_argument("--chunks", action="store_true", dest="chunks", help="With --identify-duplicates against a repository, split new files (and repository files of similar size) into content-defined chunks and report files that are partially present in the repository (e.g. edited in place)")
+   parser.add_argument("--delta", action="store", dest="delta", metavar="DIR", help="With --chunks, write for each partially present file a delta against the most similar repository file to DIR (holding only the changed chunks); see --apply-delta")
+   parser.add_argument("--sync-to-repository", action="store_true", dest="sync", help="With --identify-duplicates against a repository, copy the files missing from it into the repository (same relative paths, metadata preserved, verified against their digests; in --jobs parallel copies)")
+   parser.add_argument("--sync-journal", action="store", dest="sync_journal", metavar="FILE", help="Journal of --sync-to-repository, so that an interrupted sync resumes where it stopped (default: in {0:s})".format(RepositorySync.JOURNAL_DIR.replace("%","%%")))
    parser.add_argument("--delete", action="store_true", dest="delete", help="Really delete files identified as reduntant (default: report only)")
+   parser.add_argument("--link-mode", action="store", dest="link_mode", choices=DuplicateLinker.LINK_MODES, help="Instead of deleting, replace redundant files with hard links / copy-on-write clones (btrfs, XFS) / symlinks to the kept copy; with --identify-duplicates, all duplicates but the first are replaced")
    parser.add_argument("-c","--csv", action="store_const", const="csv", dest="format_dup", default="human", help="Report duplicates in CSV format (default: human-readable)")
+   parser.add_argument("-j","--jobs", action="store", type=int, dest="jobs", default=1, metavar="N", help="Number of files hashed concurrently (default: 1)")
+   parser.add_argument("--jobs-per-device", action="store", type=int, dest="jobs_per_device", metavar="N", help="Max. number of files hashed concurrently on a single device (default: 1 for rotational and removable media, --jobs otherwise)")
+   parser.add_argument("--processes", action="store_true", dest="processes", help="Hash in worker processes instead of threads")
+   parser.add_argument("--walk-jobs", action="store", type=int, dest="walk_jobs", default=1, metavar="N", help="Number of directories listed concurrently (default: 1); helps on network filesystems and slow media")
+   parser.add_argument("--include", action="append", dest="include", metavar="GLOB", help="Only consider files whose name or relative path matches GLOB (may be repeated)")
+   parser.add_argument("--exclude", action="append", dest="exclude", metavar="GLOB", help="Skip files and directories whose name or relative path matches GLOB, e.g. '.git' or '*.tmp' (may be repeated)")
+   parser.add_argument("-x","--one-file-system", action="store_true", dest="one_file_system", help="Do not descend into directories on other filesystems")
+   parser.add_argument("--follow-symlinks", action="store_true", dest="follow_symlinks", help="Descend into symlinked directories (each directory is visited once, so symlink loops are skipped)")
+   parser.add_argument("--cache", action="store", nargs="?", const=HashCache.DEFAULT_PATH, dest="cache", metavar="CACHEFILE", help="Reuse digests of unmodified files from (and store new ones in) a persistent cache (default location: {0:s})".format(HashCache.DEFAULT_PATH.replace("%","%%")))
+   parser.add_argument("--rebuild-cache", action="store_true", dest="rebuild_cache", help="Ignore cached digests, recompute and overwrite them (implies --cache)")
+   parser.add_argument("--progress", action="store_true", dest="progress", help="Show live hashing progress (files/s, MB/s, ETA) on stderr")
+   parser.add_argument("--stats", action="store_true", dest="stats", help="Print hashing stage and cache statistics, wall time of individual phases (walk, hash, compare, report) and hashing throughput to stderr")
+   parser.add_argument("--metrics-json", action="store", dest="metrics_json", metavar="FILE", help="Write final metrics (phase times, throughput, hashing stages, cache hits) to FILE as JSON")
    parser.add_argument("--debug", action="store_true", dest="debug", help="Print lots of debugging information")
    actions = parser.add_argument_group("actions")
    actions.add_argument("--identify-duplicates", action="store_true", dest="identify", help="Identify duplicates within directory tree(s)")
    actions.add_argument("--suggest", action="store_true", dest="suggest", help="Suggest which copy in repository to keep if several are present")
    actions.add_argument("--all", action="store_true", dest="all_steps", help="Combine --identify-duplicates and --suggest")
+   actions.add_argument("--replicas", action="store", nargs="+", dest="replicas", metavar="TREE", help="Report on which of the trees (directories or hashfiles) each content exists, and which files exist on one tree only")
+   actions.add_argument("--apply-delta", action="store", nargs=2, dest="apply_delta", metavar=("DELTA","OUTPUT"), help="Rebuild a file from a delta written by --delta (and its base file in the repository) into OUTPUT")
+   actions.add_argument("--benchmark-hashes", action="store", nargs="?", type=int, const=256, dest="benchmark_hashes", metavar="MB", help="Measure in-memory throughput of available digest algorithms (hashing MB megabytes, default 256)")
    _result = parser.parse_args()
+   _result.hasher = HASH_ALGORITHMS[_result.hash][0]
+
+   if _result.benchmark_hashes is not None :
+      if _result.benchmark_hashes <= 0 :
+         parser.error("--benchmark-hashes needs a positive number of megabytes")
+      return _result
+   if _result.apply_delta :
+      return _result
+
+   if _result.replicas :
+      if len(_result.replicas) < 2 :
+         error("--replicas requires at least two trees",True)
+      if _result.dir or _result.repository or _result.dir_hashes or _result.repo_hashes or _result.hash_store or _result.identify or _result.suggest or _result.all_steps :
+         error("--replicas takes its trees as arguments and precludes any other actions",True)
+      if _result.delete or _result.link_mode :
+         error("--replicas is a report only",True)
+      return _result
+
+   if _result.merge_hashes :
+      if not _result.hash_store :
+         error("Merging hashfiles requires --store-hashes for the result",True)
+      if _result.dir or _result.repository or _result.dir_hashes or _result.repo_hashes or _result.identify or _result.suggest or _result.all_steps :
+         error("Merging hashfiles precludes any other actions",True)
+      return _result
 
    _result.dirtree_count = 1 if (_result.dir or _result.dir_hashes) and not (_result.repository or _result.repo_hashes) else 2
 
@@ -72,8 +186,24 @@ def parse_args() :
       error("If one wants to compute hashes, one has to specify a directory...",True)
    if _result.hash_store and _result.repository :
       error("Computng hashes works on single directories only; run twice, specifying both dirs in turn",True)
+   if _result.watch and not (_result.hash_store and _result.dir) :
+      error("--watch requires --store-hashes and --dir",True)
    if _result.suggest and _result.dirtree_count != 2 :
       error("--suggest requires specifying both directory (or hashfile) and repository (or hashfile)",True)
+   if _result.delete and _result.link_mode :
+      error("--delete and --link-mode are mutually exclusive",True)
+   if _result.link_mode and not (_result.identify or _result.suggest) :
+      error("--link-mode requires --identify-duplicates or --suggest",True)
+   if _result.delta :
+      _result.chunks = True
+   if _result.chunks and (_result.dirtree_count != 2 or not _result.identify or _result.suggest) :
+      error("--chunks and --delta require --identify-duplicates with directory and repository",True)
+   if _result.sync and (_result.dirtree_count != 2 or not _result.identify or _result.suggest) :
+      error("--sync-to-repository requires --identify-duplicates with directory and repository",True)
+   if _result.rebuild_cache and not _result.cache :
+      _result.cache = HashCache.DEFAULT_PATH
+   if _result.jobs < 1 or _result.walk_jobs < 1 or (_result.jobs_per_device is not None and _result.jobs_per_device < 1) :
+      error("Number of jobs must be positive",True)
 
    return _result
 
@@ -88,78 +218,1005 @@ def append_or_insert(dict_of_lists,key,elem) :
    else :
       dict_of_lists[key] = [elem]
 
-def debug_msg(msg) :
+def debug_msg(msg,*args) :
+   # msg is only formatted (with args) if debugging is enabled
    if options.debug :
-      sys.stdout.write("[debug] {0:s}\n".format(msg))
+      sys.stdout.write("[debug] {0:s}\n".format(msg.format(*args) if args else msg))
+
+FileEntry = collections.namedtuple("FileEntry","path size dev ino mtime")  # mtime in ns
+
+
+def is_readable(stat_result) :
+   """Whether the file is readable according to its permission bits (what os.access() checks, without a syscall)"""
+   _euid = os.geteuid()
+   if _euid == 0 :
+      return True
+   if stat_result.st_uid == _euid :
+      return bool(stat_result.st_mode & stat.S_IRUSR)
+   if stat_result.st_gid == os.getegid() or stat_result.st_gid in os.getgroups() :
+      return bool(stat_result.st_mode & stat.S_IRGRP)
+   return bool(stat_result.st_mode & stat.S_IROTH)
+
+
+def glob_matcher(patterns) :
+   """Function telling whether a file name or relative path matches any of the glob patterns (None if no patterns)"""
+   if not patterns :
+      return None
+   _regex = re.compile("|".join(fnmatch.translate(_pattern.rstrip(os.sep)) for _pattern in patterns))
+   return lambda _name,_relpath: bool(_regex.match(_name) or _regex.match(_relpath))
+
+
+def walk_tree(dirtree) :
+   """Yield FileEntry for all readable regular files in the tree
+
+   Built on os.scandir(): file types come from the directory listing and each file costs a single stat
+   call. With --walk-jobs > 1, directories are listed concurrently by a thread pool (so the order of
+   files is not deterministic). Honours --include/--exclude, --one-file-system and --follow-symlinks;
+   when following symlinks, every directory is entered only once, which also breaks symlink loops."""
+   # validate options
+   if not os.access(dirtree, os.R_OK):
+      error("Cannot read directory {0}".format(dirtree), True)
+
+   _debug = options.debug
+   debug_msg("processing directory tree \"{0:s}\"",dirtree)
+
+   if os.path.isdir(dirtree) : debug_msg("walk_tree: valid directory \'{0:s}\' passed as argument",dirtree)
+   _prefix = os.path.join(dirtree,"")
+   _included = glob_matcher(options.include)
+   _excluded = glob_matcher(options.exclude)
+   _follow = options.follow_symlinks
+   _root_stat = os.stat(dirtree)
+   _visited = {(_root_stat.st_dev,_root_stat.st_ino)}
+   _visited_lock = threading.Lock()
+
+   def _scan(dirpath) :
+      """List a directory; returns ([FileEntry],[subdirectory path])"""
+      if _debug : debug_msg("walk_tree: descending into directory \'{0:s}\'\n",dirpath)
+      _files = []
+      _subdirs = []
+      try :
+         _listing = os.scandir(dirpath)
+      except OSError as _exc :
+         error("Cannot read directory {0}, skipping ({1})".format(dirpath,_exc.strerror),False)
+         return _files,_subdirs
+      with _listing :
+         for _dir_entry in _listing :
+            _relpath = _dir_entry.path[len(_prefix):]
+            if _excluded and _excluded(_dir_entry.name,_relpath) :
+               continue
+            try :
+               if _dir_entry.is_dir(follow_symlinks=_follow) :
+                  if _follow or options.one_file_system :
+                     _stat = _dir_entry.stat(follow_symlinks=_follow)
+                     if options.one_file_system and _stat.st_dev != _root_stat.st_dev :
+                        continue
+                     if _follow :
+                        with _visited_lock :
+                           if (_stat.st_dev,_stat.st_ino) in _visited :
+                              debug_msg("walk_tree: directory \'{0:s}\' already visited, skipping",_dir_entry.path)
+                              continue
+                           _visited.add((_stat.st_dev,_stat.st_ino))
+                  _subdirs.append(_dir_entry.path)
+               # symlinks to files are followed, as os.path.isfile() did
+               elif _dir_entry.is_file() :
+                  if _debug : debug_msg("walk_tree: processing file name \'{0:s}\'\n",_dir_entry.path)
+                  if _included and not _included(_dir_entry.name,_relpath) :
+                     continue
+                  _stat = _dir_entry.stat()
+                  if options.one_file_system and _stat.st_dev != _root_stat.st_dev :
+                     continue
+                  if is_readable(_stat) :
+                     _files.append(FileEntry(_dir_entry.path,_stat.st_size,_stat.st_dev,_stat.st_ino,_stat.st_mtime_ns))
+                  else : error("Cannot read file {0}, skipping".format(_dir_entry.path),False)
+            except OSError as _exc :
+               error("Cannot stat {0}, skipping ({1})".format(_dir_entry.path,_exc.strerror),False)
+      return _files,_subdirs
+
+   if options.walk_jobs == 1 :
+      _stack = [dirtree]
+      while _stack :
+         _files,_subdirs = _scan(_stack.pop())
+         yield from _files
+         _stack.extend(reversed(_subdirs))
+      return
+
+   with concurrent.futures.ThreadPoolExecutor(options.walk_jobs) as _executor :
+      _pending = {_executor.submit(_scan,dirtree)}
+      while _pending :
+         _done,_pending = concurrent.futures.wait(_pending,return_when=concurrent.futures.FIRST_COMPLETED)
+         for _future in _done :
+            _files,_subdirs = _future.result()
+            for _subdir in _subdirs :
+               _pending.add(_executor.submit(_scan,_subdir))
+            yield from _files
+
+
+_read_buffers = threading.local()
+
+def read_buffer(size) :
+   """Writable memoryview of (at least) size bytes; the buffer is allocated once per thread and reused"""
+   _buffer = getattr(_read_buffers,"buffer",None)
+   if _buffer is None or len(_buffer) < size :
+      _buffer = _read_buffers.buffer = memoryview(bytearray(max(size,MAX_BUF_SIZE)))
+   return _buffer[:size]
+
+
+def hash_file(filename,hash_engine) :
+   """Digest of the whole file contents
+
+   Large files are mmap'd and digested straight from the page cache; others are read into a reused
+   buffer (sized to the file, between BUF_SIZE and MAX_BUF_SIZE), so there is no per-chunk allocation."""
+   _hasher = hash_engine()
+   with open(filename,'rb',buffering=0) as _input_file :
+      _size = os.fstat(_input_file.fileno()).st_size
+      if _size >= MMAP_THRESHOLD :
+         with mmap.mmap(_input_file.fileno(),0,access=mmap.ACCESS_READ) as _map :
+            if hasattr(_map,"madvise") : _map.madvise(mmap.MADV_SEQUENTIAL)
+            with memoryview(_map) as _view :
+               for _offset in range(0,len(_view),MAX_BUF_SIZE) :
+                  _hasher.update(_view[_offset:_offset+MAX_BUF_SIZE])
+      else :
+         _buffer = read_buffer(min(max(_size,BUF_SIZE),MAX_BUF_SIZE))
+         while True :
+            _count = _input_file.readinto(_buffer)
+            if not _count : break
+            _hasher.update(_buffer[:_count])
+   return _hasher.hexdigest()
+
+
+def hash_file_ends(filename,size,hash_engine) :
+   """Digest of the first and the last PARTIAL_BLOCK bytes of a file (cheap pre-filter for full hashing)"""
+   _buffer = read_buffer(PARTIAL_BLOCK)
+   with open(filename,'rb',buffering=0) as _input_file :
+      _hasher = hash_engine()
+      for _offset in (0,size - PARTIAL_BLOCK) :
+         _count = os.preadv(_input_file.fileno(),[_buffer],_offset)
+         _hasher.update(_buffer[:_count])
+   return _hasher.hexdigest()
+
+
+def benchmark_hashes(megabytes) :
+   """Print in-memory throughput of all available digest algorithms"""
+   _chunk = os.urandom(MAX_BUF_SIZE)
+   print("{0:<10s} {1:>10s}".format("algorithm","MB/s"))
+   for _name,(_hash_engine,_cryptographic) in HASH_ALGORITHMS.items() :
+      _hasher = _hash_engine()
+      _start = time.perf_counter()
+      for _ in range(megabytes) :
+         _hasher.update(_chunk)
+      _hasher.hexdigest()
+      _elapsed = time.perf_counter() - _start
+      print("{0:<10s} {1:>10.1f}{2:s}".format(_name,megabytes / _elapsed,"" if _cryptographic else "  (non-cryptographic)"))
+
+
+def device_concurrency(device,jobs) :
+   """Default number of concurrent readers for a block device: 1 for rotational or removable media, otherwise jobs"""
+   _sysfs_dev = "/sys/dev/block/{0:d}:{1:d}".format(os.major(device),os.minor(device))
+   # partitions do not have their own queue attributes - these are in the parent (whole disk) directory
+   for _sysfs_path in (_sysfs_dev,os.path.join(_sysfs_dev,"..")) :
+      try :
+         with open(os.path.join(_sysfs_path,"queue","rotational")) as _attr :
+            _rotational = _attr.read().strip() == "1"
+      except OSError :
+         continue
+      try :
+         with open(os.path.join(_sysfs_path,"removable")) as _attr :
+            _removable = _attr.read().strip() == "1"
+      except OSError :
+         _removable = False
+      return 1 if _rotational or _removable else jobs
+   return jobs  # not a block device (network or virtual filesystem) - no reason to limit
+
+
+class HashPool :
+   """Worker pool computing digests concurrently
+
+   Tasks are (device, function, args) tuples; results are yielded in task order. A task with function
+   None is a known result (args), passed straight through without occupying a worker. Worker threads take
+   tasks from a bounded queue that is filled by a feeder thread (so a slow producer, e.g. a directory
+   walk, overlaps with hashing). At most device_limit(device) tasks per device run at a time, and a
+   worker never waits for a busy device while tasks for another device are pending. With
+   use_processes, the threads hand the actual hashing over to a process pool."""
+   QUEUE_DEPTH = 4  # tasks queued per worker
+
+   def __init__(self,jobs,device_limit,use_processes = False) :
+      self.jobs = jobs
+      self.device_limit = device_limit
+      self.executor = concurrent.futures.ProcessPoolExecutor(jobs) if use_processes else None
+
+   def close(self) :
+      if self.executor :
+         self.executor.shutdown()
+
+   def run(self,tasks) :
+      if self.jobs == 1 and not self.executor :
+         for _device,_function,_args in tasks :
+            yield _args if _function is None else self._call(_function,_args)
+         return
+
+      _cond = threading.Condition()
+      _pending = collections.OrderedDict()  # device -> deque of (sequence number, function, args)
+      _state = {"queued": 0, "fed": 0, "feeder_done": False, "error": None}
+      _active = collections.Counter()
+      _limits = {}
+      _results = {}
+
+      def _feeder() :
+         try :
+            for _device,_function,_args in tasks :
+               with _cond :
+                  if _function is None :
+                     _results[_state["fed"]] = _args
+                     _state["fed"] += 1
+                     _cond.notify_all()
+                     continue
+                  while _state["queued"] >= self.jobs * self.QUEUE_DEPTH and not _state["error"] :
+                     _cond.wait()
+                  if _state["error"] : return  # a worker failed, the run is aborted
+                  if _device not in _pending :
+                     _pending[_device] = collections.deque()
+                     if _device not in _limits :
+                        _limits[_device] = self.device_limit(_device)
+                  _pending[_device].append((_state["fed"],_function,_args))
+                  _state["fed"] += 1
+                  _state["queued"] += 1
+                  _cond.notify_all()
+         except BaseException as _exc :
+            _state["error"] = _exc
+         finally :
+            with _cond :
+               _state["feeder_done"] = True
+               _cond.notify_all()
+
+      def _worker() :
+         while True :
+            with _cond :
+               while True :
+                  if _state["error"] : return
+                  _task = None
+                  for _device,_queue in _pending.items() :
+                     if _active[_device] < _limits[_device] :
+                        _task = _queue.popleft()
+                        break
+                  if _task :
+                     if not _queue : del _pending[_device]
+                     _active[_device] += 1
+                     _state["queued"] -= 1
+                     _cond.notify_all()
+                     break
+                  if _state["feeder_done"] and not _pending :
+                     return
+                  _cond.wait()
+            _seq,_function,_args = _task
+            try :
+               _result = self._call(_function,_args)
+            except BaseException as _exc :
+               # anything but an I/O error (e.g. a broken process pool) ends the run, rather than leave a hole
+               # in the results that the consumer would wait for forever
+               with _cond :
+                  _state["error"] = _state["error"] or _exc
+                  _cond.notify_all()
+               return
+            with _cond :
+               _active[_device] -= 1
+               _results[_seq] = _result
+               _cond.notify_all()
+
+      _threads = [threading.Thread(target=_feeder,daemon=True)]
+      _threads += [threading.Thread(target=_worker,daemon=True) for _ in range(self.jobs)]
+      for _thread in _threads : _thread.start()
+      _next = 0
+      while True :
+         with _cond :
+            while _next not in _results and not _state["error"] and not (_state["feeder_done"] and _next >= _state["fed"]) :
+               _cond.wait()
+            if _state["error"] or _next not in _results : break
+            _result = _results.pop(_next)
+         _next += 1
+         yield _result
+      if _state["error"] :
+         raise _state["error"]
+
+   def _call(self,function,args) :
+      """Returns function result, or None on I/O error (e.g. file deleted since the directory walk)"""
+      try :
+         if self.executor :
+            return self.executor.submit(function,*args).result()
+         return function(*args)
+      except OSError as _exc :
+         error("Cannot read file {0}, skipping ({1})".format(args[0],_exc.strerror),False)
+         return None
+
+
+class HashCache :
+   """Persistent digest cache (SQLite database), so that re-scans only hash new or modified files
+
+   A cached digest is valid for the same (device, inode, size, mtime, algorithm); only the most recent
+   digest per (device, inode, algorithm) is kept, so modified files do not leave stale rows behind.
+   With rebuild=True, cached digests are ignored and overwritten."""
+   DEFAULT_PATH = os.path.join(os.path.expanduser("~"),".cache","dir_cmp","hashes.sqlite")
+   COMMIT_INTERVAL = 1000  # stored digests per transaction
+
+   def __init__(self,path,rebuild = False) :
+      _dir = os.path.dirname(path)
+      if _dir and not os.path.isdir(_dir) :
+         os.makedirs(_dir)
+      # lookups happen in HashPool's feeder thread, stores in the main thread
+      self._db = sqlite3.connect(path,check_same_thread=False)
+      self._lock = threading.Lock()
+      self._db.execute("CREATE TABLE IF NOT EXISTS digests (dev INTEGER, ino INTEGER, algorithm TEXT, "
+                       "size INTEGER, mtime INTEGER, digest TEXT, PRIMARY KEY (dev, ino, algorithm)) WITHOUT ROWID")
+      self._rebuild = rebuild
+      self._uncommitted = 0
+      self.hits = self.misses = 0
+
+   def lookup(self,entry,algorithm) :
+      """Cached digest of the file, or None"""
+      if self._rebuild :
+         self.misses += 1
+         return None
+      with self._lock :
+         _row = self._db.execute("SELECT size, mtime, digest FROM digests WHERE dev = ? AND ino = ? AND algorithm = ?",
+                                 (entry.dev,entry.ino,algorithm)).fetchone()
+      if _row and _row[0] == entry.size and _row[1] == entry.mtime :
+         self.hits += 1
+         return _row[2]
+      self.misses += 1
+      return None
+
+   def store(self,entry,algorithm,digest) :
+      with self._lock :
+         self._db.execute("INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?)",
+                          (entry.dev,entry.ino,algorithm,entry.size,entry.mtime,digest))
+         self._uncommitted += 1
+         if self._uncommitted >= self.COMMIT_INTERVAL :
+            self._db.commit()
+            self._uncommitted = 0
+
+   def commit(self) :
+      with self._lock :
+         self._db.commit()
+         self._uncommitted = 0
+
+   def close(self) :
+      with self._lock :
+         self._db.commit()
+         self._db.close()
+
+   def report(self) :
+      print("cache               : {0:d} hits, {1:d} misses".format(self.hits,self.misses),file=sys.stderr)
+
+
+class HashStats :
+   """Bytes read and avoided by the individual stages of the hashing pipeline"""
+   def __init__(self) :
+      self.files = self.bytes = 0
+      self.size_unique_files = self.size_skipped = 0
+      self.partial_files = self.partial_read = self.partial_skipped = 0
+      self.full_files = self.full_read = 0
+
+   def report(self) :
+      print("\n*** hashing: {0:d} files, {1:d} bytes ***".format(self.files,self.bytes),file=sys.stderr)
+      print("stage 1 (size)      : {0:d} files with unique size, {1:d} bytes not read".format(
+         self.size_unique_files,self.size_skipped),file=sys.stderr)
+      print("stage 2 (head/tail) : {0:d} files, {1:d} bytes read, {2:d} bytes not read".format(
+         self.partial_files,self.partial_read,self.partial_skipped),file=sys.stderr)
+      print("stage 3 (full)      : {0:d} files, {1:d} bytes read".format(self.full_files,self.full_read),file=sys.stderr)
+
+
+class Metrics :
+   """Wall time of program phases, throughput counters and live progress line
+
+   Phases may overlap: without staged hashing, the directory walk runs concurrently with hashing."""
+   PROGRESS_INTERVAL = 0.5  # seconds between progress line updates on terminal
+   PROGRESS_LOG_INTERVAL = 10.0  # seconds between progress lines otherwise
+
+   def __init__(self,progress = False) :
+      self.progress = progress
+      self.phases = collections.OrderedDict()
+      self._started = {}
+      self.files_walked = self.bytes_walked = 0
+      self.files_hashed = self.bytes_hashed = 0
+      self.bytes_expected = 0  # bytes that are going to be read (grows during the walk if not staged)
+      self._last_progress = time.perf_counter()
 
-def read_hashes(hashfile) :
+   def start(self,phase) :
+      self._started[phase] = time.perf_counter()
+
+   def stop(self,phase) :
+      self.phases[phase] = self.phases.get(phase,0.0) + time.perf_counter() - self._started.pop(phase)
+
+   @contextlib.contextmanager
+   def phase(self,phase) :
+      self.start(phase)
+      try :
+         yield
+      finally :
+         self.stop(phase)
+
+   def walked(self,size) :
+      self.files_walked += 1
+      self.bytes_walked += size
+      if self.progress and "hash" not in self._started :
+         self._show_progress()
+
+   def hashed(self,size,new_file = True) :
+      """Count bytes read by a hashing stage; new_file is False if an earlier stage already counted the file"""
+      if new_file : self.files_hashed += 1
+      self.bytes_hashed += size
+      if self.progress :
+         self._show_progress()
+
+   def _show_progress(self,final = False) :
+      _now = time.perf_counter()
+      _tty = sys.stderr.isatty()
+      if not final and _now - self._last_progress < (self.PROGRESS_INTERVAL if _tty else self.PROGRESS_LOG_INTERVAL) : return
+      self._last_progress = _now
+      if "hash" in self._started or self.files_hashed :
+         _elapsed = max(_now - self._started["hash"] if "hash" in self._started else self.phases["hash"],1e-6)
+         _rate = self.bytes_hashed / _elapsed
+         _remaining = max(self.bytes_expected - self.bytes_hashed,0)
+         _eta = "{0:d}:{1:02d}:{2:02d}".format(*_hms(_remaining / _rate)) if _rate > 0 else "?"
+         _line = "hashing: {0:d} files, {1:.1f} of {2:.1f} MB, {3:.0f} files/s, {4:.1f} MB/s, ETA {5:s}".format(
+            self.files_hashed,self.bytes_hashed / 1e6,self.bytes_expected / 1e6,self.files_hashed / _elapsed,_rate / 1e6,_eta)
+      else :
+         _line = "walking: {0:d} files, {1:.1f} MB".format(self.files_walked,self.bytes_walked / 1e6)
+      if _tty :
+         sys.stderr.write("\r\x1b[K" + _line)
+      else :
+         sys.stderr.write(_line + "\n")
+      sys.stderr.flush()
+
+   def end_progress(self) :
+      if self.progress :
+         self._show_progress(True)
+         if sys.stderr.isatty() : sys.stderr.write("\n")
+
+   def report(self) :
+      print("\n*** timing ***",file=sys.stderr)
+      for _phase,_seconds in self.phases.items() :
+         print("{0:<8s} : {1:10.3f} s".format(_phase,_seconds),file=sys.stderr)
+      _hash_time = self.phases.get("hash")
+      if _hash_time :
+         print("hashing  : {0:.0f} files/s, {1:.1f} MB/s".format(self.files_hashed / _hash_time,self.bytes_hashed / _hash_time / 1e6),
+               file=sys.stderr)
+
+   def as_dict(self) :
+      _hash_time = self.phases.get("hash") or 0.0
+      return {
+         "phases_s": dict(self.phases),
+         "files_walked": self.files_walked, "bytes_walked": self.bytes_walked,
+         "files_hashed": self.files_hashed, "bytes_hashed": self.bytes_hashed,
+         "hash_files_per_s": self.files_hashed / _hash_time if _hash_time else None,
+         "hash_mb_per_s": self.bytes_hashed / _hash_time / 1e6 if _hash_time else None,
+      }
+
+
+def _hms(seconds) :
+   _seconds = int(seconds)
+   return _seconds // 3600,_seconds // 60 % 60,_seconds % 60
+
+
+def repeated_values(values,count) :
+   """Set of the values occurring more than once; values() returns an iterable of count values (used twice)
+
+   A first pass counts values into a table of about 4 * count hashed slots (saturating at 2); only values
+   whose slot was hit more than once are counted exactly in the second pass. So memory is proportional
+   to the number of possibly repeated values, not to the number of all values."""
+   _slot_count = 4 * count | 1
+   _slots = bytearray(_slot_count)
+   for _value in values() :
+      _slot = hash(_value) % _slot_count
+      if _slots[_slot] < 2 : _slots[_slot] += 1
+   _counts = collections.Counter(_value for _value in values() if _slots[hash(_value) % _slot_count] == 2)
+   return {_value for _value,_count in _counts.items() if _count > 1}
+
+
+def get_hashes(dirtrees,staged=True,cache=None,sink=None,metrics=None) :
+   """Compute content keys for all files in the given dir trees; returns one CompactIndex per tree
+
+   With staged=True, files are only read if they may have a duplicate in any of the trees: files with
+   a size unique across all trees are not read at all, and files whose head/tail digest is unique
+   within their size group are not read in full. Such files get a pseudo-key ('#size:...',
+   '#head-tail:...'), which is unique, so it never matches anything - in the same tree or the other one.
+   The walked files are kept as compact records throughout, and the files still in question at each
+   stage as packed record numbers.
+   With staged=False (needed for storing hashes or comparing against a hashfile), every key is
+   a full-content digest, and hashing runs concurrently with the directory walk.
+   Digests found in cache (HashCache) are not recomputed; bytes counted as read include cache hits.
+   If sink is given, it is called as sink(tree index, key, entry) instead of collecting the indexes.
+   Time spent and bytes read are recorded in metrics (Metrics), phases "walk" and "hash"."""
+   _metrics = metrics or Metrics()
+   _debug = options.debug
+   _hash_engine = options.hasher
+   _algorithm = options.hash
+   _ends_algorithm = "{0:s}:head-tail:{1:d}".format(_algorithm,PARTIAL_BLOCK)
+   _stats = HashStats()
+   _pool = HashPool(options.jobs,
+                    lambda _device: options.jobs_per_device or device_concurrency(_device,options.jobs),
+                    options.processes)
+   _indices = [CompactIndex(_dirtree,_algorithm) for _dirtree in dirtrees]
+
+   def _walk_all(expect) :
+      _metrics.start("walk")
+      for _tree_idx,_dirtree in enumerate(dirtrees) :
+         for _entry in walk_tree(_dirtree) :
+            _stats.files += 1
+            _stats.bytes += _entry.size
+            _metrics.walked(_entry.size)
+            if expect : _metrics.bytes_expected += _entry.size
+            yield _tree_idx,_entry
+      _metrics.stop("walk")
+
+   def _digests(items,algorithm,function,args) :
+      """Yield (item, entry, digest or None) for each (item, entry), using the cache if possible"""
+      _pending = collections.deque()  # entries handed over to the pool, not yet collected
+      def _tasks() :
+         for _item,_entry in items :
+            _pending.append((_item,_entry))
+            _digest = cache.lookup(_entry,algorithm) if cache else None
+            if _digest is not None :
+               yield _entry.dev,None,_digest
+            else :
+               yield _entry.dev,function,args(_entry)
+      for _digest in _pool.run(_tasks()) :
+         _item,_entry = _pending.popleft()
+         if cache and _digest is not None :
+            cache.store(_entry,algorithm,_digest)
+         yield _item,_entry,_digest
+
+   def _hash_full(items,add) :
+      for _item,_entry,_hash in _digests(items,_algorithm,hash_file,lambda _entry: (_entry.path,_hash_engine)) :
+         if _hash is None :
+            add(_item,None,_entry)
+            continue
+         if _debug : debug_msg("get_hashes: file \'{0:s}\' : hash = {1:s}\n",_entry.path,_hash)
+         add(_item,_hash,_entry)
+         _stats.full_files += 1
+         _stats.full_read += _entry.size
+         # files larger than the head & tail blocks were already counted by stage 2 when staged
+         _metrics.hashed(_entry.size,not staged or _entry.size <= 2 * PARTIAL_BLOCK)
+
+   # records of staged hashing are packed into one integer: tree index << 32 | record number
+   def _entries(records) :
+      for _record in records :
+         yield _record,_indices[_record >> 32].entry(_record & 0xffffffff)
+
+   def _set_key(record,key,entry) :
+      _index = _indices[record >> 32]
+      if key is None :
+         _index.discard(record & 0xffffffff)  # unreadable
+      else :
+         _index.set_key(record & 0xffffffff,key)
+
+   try :
+      if not staged :
+         # nothing can be skipped, so there is no reason to wait for the walk to finish
+         def _add(tree_idx,key,entry) :
+            if key is None : return
+            if sink :
+               sink(tree_idx,key,entry)
+            else :
+               _indices[tree_idx].add(entry,key)
+         with _metrics.phase("hash") :
+            _hash_full(_walk_all(True),_add)
+         return _indices,_stats
+
+      # stage 1: group by size
+      for _tree_idx,_entry in _walk_all(False) :
+         _indices[_tree_idx].add(_entry)
+      _metrics.start("hash")
+      _repeated = repeated_values(lambda: itertools.chain.from_iterable(_index.sizes for _index in _indices),
+                                  sum(len(_index) for _index in _indices))
+
+      _partial = array.array("Q")
+      _full = array.array("Q")
+      for _tree_idx,_index in enumerate(_indices) :
+         for _idx,_size in enumerate(_index.sizes) :
+            if _size not in _repeated :
+               _index.set_key(_idx,"#size:{0:d}".format(_size))
+               _stats.size_unique_files += 1
+               _stats.size_skipped += _size
+            # head/tail digest is pointless if that covers the whole file anyway
+            elif _size > 2 * PARTIAL_BLOCK :
+               _partial.append(_tree_idx << 32 | _idx)
+               _metrics.bytes_expected += 2 * PARTIAL_BLOCK
+            else :
+               _full.append(_tree_idx << 32 | _idx)
+               _metrics.bytes_expected += _size
+      del _repeated
+
+      # stage 2: group by digest of head & tail
+      _by_ends = collections.Counter()
+      for _record,_entry,_ends_hash in _digests(_entries(_partial),_ends_algorithm,hash_file_ends,
+                                                lambda _entry: (_entry.path,_entry.size,_hash_engine)) :
+         if _ends_hash is None :
+            _set_key(_record,None,_entry)
+            continue
+         _set_key(_record,"#head-tail:{0:d}:{1:s}".format(_entry.size,_ends_hash),_entry)
+         _by_ends[_entry.size,_ends_hash] += 1
+         _stats.partial_files += 1
+         _stats.partial_read += 2 * PARTIAL_BLOCK
+         _metrics.hashed(2 * PARTIAL_BLOCK)
+      for _record in _partial :
+         _index = _indices[_record >> 32]
+         _idx = _record & 0xffffffff
+         _key = _index.key(_idx)
+         if _key is None : continue
+         _size = _index.sizes[_idx]
+         if _by_ends[_size,_key.rpartition(":")[2]] > 1 :
+            _full.append(_record)
+            _metrics.bytes_expected += _size
+         else :
+            _stats.partial_skipped += _size - 2 * PARTIAL_BLOCK
+      del _partial,_by_ends
+
+      # stage 3: full-content digest
+      _hash_full(_entries(_full),_set_key)
+      del _full
+      _metrics.stop("hash")
+   finally :
+      _pool.close()
+      _metrics.end_progress()
+
+   if sink :
+      for _tree_idx,_index in enumerate(_indices) :
+         for _idx in range(len(_index)) :
+            _key = _index.key(_idx)
+            if _key is not None : sink(_tree_idx,_key,_index.entry(_idx))
+   return _indices,_stats
+
+
+class TreeIndex :
+   """In-memory index of a dir tree: {key: [FileEntry]}"""
+   def __init__(self,root,hashes,algorithm) :
+      self.root = root
+      self.hashes = hashes
+      self.algorithm = algorithm
+
+   def groups(self) :
+      """Yield (key,[FileEntry]) sorted by key, files sorted by path (walk order is not deterministic)"""
+      for _key in sorted(self.hashes) :
+         yield _key,sorted(self.hashes[_key],key=lambda _entry: _entry.path)
+
+
+class CompactIndex :
+   """Compact in-memory index of a dir tree with the same groups() interface as TreeIndex
+
+   Meant for trees of millions of files: instead of a FileEntry tuple, a path string and a hex key
+   string per file, records are kept in typed arrays - binary digest (packed into one bytearray),
+   size, mtime, inode, key kind, directory number and the end of the file name within one bytearray
+   of (fs-encoded) names. Directory paths and devices are kept once per directory. This takes about
+   55 bytes per file plus the length of its name, against about 500 for a dict of lists of FileEntry.
+
+   Key kinds: full digest, or a pseudo-key of staged hashing - unique size ('#size:N', no digest
+   stored) or unique head/tail digest ('#head-tail:N:hex', the head/tail digest stored). Files are
+   added without a key (kind UNHASHED) while staged hashing decides what to read, and get their key
+   later with set_key(). groups() yields full digests in key order, preceded by the pseudo-keys
+   (ordered by kind, size and digest, not as strings - being unique, they never match anything)."""
+   UNHASHED,HEAD_TAIL,SIZE,DIGEST = range(4)
+
+   def __init__(self,root,algorithm) :
+      self.root = root
+      self.algorithm = algorithm
+      self.digest_size = HASH_ALGORITHMS[algorithm][0]().digest_size
+      self._dirs = []  # directory paths
+      self._dir_ids = {}
+      self._dir_devs = array.array("Q")
+      self._other_devs = {}  # record -> device, for files not on the device of their directory (bind mounts)
+      self._file_dirs = array.array("I")
+      self._names = bytearray()
+      self._name_ends = array.array("Q")
+      self.sizes = array.array("q")
+      self._mtimes = array.array("q")
+      self._inos = array.array("Q")
+      self._kinds = bytearray()
+      self._digests = bytearray()
+
+   def __len__(self) :
+      return len(self._kinds)
+
+   def add(self,entry,key = None) :
+      """Add a file (FileEntry); returns its record number"""
+      _idx = len(self._kinds)
+      _dir,_name = os.path.split(entry.path)
+      _dir_id = self._dir_ids.get(_dir)
+      if _dir_id is None :
+         _dir_id = self._dir_ids[_dir] = len(self._dirs)
+         self._dirs.append(_dir)
+         self._dir_devs.append(entry.dev)
+      elif self._dir_devs[_dir_id] != entry.dev :
+         self._other_devs[_idx] = entry.dev
+      self._file_dirs.append(_dir_id)
+      self._names += os.fsencode(_name)
+      self._name_ends.append(len(self._names))
+      self.sizes.append(entry.size)
+      self._mtimes.append(entry.mtime)
+      self._inos.append(entry.ino)
+      self._kinds.append(self.UNHASHED)
+      self._digests += bytes(self.digest_size)
+      if key is not None :
+         self.set_key(_idx,key)
+      return _idx
+
+   def set_key(self,idx,key) :
+      if key.startswith("#size:") :
+         self._kinds[idx] = self.SIZE
+         return
+      if key.startswith("#head-tail:") :
+         self._kinds[idx] = self.HEAD_TAIL
+         key = key.rpartition(":")[2]
+      else :
+         self._kinds[idx] = self.DIGEST
+      self._digests[idx * self.digest_size:(idx + 1) * self.digest_size] = bytes.fromhex(key)
+
+   def discard(self,idx) :
+      """Leave a record out of groups() (e.g. file unreadable)"""
+      self._kinds[idx] = self.UNHASHED
+
+   def digest(self,idx) :
+      """Raw digest (or head/tail digest) of a record"""
+      return bytes(self._digests[idx * self.digest_size:(idx + 1) * self.digest_size])
+
+   def key(self,idx) :
+      _kind = self._kinds[idx]
+      if _kind == self.DIGEST :
+         return self.digest(idx).hex()
+      if _kind == self.SIZE :
+         return "#size:{0:d}".format(self.sizes[idx])
+      if _kind == self.HEAD_TAIL :
+         return "#head-tail:{0:d}:{1:s}".format(self.sizes[idx],self.digest(idx).hex())
+      return None
+
+   def entry(self,idx) :
+      _dir_id = self._file_dirs[idx]
+      _name = os.fsdecode(bytes(self._names[self._name_ends[idx - 1] if idx else 0:self._name_ends[idx]]))
+      return FileEntry(os.path.join(self._dirs[_dir_id],_name),self.sizes[idx],
+                       self._other_devs.get(idx,self._dir_devs[_dir_id]),self._inos[idx],self._mtimes[idx])
+
+   def groups(self) :
+      """Yield (key,[FileEntry]) sorted by key (see above), files sorted by path"""
+      _kinds = self._kinds
+      for _kind,_order in ((self.HEAD_TAIL,lambda _idx: (self.sizes[_idx],self.digest(_idx))),(self.SIZE,self.sizes.__getitem__)) :
+         for _idx in sorted((_idx for _idx in range(len(_kinds)) if _kinds[_idx] == _kind),key=_order) :
+            yield self.key(_idx),[self.entry(_idx)]
+      # full digests: bucket records by first digest byte, so that sort keys exist for one bucket at a time
+      _buckets = [array.array("I") for _ in range(256)]
+      _size = self.digest_size
+      _digests = self._digests
+      for _idx in range(len(_kinds)) :
+         if _kinds[_idx] == self.DIGEST :
+            _buckets[_digests[_idx * _size]].append(_idx)
+      for _b in range(256) :
+         _bucket = sorted(_buckets[_b],key=self.digest)
+         _buckets[_b] = None
+         for _digest,_records in itertools.groupby(_bucket,key=self.digest) :
+            yield _digest.hex(),sorted((self.entry(_idx) for _idx in _records),key=lambda _entry: _entry.path)
+
+
+def escape_path(path) :
+   """Manifest representation of a relative path: one line, no tabs, arbitrary (non-UTF-8) file names preserved"""
+   return os.fsencode(path).replace(b"\\",b"\\\\").replace(b"\t",b"\\t").replace(b"\n",b"\\n")
+
+def unescape_path(raw) :
+   return os.fsdecode(MANIFEST_UNESCAPE_RE.sub(lambda _match: MANIFEST_UNESCAPE[_match.group(0)],raw))
+
+MANIFEST_UNESCAPE = {b"\\\\": b"\\", b"\\t": b"\t", b"\\n": b"\n"}
+MANIFEST_UNESCAPE_RE = re.compile(rb"\\[\\tn]")
+
+
+class ManifestWriter :
+   """Writes a hash manifest: header followed by one line per file, sorted by digest
+
+   Line format: digest <TAB> size <TAB> mtime (ns) <TAB> path relative to root. Records are buffered
+   and sorted in runs of RUN_SIZE lines, spilled to temporary files and merged when closing, so memory
+   use does not depend on tree size. The manifest appears under its final name only when complete."""
+   MAGIC = b"#dir_cmp-manifest 1\n"
+   RUN_SIZE = 1000000
+
+   def __init__(self,filename,root,algorithm) :
+      self.filename = filename
+      self.root = os.path.abspath(root)  # recorded absolute, so the manifest can be used from anywhere
+      self.algorithm = algorithm
+      self._prefix = os.path.join(root,"")
+      self._lines = []
+      self._runs = []
+      self._sorted_sources = []
+
+   def __enter__(self) :
+      return self
+
+   def __exit__(self,exc_type,exc_value,traceback) :
+      if exc_type is None :
+         self.close()
+      else :
+         self._cleanup()
+
+   def add(self,digest,entry) :
+      _relpath = entry.path[len(self._prefix):] if entry.path.startswith(self._prefix) else os.path.relpath(entry.path,self.root)
+      self.add_line(b"%s\t%d\t%d\t%s\n" % (digest.encode("ascii"),entry.size,entry.mtime,escape_path(_relpath)))
+
+   def add_line(self,line) :
+      self._lines.append(line)
+      if len(self._lines) >= self.RUN_SIZE :
+         self._spill()
+
+   def add_sorted(self,lines) :
+      """Add an iterable of record lines that is already sorted; it is merged in when closing"""
+      self._sorted_sources.append(lines)
+
+   def _spill(self) :
+      self._lines.sort()
+      with tempfile.NamedTemporaryFile("wb",dir=os.path.dirname(os.path.abspath(self.filename)),
+                                       prefix=".dir_cmp-run-",delete=False) as _run :
+         _run.writelines(self._lines)
+      self._runs.append(_run.name)
+      self._lines = []
+
+   def close(self) :
+      self._lines.sort()
+      _tmpname = self.filename + ".tmp"
+      _runs = [open(_run,"rb") for _run in self._runs]
+      try :
+         with open(_tmpname,"wb") as _output :
+            _output.write(self.MAGIC)
+            _output.write(b"#root\t%s\n#algorithm\t%s\n#end\n" % (escape_path(self.root),self.algorithm.encode("ascii")))
+            _output.writelines(heapq.merge(self._lines,*(_runs + self._sorted_sources)))
+         os.replace(_tmpname,self.filename)
+      finally :
+         for _run in _runs : _run.close()
+         self._cleanup()
+
+   def _cleanup(self) :
+      for _run in self._runs :
+         os.remove(_run)
+      self._runs = []
+      self._lines = []
+      self._sorted_sources = []
+
+
+class Manifest :
+   """Hash manifest written by ManifestWriter; records are read sequentially through mmap"""
+   def __init__(self,filename) :
+      self.filename = filename
+      with open(filename,"rb") as _input :
+         self._map = mmap.mmap(_input.fileno(),0,access=mmap.ACCESS_READ)
+      if self._map.readline() != ManifestWriter.MAGIC :
+         raise ValueError("not a hash manifest")
+      _header = {}
+      while True :
+         _line = self._map.readline()
+         if not _line.startswith(b"#") :
+            raise ValueError("truncated manifest header")
+         if _line == b"#end\n" : break
+         _name,_,_value = _line[1:-1].partition(b"\t")
+         _header[_name] = _value
+      self._data_start = self._map.tell()
+      self.root = unescape_path(_header[b"root"])
+      self.algorithm = _header[b"algorithm"].decode("ascii")
+
+   def lines(self) :
+      """Yield raw record lines, sorted"""
+      _map = self._map
+      _map.seek(self._data_start)
+      for _line in iter(_map.readline,b"") :
+         yield _line
+
+   def groups(self) :
+      """Yield (digest,[FileEntry]) sorted by digest, one group in memory at a time"""
+      _key = None
+      _group = []
+      _prefix = os.path.join(self.root,"")
+      for _line in self.lines() :
+         _digest,_size,_mtime,_relpath = _line[:-1].split(b"\t",3)
+         if _digest != _key :
+            if _group : yield _key.decode("ascii"),_group
+            _key = _digest
+            _group = []
+         _group.append(FileEntry(_prefix + unescape_path(_relpath),int(_size),None,None,int(_mtime)))
+      if _group : yield _key.decode("ascii"),_group
+
+
+def load_hashes(hashfile) :
+   """Open a hash manifest; hashfiles pickled by older versions of this script are loaded into memory"""
+   try :
+      return Manifest(hashfile)
+   except (ValueError,KeyError) :
+      pass
    with open(hashfile,'rb') as input_file:
       try:
-         options.dir = pickle.load(input_file)
-         return pickle.load(input_file)
+         _root = pickle.load(input_file)
+         _hashes = pickle.load(input_file)
       except:
          error("Wrong format of hashfile {0}!".format(hashfile), True)
+   for _key in _hashes :
+      _hashes[_key] = [FileEntry(_path,None,None,None,None) for _path in _hashes[_key]]
+   return TreeIndex(_root,_hashes,None)
 
 
-def get_hashes(dirtree) :
-   _hash_engine = options.hasher
+def merge_manifests(filename,hashfiles) :
+   """Merge manifests of several (sub)trees into one, rooted at their common parent directory"""
+   _manifests = [load_hashes(_hashfile) for _hashfile in hashfiles]
+   for _hashfile,_manifest in zip(hashfiles,_manifests) :
+      if not isinstance(_manifest,Manifest) :
+         error("Hashfile {0} has an old format that cannot be merged; recompute it".format(_hashfile),True)
+      if _manifest.algorithm != _manifests[0].algorithm :
+         error("Hashfiles {0} and {1} use different hash algorithms".format(hashfiles[0],_hashfile),True)
+   _root = os.path.commonpath([_manifest.root for _manifest in _manifests])
 
-   # validate options
-   if not os.access(dirtree, os.R_OK):
-      error("Cannot read directory {0}".format(dirtree), True)
+   def _rebased(manifest) :
+      # prepending the same prefix to all paths keeps the lines sorted
+      _prefix = escape_path(os.path.join(os.path.relpath(manifest.root,_root),"")) if manifest.root != _root else b""
+      for _line in manifest.lines() :
+         _fields = _line.split(b"\t",3)
+         _fields[3] = _prefix + _fields[3]
+         yield b"\t".join(_fields)
+
+   with ManifestWriter(filename,_root,_manifests[0].algorithm) as _writer :
+      for _manifest in _manifests :
+         _writer.add_sorted(_rebased(_manifest))
+
+
+def merge_groups(streams) :
+   """K-way merge of sorted (key,[FileEntry]) streams; yields (key,[[FileEntry] from each stream])"""
+   def _tagged(idx,stream) :
+      for _key,_files in stream :
+         yield _key,idx,_files
+   _merged = heapq.merge(*[_tagged(_idx,_stream) for _idx,_stream in enumerate(streams)])
+   for _key,_items in itertools.groupby(_merged,key=lambda _item: _item[0]) :
+      _files = [[] for _ in streams]
+      for _,_idx,_group in _items :
+         _files[_idx] = _group
+      yield _key,_files
+
+
+def entry_size(entry) :
+   """File size, as recorded (hashfiles of older versions have none) or from the file system"""
+   return entry.size if entry.size is not None else os.path.getsize(entry.path)
+
+
+def relative_path(path,root) :
+   """Path relative to root; cheap for paths under root (as all paths produced by walks and manifests are)"""
+   _prefix = os.path.join(root,"")
+   return path[len(_prefix):] if path.startswith(_prefix) else os.path.relpath(path,root)
 
-   # start_time = time.time()
-   # _hashes = get_hashes(options.dir,md5)
-   # print "MD5: elapsed time = {0:f}, dict size = {1:d}".format(time.time() - start_time,len(_hashes))
-   debug_msg("processing directory tree \"{0:s}\"".format(dirtree))
-
-   _hashes = {}
-   if os.path.isdir(dirtree) : debug_msg("get_hashes: valid directory \'{0:s}\' passed as argument".format(dirtree))
-   for dirpath, dirs, files in os.walk(dirtree) :
-      debug_msg("get_hashes: descending into directory \'{0:s}\'\n".format(dirpath))
-      for _file in files :
-         _file_fullpath = os.path.join(dirpath,_file)
-         debug_msg("get_hashes: processing file name \'{0:s}\'\n".format(_file_fullpath))
-         if os.path.isfile(_file_fullpath) :
-            if os.access(_file_fullpath,os.R_OK) :
-               with open(_file_fullpath,'rb') as _input_file :
-                  _hasher = _hash_engine()
-                  while True :
-                     data = _input_file.read(BUF_SIZE)
-                     if not data : break
-                     _hasher.update(data)
-                  _hash = _hasher.hexdigest()
-                  debug_msg("get_hashes: file \'{0:s}\' : hash = {1:s}\n".format(_file_fullpath,_hash))
-                  #print "File: {0}, hash: {1}".format(_file_fullpath,_hash)
-                  append_or_insert(_hashes,_hash,_file_fullpath)
-            else : error("Cannot read file {0}, skipping".format(_file_fullpath),False)
-
-#      for _dir in dirs :
-#         debug_msg("get_hashes: os.walk generated: {0:s} {1:s}\n".format(dirpath,_dir))
-#         _dir_fullpath = os.path.join(dirpath,_dir)
-#         debug_msg("get_hashes: descending into directory {0:s}\n".format(_dir_fullpath))
-#         for _file in os.listdir(_dir_fullpath) :
-   return _hashes
-
-
-def detect_duplicates(dir_hashes) :
+
+def join_groups(left,right) :
+   """Merge-join two sorted (key,[FileEntry]) streams; yields (key,left entries,right entries), missing side as []"""
+   _left = next(left,None)
+   _right = next(right,None)
+   while _left is not None or _right is not None :
+      if _right is None or (_left is not None and _left[0] < _right[0]) :
+         yield _left[0],_left[1],[]
+         _left = next(left,None)
+      elif _left is None or _right[0] < _left[0] :
+         yield _right[0],[],_right[1]
+         _right = next(right,None)
+      else :
+         yield _left[0],_left[1],_right[1]
+         _left = next(left,None)
+         _right = next(right,None)
+
+
+def detect_duplicates(groups) :
+   """Find duplicates in a sorted (key,[FileEntry]) stream; returns [(key,size,[FileEntry])] and hash collision count"""
    _hash_collisions = 0
    _duplicates = []
-   for _hash in sorted(dir_hashes.keys()) :
-      _files = dir_hashes[_hash]
-      debug_msg("detect_duplicates: hash {0:s} associated with files {1:s}\n".format(_hash,str(_files)))
+   _debug = options.debug
+   for _hash,_files in groups :
+      if _debug : debug_msg("detect_duplicates: hash {0:s} associated with files {1:s}\n",_hash,str([_file.path for _file in _files]))
       if len(_files) > 1 :
-         _sizes = {}  # 2nd identity criterion - file size
+         _sizes = {}  # 2nd identity criterion - file size (as recorded; hashfiles of old versions have none)
          for _file in _files :
-            append_or_insert(_sizes,os.path.getsize(_file),_file)
-         debug_msg("detect_duplicates: hash {0:s} - files sizes {1:s}\n".format(_hash,str(_sizes)))
+            append_or_insert(_sizes,entry_size(_file),_file)
+         if _debug : debug_msg("detect_duplicates: hash {0:s} - files sizes {1:s}\n",_hash,str(list(_sizes)))
          for _size in _sizes :
             if len(_sizes[_size]) > 1 :
                #print "--- Duplicates: ---------"
                #for _file in _sizes[_size] :
                #   print _file
                _duplicates.append((_hash,_size,_sizes[_size]))  # store tuple
-               debug_msg("detect_duplicates: hash {0:s} - DUPLICATE DETECTED\n".format(_hash))
+               if _debug : debug_msg("detect_duplicates: hash {0:s} - DUPLICATE DETECTED\n",_hash)
          if len(_sizes) > 1 :
             _hash_collisions += 1
    return _duplicates,_hash_collisions
@@ -171,18 +1228,901 @@ def report_duplicates(candidate_dir_dups,hash_collisions) :
          for _dup in candidate_dir_dups :
             _msg = "\"DIR DUPLICATE\""
             _,_,_filenames = _dup
-            for _dupname in _filenames :
-               _msg += ",\"{0:s}\"".format(_dupname)
+            for _dup_entry in _filenames :
+               _msg += ",\"{0:s}\"".format(_dup_entry.path)
             print(_msg)
       else :
          for _dup in candidate_dir_dups :
             _msg = "DIR DUPLICATE: "
             _,_,_filenames = _dup
-            for _dupname in _filenames :
-               _msg += " \'{0:s}\'".format(_dupname)
+            for _dup_entry in _filenames :
+               _msg += " \'{0:s}\'".format(_dup_entry.path)
             print(_msg)
    print(("\n*** directory tree: {0:d} duplicate sets detectes ***".format(len(candidate_dir_dups))))
 
+def files_identical(filename1,filename2) :
+   """Byte-by-byte comparison (digests are only used to find candidates; links are made only for identical files)"""
+   with open(filename1,'rb') as _file1, open(filename2,'rb') as _file2 :
+      while True :
+         _data1 = _file1.read(MAX_BUF_SIZE)
+         if _data1 != _file2.read(MAX_BUF_SIZE) : return False
+         if not _data1 : return True
+
+
+class DuplicateLinker :
+   """Reclaims space taken by duplicates, replacing them with links to (or clones of) the copy being kept
+
+   Pairs (kept file, duplicate) are collected and processed in batches of BATCH_SIZE: each pair is
+   compared byte by byte, the link or clone is created under a temporary name in the duplicate's
+   directory and renamed over the duplicate (atomic - the path never disappears), and finally the
+   modified directories are synced."""
+   LINK_MODES = ["hardlink","reflink","symlink"]
+   BATCH_SIZE = 256
+   FICLONE = 0x40049409  # from linux/fs.h
+
+   def __init__(self,link_mode) :
+      self.link_mode = link_mode
+      self._batch = []
+      self.linked = self.skipped = self.failed = self.reclaimed = 0
+
+   def add(self,keep,duplicate) :
+      self._batch.append((keep,duplicate))
+      if len(self._batch) >= self.BATCH_SIZE :
+         self.flush()
+
+   def flush(self) :
+      _dirs = set()
+      for _keep,_duplicate in self._batch :
+         try :
+            if self._replace(_keep,_duplicate) :
+               _dirs.add(os.path.dirname(_duplicate))
+         except OSError as _exc :
+            self.failed += 1
+            error("Cannot replace {0} with {1} of {2}: {3}".format(_duplicate,self.link_mode,_keep,_exc.strerror))
+      self._batch = []
+      for _dir in _dirs :
+         _fd = os.open(_dir,os.O_RDONLY)
+         try :
+            os.fsync(_fd)
+         finally :
+            os.close(_fd)
+
+   def _replace(self,keep,duplicate) :
+      _keep_stat = os.stat(keep)
+      _dup_stat = os.lstat(duplicate)
+      if (_keep_stat.st_dev,_keep_stat.st_ino) == (_dup_stat.st_dev,_dup_stat.st_ino) or not stat.S_ISREG(_dup_stat.st_mode) :
+         self.skipped += 1  # already linked
+         return False
+      if not files_identical(keep,duplicate) :
+         self.skipped += 1
+         error("Files {0} and {1} have equal digests, but differ; not linking".format(keep,duplicate))
+         return False
+      _tmpname = os.path.join(os.path.dirname(duplicate),".{0:s}.dir_cmp-{1:d}".format(os.path.basename(duplicate),os.getpid()))
+      try :
+         if self.link_mode == "hardlink" :
+            os.link(keep,_tmpname)
+         elif self.link_mode == "symlink" :
+            os.symlink(os.path.abspath(keep),_tmpname)
+         else :
+            with open(keep,'rb') as _source, open(_tmpname,'wb') as _clone :
+               fcntl.ioctl(_clone.fileno(),self.FICLONE,_source.fileno())
+            # a clone is a separate file, so it can keep the duplicate's metadata
+            shutil.copystat(duplicate,_tmpname)
+            try :
+               os.chown(_tmpname,_dup_stat.st_uid,_dup_stat.st_gid)
+            except PermissionError :
+               pass
+         os.rename(_tmpname,duplicate)
+      except BaseException :
+         if os.path.lexists(_tmpname) : os.remove(_tmpname)
+         raise
+      self.linked += 1
+      if _dup_stat.st_nlink == 1 :  # otherwise the data is still referenced by another hard link
+         self.reclaimed += _dup_stat.st_size
+      return True
+
+   def report(self) :
+      self.flush()
+      print("\n*** {0:s}: {1:d} files replaced, {2:d} skipped, {3:d} failed; {4:d} bytes reclaimed ***".format(
+         self.link_mode,self.linked,self.skipped,self.failed,self.reclaimed))
+
+
+def copy_file_data(source,target,size) :
+   """Copy file contents between open files inside the kernel; returns the method used
+
+   Tries a copy-on-write clone first (btrfs, XFS; only possible within one filesystem), then
+   os.copy_file_range() and os.sendfile(); plain read/write is the last resort."""
+   if os.fstat(source.fileno()).st_dev == os.fstat(target.fileno()).st_dev :
+      try :
+         fcntl.ioctl(target.fileno(),DuplicateLinker.FICLONE,source.fileno())
+         return "reflink"
+      except OSError :
+         pass
+   for _method in ("copy_file_range","sendfile") :
+      if not hasattr(os,_method) : continue
+      _offset = 0
+      try :
+         while _offset < size :
+            if _method == "copy_file_range" :
+               _count = os.copy_file_range(source.fileno(),target.fileno(),size - _offset,_offset,_offset)
+            else :
+               _count = os.sendfile(target.fileno(),source.fileno(),_offset,size - _offset)
+            if not _count : break  # file shrank meanwhile; caught by verification
+            _offset += _count
+         return _method
+      except OSError as _exc :
+         if _offset or _exc.errno not in (errno.EXDEV,errno.ENOSYS,errno.EINVAL,errno.EOPNOTSUPP,errno.ENOTSUP) :
+            raise
+   source.seek(0)
+   shutil.copyfileobj(source,target,MAX_BUF_SIZE)
+   return "read/write"
+
+
+class RepositorySync :
+   """Copies files missing from the repository into it, under the same relative paths
+
+   Copies run on a pool of --jobs threads. Each file is copied (see copy_file_data()) to a temporary
+   name next to its target, gets the source's metadata, is verified against the digest computed for
+   the source and only then renamed to its final name; existing files are never overwritten.
+   Progress is recorded in a journal (lines 'start'/'done' <TAB> size <TAB> mtime <TAB> relative path),
+   so an interrupted sync skips finished files when re-run and removes temporary files left behind;
+   the journal is deleted when a sync completes without failures."""
+   JOURNAL_DIR = os.path.join(os.path.expanduser("~"),".cache","dir_cmp")
+
+   def __init__(self,source_root,target_root,algorithm,jobs = 1,journal = None) :
+      self.source_root = source_root
+      self.target_root = target_root
+      self._hash_engine = HASH_ALGORITHMS[algorithm][0]
+      self.jobs = jobs
+      if journal is None :
+         _id = hashlib.md5(os.fsencode(source_root) + b"\0" + os.fsencode(target_root)).hexdigest()
+         journal = os.path.join(self.JOURNAL_DIR,"sync-{0:s}.journal".format(_id))
+      self.journal = journal
+      self._lock = threading.Lock()
+      self._created_dirs = set()
+      self.copied = self.resumed = self.skipped = self.failed = self.bytes_copied = 0
+      self.methods = collections.Counter()
+
+   def _tmpname(self,target) :
+      return os.path.join(os.path.dirname(target),".{0:s}.dir_cmp-sync".format(os.path.basename(target)))
+
+   def _read_journal(self) :
+      """Relative paths of files copied by an earlier run: {relpath: (size,mtime)}; removes stale temporary files"""
+      _done = {}
+      _started = set()
+      if not os.path.exists(self.journal) :
+         return _done
+      with open(self.journal,"rb") as _input :
+         for _line in _input :
+            if not _line.endswith(b"\n") : break  # torn write
+            _state,_size,_mtime,_relpath = _line[:-1].split(b"\t",3)
+            _relpath = unescape_path(_relpath)
+            if _state == b"done" :
+               _done[_relpath] = (int(_size),int(_mtime))
+               _started.discard(_relpath)
+            else :
+               _started.add(_relpath)
+      for _relpath in _started :
+         _tmpname = self._tmpname(os.path.join(self.target_root,_relpath))
+         if os.path.lexists(_tmpname) :
+            debug_msg("sync: removing {0:s} left by interrupted copy",_tmpname)
+            os.remove(_tmpname)
+      return _done
+
+   def _log(self,state,entry,relpath) :
+      with self._lock :
+         self._journal.write(b"%s\t%d\t%d\t%s\n" % (state,entry.size,entry.mtime,escape_path(relpath)))
+         self._journal.flush()
+
+   def _copy(self,key,entry) :
+      _relpath = relative_path(entry.path,self.source_root)
+      _target = os.path.join(self.target_root,_relpath)
+      if os.path.lexists(_target) :
+         with self._lock : self.skipped += 1
+         error("{0:s} already exists in repository with different contents; not overwriting".format(_target))
+         return
+      _dir = os.path.dirname(_target)
+      with self._lock :
+         if not os.path.isdir(_dir) :
+            # remember created directories, to give them the source's metadata at the end
+            _missing = _dir
+            while not os.path.isdir(_missing) :
+               self._created_dirs.add(_missing)
+               _missing = os.path.dirname(_missing)
+            os.makedirs(_dir)
+      # pseudo-keys from staged hashing (unique size or head/tail) are not digests; hash the source then
+      _expected = hash_file(entry.path,self._hash_engine) if key.startswith("#") else key
+      self._log(b"start",entry,_relpath)
+      _tmpname = self._tmpname(_target)
+      try :
+         with open(entry.path,"rb") as _source, open(_tmpname,"wb") as _copy :
+            _size = os.fstat(_source.fileno()).st_size
+            _method = copy_file_data(_source,_copy,_size)
+         shutil.copystat(entry.path,_tmpname)
+         try :
+            _stat = os.stat(entry.path)
+            os.chown(_tmpname,_stat.st_uid,_stat.st_gid)
+         except PermissionError :
+            pass
+         if hash_file(_tmpname,self._hash_engine) != _expected :
+            raise ValueError("copy does not match digest of {0:s} (was it modified during sync?)".format(entry.path))
+         if os.path.lexists(_target) :
+            raise ValueError("{0:s} appeared in repository meanwhile".format(_target))
+         os.rename(_tmpname,_target)
+      except (OSError,ValueError) as _exc :
+         if os.path.lexists(_tmpname) : os.remove(_tmpname)
+         with self._lock : self.failed += 1
+         error("Cannot copy {0} to {1}: {2}".format(entry.path,_target,_exc.strerror if isinstance(_exc,OSError) else _exc))
+         return
+      self._log(b"done",entry,_relpath)
+      with self._lock :
+         self.copied += 1
+         self.bytes_copied += _size
+         self.methods[_method] += 1
+
+   def run(self,files) :
+      """Copy [(key,FileEntry)] (files of the source tree absent from the repository)"""
+      _done = self._read_journal()
+      _dir = os.path.dirname(self.journal)
+      if _dir and not os.path.isdir(_dir) :
+         os.makedirs(_dir)
+      _pending = []
+      for _key,_entry in files :
+         _relpath = relative_path(_entry.path,self.source_root)
+         if _done.get(_relpath) == (_entry.size,_entry.mtime) and os.path.exists(os.path.join(self.target_root,_relpath)) :
+            self.resumed += 1
+         else :
+            _pending.append((_key,_entry))
+      with open(self.journal,"ab") as self._journal :
+         with concurrent.futures.ThreadPoolExecutor(self.jobs) as _executor :
+            for _ in _executor.map(lambda _item: self._copy(*_item),_pending) :
+               pass
+      # deepest first, so that setting a directory's mtime is not undone by changes inside it
+      for _created in sorted(self._created_dirs,key=lambda _dir: _dir.count(os.sep),reverse=True) :
+         shutil.copystat(os.path.join(self.source_root,relative_path(_created,self.target_root)),_created)
+      if not self.failed :
+         os.remove(self.journal)
+
+   def report(self) :
+      print("\n*** sync to {0:s}: {1:d} files copied ({2:d} bytes; {3:s}), {4:d} already copied before, {5:d} skipped, {6:d} failed ***".format(
+         self.target_root,self.copied,self.bytes_copied,
+         ", ".join("{0:d} by {1:s}".format(_count,_method) for _method,_count in sorted(self.methods.items())) or "none",
+         self.resumed,self.skipped,self.failed))
+
+
+# content-defined chunking: a chunk ends after a byte where the gear hash of the preceding
+# CHUNK_WINDOW bytes has its top CHUNK_AVG_BITS bits zero, so boundaries depend on content only
+# and survive insertions and deletions elsewhere in the file
+CHUNK_AVG_BITS = 13  # 8 KiB average chunk
+CHUNK_MIN = 2048
+CHUNK_MAX = 65536
+CHUNK_WINDOW = 32  # the 32 bit gear hash only depends on the last 32 bytes
+CHUNK_MASK = ((1 << CHUNK_AVG_BITS) - 1) << (32 - CHUNK_AVG_BITS)
+CHUNK_BLOCK = 4 * MAX_BUF_SIZE
+GEAR = [int.from_bytes(hashlib.md5(bytes([_byte])).digest()[:4],"little") for _byte in range(256)]
+if numpy is not None :
+   GEAR_ARRAY = numpy.array(GEAR,dtype=numpy.uint32)
+
+
+def gear_cut_points(data,history) :
+   """Offsets into data after which a chunk may end; history holds the preceding (up to CHUNK_WINDOW-1) bytes
+
+   Uses numpy if available: the hash of the window ending at byte i is sum(GEAR[data[i-k]] << k), which is
+   computed for the whole block at once in CHUNK_WINDOW vectorised passes."""
+   if numpy is not None :
+      _gears = GEAR_ARRAY[numpy.frombuffer(history + data,dtype=numpy.uint8)]
+      _count = len(data)
+      _hashes = numpy.zeros(_count,dtype=numpy.uint32)
+      for _shift in range(min(CHUNK_WINDOW,len(_gears))) :
+         _start = len(history) - _shift
+         if _start >= 0 :
+            _hashes += _gears[_start:_start + _count] << numpy.uint32(_shift)
+         else :
+            _hashes[-_start:] += _gears[:_count + _start] << numpy.uint32(_shift)
+      return (numpy.flatnonzero((_hashes & numpy.uint32(CHUNK_MASK)) == 0) + 1).tolist()
+   _hash = 0
+   for _byte in history :
+      _hash = ((_hash << 1) + GEAR[_byte]) & 0xffffffff
+   _cuts = []
+   for _offset,_byte in enumerate(data,1) :
+      _hash = ((_hash << 1) + GEAR[_byte]) & 0xffffffff
+      if not _hash & CHUNK_MASK :
+         _cuts.append(_offset)
+   return _cuts
+
+
+def chunk_file(filename,hash_engine) :
+   """Split the file into content-defined chunks of CHUNK_MIN..CHUNK_MAX bytes; returns [(digest,length)]"""
+   _chunks = []
+   _pending = bytearray()  # data since the last boundary
+   _history = b""
+   _last = _position = 0  # file offsets of the last boundary and of the end of data read so far
+
+   def _emit(boundary) :
+      _length = boundary - _last
+      _chunks.append((hash_engine(_pending[:_length]).hexdigest(),_length))
+      del _pending[:_length]
+      return boundary
+
+   with open(filename,'rb',buffering=0) as _input_file :
+      while True :
+         _data = _input_file.read(CHUNK_BLOCK)
+         if not _data : break
+         _pending += _data
+         for _cut in gear_cut_points(_data,_history) :
+            _cut += _position
+            while _cut - _last > CHUNK_MAX :
+               _last = _emit(_last + CHUNK_MAX)
+            if _cut - _last >= CHUNK_MIN :
+               _last = _emit(_cut)
+         _position += len(_data)
+         while _position - _last >= CHUNK_MAX :
+            _last = _emit(_last + CHUNK_MAX)
+         _history = (_history + _data)[-(CHUNK_WINDOW - 1):]
+   if _position > _last :
+      _emit(_position)
+   return _chunks
+
+
+class ChunkIndex :
+   """Chunk lists of files, and which files (with offsets) hold each chunk
+
+   Chunk lists are cached in the HashCache (if any) as 'length:digest ...', under algorithm 'chunks-<algorithm>'."""
+   def __init__(self,algorithm,cache = None) :
+      self._hash_engine = HASH_ALGORITHMS[algorithm][0]
+      self._cache_key = "chunks-" + algorithm
+      self._cache = cache
+      self.files = []
+      self.owners = {}  # chunk digest -> [(file index, offset)]
+      self.bytes_chunked = 0
+
+   def chunks(self,entry) :
+      """[(digest,length)] of the file, or None if it cannot be read"""
+      if self._cache and entry.dev is not None :
+         _cached = self._cache.lookup(entry,self._cache_key)
+         if _cached is not None :
+            return [(_digest,int(_length)) for _length,_,_digest in (_item.partition(":") for _item in _cached.split())]
+      try :
+         _chunks = chunk_file(entry.path,self._hash_engine)
+      except OSError as _exc :
+         error("Cannot read file {0} ({1}), skipping".format(entry.path,_exc.strerror),False)
+         return None
+      self.bytes_chunked += sum(_length for _,_length in _chunks)
+      if self._cache and entry.dev is not None :
+         self._cache.store(entry,self._cache_key," ".join("{0:d}:{1:s}".format(_length,_digest) for _digest,_length in _chunks))
+      return _chunks
+
+   def add(self,entry) :
+      _chunks = self.chunks(entry)
+      if _chunks is None : return
+      _idx = len(self.files)
+      self.files.append(entry)
+      _offset = 0
+      for _digest,_length in _chunks :
+         _owners = self.owners.setdefault(_digest,[])
+         if not _owners or _owners[-1][0] != _idx :
+            _owners.append((_idx,_offset))
+         _offset += _length
+
+   def similarity(self,chunks) :
+      """(best matching file index or None, bytes shared with it, bytes found in any indexed file)"""
+      _shared = collections.Counter()
+      _found = 0
+      for _digest,_length in chunks :
+         _owners = self.owners.get(_digest)
+         if _owners :
+            _found += _length
+            for _idx,_ in _owners :
+               _shared[_idx] += _length
+      if not _shared :
+         return None,0,0
+      _best,_bytes = _shared.most_common(1)[0]
+      return _best,_bytes,_found
+
+
+class DeltaWriter :
+   """Delta of a file against a base file: copies of base ranges for shared chunks, literal data otherwise
+
+   Format: header lines (like hash manifests) followed by records 'C' <offset> <length> (copy from base)
+   and 'L' <length> <data> (literal), integers as 8-byte little endian."""
+   MAGIC = b"#dir_cmp-delta 1\n"
+
+   @staticmethod
+   def write(filename,target,chunks,base,base_offsets,algorithm) :
+      """Write delta of target (with chunk list chunks) against base; base_offsets maps chunk digest -> base offset
+
+      Returns the number of literal bytes."""
+      _records = []  # [kind,offset,length]
+      _offset = 0
+      for _digest,_length in chunks :
+         _base_offset = base_offsets.get(_digest)
+         if _base_offset is not None :
+            if _records and _records[-1][0] == b"C" and _records[-1][1] + _records[-1][2] == _base_offset :
+               _records[-1][2] += _length
+            else :
+               _records.append([b"C",_base_offset,_length])
+         elif _records and _records[-1][0] == b"L" and _records[-1][1] + _records[-1][2] == _offset :
+            _records[-1][2] += _length
+         else :
+            _records.append([b"L",_offset,_length])
+         _offset += _length
+      _digest = hash_file(target,HASH_ALGORITHMS[algorithm][0])
+      _literal = 0
+      _dir = os.path.dirname(filename)
+      if _dir and not os.path.isdir(_dir) :
+         os.makedirs(_dir)
+      with open(target,"rb") as _input, open(filename + ".tmp","wb") as _output :
+         _output.write(DeltaWriter.MAGIC)
+         _output.write(b"#base\t%s\n#size\t%d\n#algorithm\t%s\n#digest\t%s\n#end\n" % (
+            escape_path(base),_offset,algorithm.encode("ascii"),_digest.encode("ascii")))
+         for _kind,_offset,_length in _records :
+            if _kind == b"C" :
+               _output.write(b"C" + struct.pack("<QQ",_offset,_length))
+            else :
+               _input.seek(_offset)
+               _output.write(b"L" + struct.pack("<Q",_length) + _input.read(_length))
+               _literal += _length
+      os.replace(filename + ".tmp",filename)
+      return _literal
+
+
+def apply_delta(delta,output) :
+   """Rebuild the file described by the delta into output, verifying its digest"""
+   with open(delta,"rb") as _input :
+      if _input.readline() != DeltaWriter.MAGIC :
+         error("{0} is not a delta file".format(delta),True)
+      _header = {}
+      for _line in iter(_input.readline,b"#end\n") :
+         if not _line.startswith(b"#") :
+            error("Truncated delta header in {0}".format(delta),True)
+         _name,_,_value = _line[1:-1].partition(b"\t")
+         _header[_name] = _value
+      _base = unescape_path(_header[b"base"])
+      _algorithm = _header[b"algorithm"].decode("ascii")
+      _hasher = HASH_ALGORITHMS[_algorithm][0]()
+      _tmpname = output + ".tmp"
+      with open(_base,"rb") as _base_file, open(_tmpname,"wb") as _output :
+         while True :
+            _kind = _input.read(1)
+            if not _kind : break
+            if _kind == b"C" :
+               _offset,_length = struct.unpack("<QQ",_input.read(16))
+               _base_file.seek(_offset)
+               _data = _base_file.read(_length)
+            else :
+               _length, = struct.unpack("<Q",_input.read(8))
+               _data = _input.read(_length)
+            if len(_data) != _length :
+               os.remove(_tmpname)
+               error("Delta {0} does not match base file {1}".format(delta,_base),True)
+            _hasher.update(_data)
+            _output.write(_data)
+   if _hasher.hexdigest() != _header[b"digest"].decode("ascii") :
+      os.remove(_tmpname)
+      error("Digest mismatch rebuilding {0} from {1} (was the base file modified?)".format(output,delta),True)
+   os.replace(_tmpname,output)
+
+
+class Inotify :
+   """Minimal inotify(7) binding through ctypes"""
+   IN_ATTRIB = 0x00000004
+   IN_CLOSE_WRITE = 0x00000008
+   IN_MOVED_FROM = 0x00000040
+   IN_MOVED_TO = 0x00000080
+   IN_CREATE = 0x00000100
+   IN_DELETE = 0x00000200
+   IN_DELETE_SELF = 0x00000400
+   IN_MOVE_SELF = 0x00000800
+   IN_Q_OVERFLOW = 0x00004000
+   IN_IGNORED = 0x00008000
+   IN_ONLYDIR = 0x01000000
+   IN_DONT_FOLLOW = 0x02000000
+   IN_ISDIR = 0x40000000
+   IN_NONBLOCK = os.O_NONBLOCK
+   IN_CLOEXEC = os.O_CLOEXEC
+   EVENT = struct.Struct("iIII")  # wd, mask, cookie, length of name (which follows, NUL-padded)
+
+   def __init__(self) :
+      self._libc = ctypes.CDLL(None,use_errno=True)
+      self.fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+      if self.fd < 0 :
+         _errno = ctypes.get_errno()
+         raise OSError(_errno,os.strerror(_errno))
+
+   def add_watch(self,path,mask) :
+      _wd = self._libc.inotify_add_watch(self.fd,os.fsencode(path),mask)
+      if _wd < 0 :
+         _errno = ctypes.get_errno()
+         raise OSError(_errno,os.strerror(_errno),path)
+      return _wd
+
+   def rm_watch(self,wd) :
+      self._libc.inotify_rm_watch(self.fd,wd)  # fails harmlessly if the kernel removed the watch already
+
+   def read(self,timeout) :
+      """List of (wd,mask,cookie,name) events; empty if none arrived within timeout seconds"""
+      if not select.select([self.fd],[],[],timeout)[0] :
+         return []
+      try :
+         _data = os.read(self.fd,1048576)
+      except BlockingIOError :
+         return []
+      _events = []
+      _offset = 0
+      while _offset < len(_data) :
+         _wd,_mask,_cookie,_length = self.EVENT.unpack_from(_data,_offset)
+         _offset += self.EVENT.size
+         _events.append((_wd,_mask,_cookie,os.fsdecode(_data[_offset:_offset + _length].rstrip(b"\0"))))
+         _offset += _length
+      return _events
+
+   def close(self) :
+      os.close(self.fd)
+
+
+class TreeWatcher :
+   """Keeps the digests of a dir tree current by following inotify events, and the tree's manifest with them
+
+   Events only mark paths dirty; a burst of events is closed by COALESCE_DELAY seconds without events
+   (or MAX_BATCH_DELAY after its first event) and handed as one batch to a background thread, which
+   rehashes changed files (new and moved directories are walked), drops deleted ones and rewrites the
+   manifest (at most every write_interval seconds). If the kernel event queue overflows, events were
+   lost, so the whole tree is rescanned - with only files whose size, mtime or inode changed rehashed."""
+   EVENTS = (Inotify.IN_CLOSE_WRITE | Inotify.IN_ATTRIB | Inotify.IN_CREATE | Inotify.IN_DELETE | Inotify.IN_MOVED_FROM |
+             Inotify.IN_MOVED_TO | Inotify.IN_DELETE_SELF | Inotify.IN_MOVE_SELF | Inotify.IN_ONLYDIR | Inotify.IN_DONT_FOLLOW)
+   COALESCE_DELAY = 1.0
+   MAX_BATCH_DELAY = 10.0
+
+   def __init__(self,root,manifest,algorithm,cache = None,write_interval = 60.0) :
+      self.root = root
+      self.manifest = manifest
+      self.algorithm = algorithm
+      self.cache = cache
+      self.write_interval = write_interval
+      self._hash_engine = HASH_ALGORITHMS[algorithm][0]
+      self._prefix = os.path.join(root,"")
+      self._included = glob_matcher(options.include)
+      self._excluded = glob_matcher(options.exclude)
+      # same symlink rules as walk_tree: symlinks to files are followed, to directories only with --follow-symlinks
+      self._follow = options.follow_symlinks
+      self._events = self.EVENTS & ~Inotify.IN_DONT_FOLLOW if self._follow else self.EVENTS
+      self._root_dev = os.stat(root).st_dev
+      self._inotify = Inotify()
+      self._watches = {}  # wd -> directory path
+      self._dirs = {}  # directory path -> wd
+      self._lock = threading.Lock()  # guards the two above (events are read in the main thread)
+      self._index = {}  # path -> (digest,FileEntry)
+      self._batches = queue.Queue()
+      self._pool = HashPool(options.jobs,lambda _device: options.jobs_per_device or device_concurrency(_device,options.jobs))
+      self._last_write = 0.0
+      self._unwritten = False
+
+   def _watch(self,dirpath) :
+      try :
+         _wd = self._inotify.add_watch(dirpath,self._events)
+      except OSError as _exc :
+         if _exc.errno == errno.ENOSPC :
+            error("inotify watch limit reached (see /proc/sys/fs/inotify/max_user_watches); changes in {0} will not be noticed".format(dirpath))
+         elif _exc.errno not in (errno.ENOENT,errno.ENOTDIR) :  # gone already
+            error("Cannot watch directory {0} ({1})".format(dirpath,_exc.strerror))
+         return
+      with self._lock :
+         self._watches[_wd] = dirpath
+         self._dirs[dirpath] = _wd
+
+   def _walk(self,dirpath) :
+      """Watch all directories of the subtree and yield FileEntry for its files (watches are set before
+      listing a directory, so files created meanwhile are not missed)"""
+      _stack = [dirpath]
+      _visited = set()
+      while _stack :
+         _dir = _stack.pop()
+         if self._follow :
+            try :
+               _stat = os.stat(_dir)
+            except OSError :
+               continue
+            if (_stat.st_dev,_stat.st_ino) in _visited : continue
+            _visited.add((_stat.st_dev,_stat.st_ino))
+         self._watch(_dir)
+         try :
+            _listing = os.scandir(_dir)
+         except OSError :
+            continue
+         with _listing :
+            for _dir_entry in _listing :
+               _relpath = _dir_entry.path[len(self._prefix):]
+               if self._excluded and self._excluded(_dir_entry.name,_relpath) :
+                  continue
+               try :
+                  if _dir_entry.is_dir(follow_symlinks=self._follow) :
+                     if options.one_file_system and _dir_entry.stat(follow_symlinks=self._follow).st_dev != self._root_dev :
+                        continue
+                     _stack.append(_dir_entry.path)
+                  elif _dir_entry.is_file() :
+                     _entry = self._entry(_dir_entry.path,_dir_entry.stat())
+                     if _entry : yield _entry
+               except OSError :
+                  continue
+
+   def _stat(self,path) :
+      """stat of path under the symlink rules of walk_tree; None if gone or a symlink to a directory not followed"""
+      try :
+         _stat = os.stat(path)
+      except OSError :
+         return None
+      if stat.S_ISDIR(_stat.st_mode) and not self._follow and os.path.islink(path) :
+         return None
+      return _stat
+
+   def _entry(self,path,stat_result) :
+      """FileEntry for a regular, readable, included file; None otherwise"""
+      _relpath = path[len(self._prefix):]
+      if self._included and not self._included(os.path.basename(path),_relpath) :
+         return None
+      if not stat.S_ISREG(stat_result.st_mode) or not is_readable(stat_result) :
+         return None
+      if options.one_file_system and stat_result.st_dev != self._root_dev :
+         return None
+      return FileEntry(path,stat_result.st_size,stat_result.st_dev,stat_result.st_ino,stat_result.st_mtime_ns)
+
+   def _drop_subtree(self,dirpath) :
+      _prefix = os.path.join(dirpath,"")
+      with self._lock :
+         for _dir in [_dir for _dir in self._dirs if _dir == dirpath or _dir.startswith(_prefix)] :
+            _wd = self._dirs.pop(_dir)
+            self._watches.pop(_wd,None)
+            self._inotify.rm_watch(_wd)
+      for _path in [_path for _path in self._index if _path.startswith(_prefix)] :
+         del self._index[_path]
+
+   def _hash(self,entries) :
+      """Digest entries (using the cache) and put them into the index; returns the number of files hashed"""
+      _pending = collections.deque()
+      _hashed = 0
+      def _tasks() :
+         for _entry in entries :
+            _pending.append(_entry)
+            _digest = self.cache.lookup(_entry,self.algorithm) if self.cache else None
+            if _digest is not None :
+               yield _entry.dev,None,_digest
+            else :
+               yield _entry.dev,hash_file,(_entry.path,self._hash_engine)
+      for _digest in self._pool.run(_tasks()) :
+         _entry = _pending.popleft()
+         if _digest is None : continue  # vanished or unreadable; a later event tells what happened
+         if self.cache : self.cache.store(_entry,self.algorithm,_digest)
+         self._index[_entry.path] = (_digest,_entry)
+         _hashed += 1
+      return _hashed
+
+   def _changed(self,entry) :
+      _known = self._index.get(entry.path)
+      return _known is None or (_known[1].size,_known[1].mtime,_known[1].ino) != (entry.size,entry.mtime,entry.ino)
+
+   def _process(self,dirty) :
+      """Bring the index up to date for dirty paths (None: rescan all)"""
+      if dirty is None :
+         _seen = set()
+         _changed = []
+         for _entry in self._walk(self.root) :
+            _seen.add(_entry.path)
+            if self._changed(_entry) : _changed.append(_entry)
+         _removed = [_path for _path in self._index if _path not in _seen]
+         for _path in _removed :
+            del self._index[_path]
+         with self._lock :
+            _gone = [_dir for _dir in self._dirs if not os.path.isdir(_dir)]
+         for _dir in _gone :
+            self._drop_subtree(_dir)
+         return self._hash(_changed),len(_removed)
+      _changed = []
+      _removed = 0
+      _new_dirs = []
+      # removals first: a directory moved within the tree keeps its watch descriptor, which must be
+      # released for the old path before the new path is watched
+      for _path in sorted(dirty) :
+         _stat = self._stat(_path)
+         if _stat is not None and stat.S_ISDIR(_stat.st_mode) :
+            if _path not in self._dirs :  # created or moved in
+               _new_dirs.append(_path)
+            continue
+         if _path in self._dirs :  # directory deleted or moved away
+            _count = len(self._index)
+            self._drop_subtree(_path)
+            _removed += _count - len(self._index)
+         _entry = self._entry(_path,_stat) if _stat is not None else None
+         if _entry is None :
+            if self._index.pop(_path,None) : _removed += 1
+         elif self._changed(_entry) :
+            _changed.append(_entry)
+      for _path in _new_dirs :
+         _changed.extend(_entry for _entry in self._walk(_path) if self._changed(_entry))
+      return self._hash(_changed),_removed
+
+   def _write_manifest(self) :
+      with ManifestWriter(self.manifest,self.root,self.algorithm) as _writer :
+         for _digest,_entry in self._index.values() :
+            _writer.add(_digest,_entry)
+      if self.cache : self.cache.commit()
+      self._last_write = time.monotonic()
+      self._unwritten = False
+
+   def _worker(self) :
+      while True :
+         try :
+            _dirty = self._batches.get(timeout=self.write_interval)
+         except queue.Empty :
+            _dirty = ()
+         if _dirty is StopIteration : break
+         if _dirty != () :
+            _started = time.perf_counter()
+            _hashed,_removed = self._process(_dirty)
+            if _hashed or _removed :
+               self._unwritten = True
+            print("[{0:s}] {1:s}: {2:d} files (re)hashed, {3:d} removed; {4:d} files indexed ({5:.1f} s)".format(
+               time.strftime("%Y-%m-%d %H:%M:%S"),"rescan" if _dirty is None else "{0:d} paths changed".format(len(_dirty)),
+               _hashed,_removed,len(self._index),time.perf_counter() - _started),flush=True)
+         if self._unwritten and time.monotonic() - self._last_write >= self.write_interval :
+            self._write_manifest()
+      if self._unwritten :
+         self._write_manifest()
+
+   def run(self) :
+      """Index the tree, then follow changes until interrupted (SIGINT, SIGTERM)"""
+      self._hash(self._walk(self.root))
+      self._write_manifest()
+      print("[{0:s}] watching {1:s}: {2:d} files indexed in {3:s}".format(
+         time.strftime("%Y-%m-%d %H:%M:%S"),self.root,len(self._index),self.manifest),flush=True)
+      _worker = threading.Thread(target=self._worker)
+      _worker.start()
+      _dirty = set()
+      _first = None
+      try :
+         while True :
+            _events = self._inotify.read(self.COALESCE_DELAY if _dirty else None)
+            _now = time.monotonic()
+            for _wd,_mask,_cookie,_name in _events :
+               if _mask & Inotify.IN_Q_OVERFLOW :
+                  debug_msg("watch: inotify queue overflow, rescanning")
+                  _dirty = None
+                  break
+               with self._lock :
+                  _dir = self._watches.get(_wd)
+                  if _mask & Inotify.IN_IGNORED and _dir is not None :
+                     del self._watches[_wd]
+                     if self._dirs.get(_dir) == _wd : del self._dirs[_dir]
+               if _dir is None or _mask & Inotify.IN_IGNORED : continue
+               _path = os.path.join(_dir,_name) if _name else _dir
+               if _path != self.root : _dirty.add(_path)
+            if _dirty is None :
+               self._batches.put(None)
+               _dirty = set()
+               _first = None
+               continue
+            if _events and _dirty and _first is None :
+               _first = _now
+            if _dirty and (not _events or _now - _first >= self.MAX_BATCH_DELAY) :
+               self._batches.put(_dirty)
+               _dirty = set()
+               _first = None
+      finally :
+         if _dirty : self._batches.put(_dirty)
+         self._batches.put(StopIteration)
+         _worker.join()
+         self._pool.close()
+         self._inotify.close()
+
+
+def report_similar_files(new_files,candidate_dir,repository,metrics) :
+   """Report new files that share content-defined chunks with repository files; write deltas if requested
+
+   Only repository files between half and twice the size of some new file are chunked (one file per
+   group of identical files), and new files of at most CHUNK_MIN bytes (a single chunk) are skipped."""
+   _algorithm = options.hash
+   _cache = HashCache(options.cache,options.rebuild_cache) if options.cache else None
+   try :
+      _index = ChunkIndex(_algorithm,_cache)
+      _new_files = sorted((_entry for _entry in new_files if entry_size(_entry) > CHUNK_MIN),key=lambda _entry: _entry.path)
+      _sizes = sorted(entry_size(_entry) for _entry in _new_files)
+      with metrics.phase("chunk") :
+         if _sizes :
+            for _key,_files in repository.groups() :
+               _size = entry_size(_files[0])
+               _lowest = bisect.bisect_left(_sizes,_size // 2)
+               if _lowest < len(_sizes) and _sizes[_lowest] <= 2 * _size :
+                  _index.add(_files[0])
+         _similar = []
+         for _entry in _new_files :
+            _chunks = _index.chunks(_entry)
+            if not _chunks : continue
+            _best,_shared,_found = _index.similarity(_chunks)
+            if _best is not None :
+               _similar.append((_entry,_chunks,_index.files[_best],_shared,_found))
+      with metrics.phase("report") :
+         print("\n***** Files partially present in repository (shared content-defined chunks, by size): *****")
+         _total = _literal = 0
+         for _entry,_chunks,_base,_shared,_found in _similar :
+            _size = sum(_length for _,_length in _chunks)
+            print("{0:s} : {1:d}% of chunks shared with {2:s} ({3:d}% found in repository)".format(
+               _entry.path,_shared * 100 // _size,_base.path,_found * 100 // _size))
+            if options.delta :
+               _base_offsets = {}
+               _offset = 0
+               for _digest,_length in _index.chunks(_base) :
+                  _base_offsets.setdefault(_digest,_offset)
+                  _offset += _length
+               _delta = os.path.join(options.delta,relative_path(_entry.path,candidate_dir.root) + ".delta")
+               _total += _size
+               _literal += DeltaWriter.write(_delta,_entry.path,_chunks,_base.path,_base_offsets,_algorithm)
+         if options.delta :
+            print("deltas written to {0:s}: {1:d} of {2:d} bytes to transfer".format(options.delta,_literal,_total))
+      debug_msg("chunking: {0:d} bytes read, {1:d} repository files indexed",_index.bytes_chunked,len(_index.files))
+   finally :
+      if _cache : _cache.close()
+
+
+def report_replicas(labels,trees) :
+   """Report on which trees (dirs or hashfiles) each content exists, and which files exist on a single tree only
+
+   All trees are merged in a single pass over their sorted digest streams."""
+   _replica_hist = collections.Counter()  # number of trees -> number of distinct contents
+   _replica_bytes = collections.Counter()
+   _tree_files = [0] * len(trees)
+   _tree_bytes = [0] * len(trees)
+   _only_files = [0] * len(trees)
+   _only_bytes = [0] * len(trees)
+   _single = []  # (tree index, path)
+   if options.format_dup == "csv" :
+      print("\"digest\",\"size\",\"trees\",\"copies\",{0:s}".format(",".join("\"{0:s}\"".format(_label) for _label in labels)))
+   for _key,_files in merge_groups([_tree.groups() for _tree in trees]) :
+      _holders = [_idx for _idx,_group in enumerate(_files) if _group]
+      _size = next(_group[0].size for _group in _files if _group)
+      _size = _size if _size is not None else 0
+      _replica_hist[len(_holders)] += 1
+      _replica_bytes[len(_holders)] += _size
+      for _idx in _holders :
+         _tree_files[_idx] += len(_files[_idx])
+         _tree_bytes[_idx] += _size * len(_files[_idx])
+      if len(_holders) == 1 :
+         _only_files[_holders[0]] += len(_files[_holders[0]])
+         _only_bytes[_holders[0]] += _size * len(_files[_holders[0]])
+         _single.extend((_holders[0],_entry.path) for _entry in _files[_holders[0]])
+      if options.format_dup == "csv" :
+         print("\"{0:s}\",{1:d},{2:d},{3:d},{4:s}".format(_key,_size,len(_holders),sum(len(_group) for _group in _files),
+                                                        ",".join(str(len(_group)) for _group in _files)))
+   if options.format_dup == "csv" :
+      return
+
+   print("\n*** replicas: distinct contents by number of trees holding them ***")
+   for _count in sorted(_replica_hist) :
+      print("{0:3d} tree(s) : {1:10d} contents, {2:15d} bytes".format(_count,_replica_hist[_count],_replica_bytes[_count]))
+   print("\n*** trees ***")
+   for _idx,_label in enumerate(labels) :
+      print("{0:s} : {1:d} files, {2:d} bytes; only on this tree: {3:d} files, {4:d} bytes".format(
+         _label,_tree_files[_idx],_tree_bytes[_idx],_only_files[_idx],_only_bytes[_idx]))
+   print("\n***** Files existing on a single tree only: *****")
+   for _idx,_path in sorted(_single) :
+      print("[{0:s}] {1:s}".format(labels[_idx],_path))
+
+
+def report_metrics(metrics,hash_stats,cache) :
+   """Output for --stats and --metrics-json"""
+   if options.stats :
+      if hash_stats : hash_stats.report()
+      if cache : cache.report()
+      metrics.report()
+   if options.metrics_json :
+      _metrics = metrics.as_dict()
+      _metrics.update({
+         "mode": mode.name, "algorithm": options.hash, "jobs": options.jobs,
+         "hash_stages": vars(hash_stats) if hash_stats else None,
+         "cache": {"hits": cache.hits, "misses": cache.misses} if cache else None,
+      })
+      with open(options.metrics_json,"w") as _output :
+         json.dump(_metrics,_output,indent=1)
+
+
 class Mode(enum.Enum) :
    """Modes of operation"""
    unknown = False
@@ -190,95 +2130,184 @@ class Mode(enum.Enum) :
    find_duplicates = "identify duplicates in dir"
    find_new_files = "find files in candidate dir absent in repository"
    deduplicate = "suggest which files in repository to keep (de-duplicate)"
+   merge_hashes = "merge hashfiles"
+   replicas = "find replicas of files across several trees"
+   watch = "keep hashes of a changing dir tree current"
 
 ###############################################
 #
 # the program starts here
 #
 ###############################################
-options = parse_args()
-
-mode = Mode.unknown
-#options = _result
-if options.hash_store:
-   mode = Mode.compute_hashes
-if options.identify:
-   if options.dirtree_count == 1:
-      mode = Mode.find_duplicates
-   elif options.dirtree_count == 2:
-      mode = Mode.find_new_files
-   else:
-      error("Internal argument parsing error", True)
-if options.suggest and options.dirtree_count == 2:
-   mode = Mode.deduplicate
-if not mode:
-   error("Incorrect syntax!", True)
-print("[AWSdebug] mode : '{}'".format(mode.value))
-
-# get hashes for candidate directory
-if options.dir_hashes:
-   _hashes_candidate_dir = read_hashes(options.dir_hashes)
-else:
-   _hashes_candidate_dir = get_hashes(options.dir)
-   if mode == Mode.compute_hashes:
-      with open(options.hash_store, 'wb') as output_file:
-         pickle.dump(options.dir, output_file)
-         pickle.dump(_hashes_candidate_dir, output_file)
+if __name__ == "__main__" :
+   options = parse_args()
+
+   mode = Mode.unknown
+   #options = _result
+   if options.benchmark_hashes is not None :
+      benchmark_hashes(options.benchmark_hashes)
+      exit(0)
+   if options.apply_delta :
+      apply_delta(*options.apply_delta)
+      exit(0)
+
+   if options.replicas :
+      mode = Mode.replicas
+   if options.hash_store:
+      mode = Mode.merge_hashes if options.merge_hashes else Mode.watch if options.watch else Mode.compute_hashes
+   if options.identify:
+      if options.dirtree_count == 1:
+         mode = Mode.find_duplicates
+      elif options.dirtree_count == 2:
+         mode = Mode.find_new_files
+      else:
+         error("Internal argument parsing error", True)
+   if options.suggest and options.dirtree_count == 2:
+      mode = Mode.deduplicate
+   if not mode:
+      error("Incorrect syntax!", True)
+   print("[AWSdebug] mode : '{}'".format(mode.value))
+
+   if mode == Mode.merge_hashes :
+      merge_manifests(options.hash_store,options.merge_hashes)
+      exit(0)
+
+   if mode == Mode.watch :
+      _hash_cache = HashCache(options.cache,options.rebuild_cache) if options.cache else None
+      signal.signal(signal.SIGTERM,lambda _signum,_frame: sys.exit(0))
+      try :
+         TreeWatcher(os.path.abspath(options.dir),options.hash_store,options.hash,_hash_cache,options.watch_interval).run()
+      except KeyboardInterrupt :
+         pass
+      finally :
+         if _hash_cache : _hash_cache.close()
+      exit(0)
+
+   # get hashes for candidate directory and repository, if applicable
+   # (trees that are walked are hashed together, so that files with unique size need not be read at all)
+   # (roots are walked as given, so files are reported by paths in the form the user typed)
+   _algorithm = options.hash
+   _dirtrees = []
+   if mode == Mode.replicas :
+      _dirtrees = [_tree for _tree in options.replicas if os.path.isdir(_tree)]
+      _staged = len(_dirtrees) == len(options.replicas)
+   else :
+      if not options.dir_hashes :
+         _dirtrees.append(options.dir)
+      if options.dirtree_count == 2 and not options.repo_hashes :
+         _dirtrees.append(options.repository)
+      _staged = mode != Mode.compute_hashes and not (options.dir_hashes or options.repo_hashes)
+   _hash_cache = HashCache(options.cache,options.rebuild_cache) if options.cache and _dirtrees else None
+   _metrics = Metrics(options.progress)
+   try :
+      if mode == Mode.compute_hashes :
+         # stream digests straight into the manifest
+         with ManifestWriter(options.hash_store,_dirtrees[0],_algorithm) as _writer :
+            _,_hash_stats = get_hashes(_dirtrees,False,_hash_cache,
+                                       lambda _tree_idx,_digest,_entry: _writer.add(_digest,_entry),_metrics)
+         _walked_hashes = []
+      else :
+         _walked_hashes,_hash_stats = get_hashes(_dirtrees,_staged,_hash_cache,None,_metrics) if _dirtrees else ([],None)
+   finally :
+      if _hash_cache : _hash_cache.close()
+   if mode == Mode.compute_hashes :
+      report_metrics(_metrics,_hash_stats,_hash_cache)
       exit(0)  # computing hashes precludes any other actions
 
-# get hashes for repository, if applicable
-if options.dirtree_count == 2 :
-   if options.repo_hashes:
-      _hashes_repository = read_hashes(options.repo_hashes)
-   else:
-      _hashes_repository = get_hashes(options.repository)
-
-##################################
-#  main program decision ladder
-if mode == Mode.find_duplicates :
-   # detect duplicates within dirtree
-   _candidate_dir_dups,_hash_collisions = detect_duplicates(_hashes_candidate_dir)
-   report_duplicates(_candidate_dir_dups,_hash_collisions)
-
-elif mode == Mode.find_new_files :
-   # identify files occurring only in candidate dir and absent from repository
-   # (thus candidates for adding to repository)
-   _uniq = []
-   for _hash in sorted(_hashes_candidate_dir.keys()):
-      # noinspection PyUnboundLocalVariable
-      if _hash not in _hashes_repository:
-         _uniq.extend(_hashes_candidate_dir[_hash])
-   print("\n***** Files existing only in candidate directory: *****")
-   for _f in sorted(_uniq): print(_f)
-
-elif mode == Mode.deduplicate :
-   # suggest which copy in repository to keep
-   _cnt_decided = _cnt_undecided = 0
-   _repository_dups,_hash_collisions = detect_duplicates(_hashes_candidate_dir)
-   #report_duplicates(_repository_dups,_hash_collisions)
-   for _hash,_size,_dups in _repository_dups :
-      # first look up the file in reference dir
-      if _hash in _hashes_candidate_dir :
-         _decided = False
-         _chosen = []
-         _candidate_dir_locations = []
-         for _candidate_dir_file in _hashes_candidate_dir[_hash] :
-            _candidate_dir_locations.append(os.path.relpath(_candidate_dir_file,options.dir))
-         for _dup in _dups :
-            if os.path.relpath(_dup,options.repository) in _candidate_dir_locations :
-               _decided = True
-               _cnt_decided += 1
-               _chosen.append(_dup)
-         print("--- Duplicates : ---")
-         print("REF: {0}".format(_hashes_candidate_dir[_hash][0]))
-         for _dup in _dups :
-            print("{0} : {1}".format(_dup,"hgw" if not _decided else "keep" if _dup in _chosen else "delete"))
-            if options.delete :
-               if _decided and _dup not in _chosen :
-                  os.remove(_dup)
-                  #print "os.remove({0})".format(_dup)
-         if not _decided :
-            _cnt_undecided += 1
-
-print("\ncandidate dir : {0}\nrepository    : {1}".format(options.dir,options.repository))
-#print "duplicates decided: {0:d}  undecided: {1:d}".format(_cnt_decided,_cnt_undecided)
+   def _tree_index(hashfile) :
+      if hashfile :
+         _index = load_hashes(hashfile)
+         if _index.algorithm and _index.algorithm != _algorithm :
+            error("Hashfile {0} uses hash algorithm {1}, not {2}".format(hashfile,_index.algorithm,_algorithm),True)
+         return _index
+      _root,_index = _walked_trees.pop(0)
+      return _index
+
+   _walked_trees = list(zip(_dirtrees,_walked_hashes))
+
+   if mode == Mode.replicas :
+      _trees = [_tree_index(None if os.path.isdir(_tree) else _tree) for _tree in options.replicas]
+      with _metrics.phase("compare") :
+         report_replicas(options.replicas,_trees)
+      report_metrics(_metrics,_hash_stats,_hash_cache)
+      exit(0)
+
+   _candidate_dir = _tree_index(options.dir_hashes)
+   if options.dirtree_count == 2 :
+      _repository = _tree_index(options.repo_hashes)
+
+   ##################################
+   #  main program decision ladder
+   if mode == Mode.find_duplicates :
+      # detect duplicates within dirtree
+      with _metrics.phase("compare") :
+         _candidate_dir_dups,_hash_collisions = detect_duplicates(_candidate_dir.groups())
+      with _metrics.phase("report") :
+         report_duplicates(_candidate_dir_dups,_hash_collisions)
+      if options.link_mode :
+         _linker = DuplicateLinker(options.link_mode)
+         for _,_,_dups in _candidate_dir_dups :
+            for _dup in _dups[1:] :
+               _linker.add(_dups[0].path,_dup.path)
+         _linker.report()
+
+   elif mode == Mode.find_new_files :
+      # identify files occurring only in candidate dir and absent from repository
+      # (thus candidates for adding to repository)
+      _uniq = []
+      with _metrics.phase("compare") :
+         # noinspection PyUnboundLocalVariable
+         for _hash,_candidate_files,_repository_files in join_groups(_candidate_dir.groups(),_repository.groups()):
+            if not _repository_files:
+               _uniq.extend((_hash,_entry) for _entry in _candidate_files)
+      with _metrics.phase("report") :
+         print("\n***** Files existing only in candidate directory: *****")
+         for _f in sorted(_entry.path for _,_entry in _uniq): print(_f)
+      if options.chunks :
+         report_similar_files([_entry for _,_entry in _uniq],_candidate_dir,_repository,_metrics)
+      if options.sync :
+         if not os.path.isdir(_repository.root) :
+            error("Repository {0} is not accessible; cannot sync".format(_repository.root),True)
+         _sync = RepositorySync(_candidate_dir.root,_repository.root,_algorithm,options.jobs,options.sync_journal)
+         with _metrics.phase("sync") :
+            _sync.run(_uniq)
+         _sync.report()
+
+   elif mode == Mode.deduplicate :
+      # suggest which copy in repository to keep
+      _cnt_decided = _cnt_undecided = 0
+      _linker = DuplicateLinker(options.link_mode) if options.link_mode else None
+      _metrics.start("compare")  # suggestions are reported as they are found, so this includes reporting
+      for _hash,_candidate_files,_repository_files in join_groups(_candidate_dir.groups(),_repository.groups()) :
+         # first look up the file in reference dir
+         if not _candidate_files : continue
+         _repository_dups,_hash_collisions = detect_duplicates([(_hash,_repository_files)])
+         if not _repository_dups : continue
+         _candidate_dir_locations = {relative_path(_candidate_dir_file.path,_candidate_dir.root)
+                                     for _candidate_dir_file in _candidate_files}
+         for _hash,_size,_dups in _repository_dups :
+            _decided = False
+            _chosen = set()
+            for _dup in _dups :
+               if relative_path(_dup.path,_repository.root) in _candidate_dir_locations :
+                  _decided = True
+                  _cnt_decided += 1
+                  _chosen.add(_dup.path)
+            print("--- Duplicates : ---")
+            print("REF: {0}".format(_candidate_files[0].path))
+            for _dup in _dups :
+               print("{0} : {1}".format(_dup.path,"hgw" if not _decided else "keep" if _dup.path in _chosen else "delete"))
+               if options.delete :
+                  if _decided and _dup.path not in _chosen :
+                     os.remove(_dup.path)
+                     #print "os.remove({0})".format(_dup)
+               if _linker and _decided and _dup.path not in _chosen :
+                  _linker.add(min(_chosen),_dup.path)
+            if not _decided :
+               _cnt_undecided += 1
+      _metrics.stop("compare")
+      if _linker : _linker.report()
+
+   print("\ncandidate dir : {0}\nrepository    : {1}".format(_candidate_dir.root,_repository.root if options.dirtree_count == 2 else None))
+   report_metrics(_metrics,_hash_stats,_hash_cache)
+   #print "duplicates decided: {0:d}  undecided: {1:d}".format(_cnt_decided,_cnt_undecided)
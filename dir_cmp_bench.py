@@ -0,0 +1,302 @@
+#!/usr/bin/python
+# vim: set ts=3 sw=3 tw=0 et :
+#
+# Benchmark harness for dir_cmp.py: generates synthetic dir trees and measures each mode of operation
+#
+
+import argparse
+import datetime
+import json
+import math
+import os, os.path, sys
+import random
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+
+
+DIR_CMP = os.path.join(os.path.dirname(os.path.abspath(__file__)),"dir_cmp.py")
+MODES = ["identify","new-files","suggest","store-hashes"]
+BLOCK = 65536  # dir_cmp.py head/tail block; "tricky" files must differ from each other beyond it
+
+
+def parse_args() :
+   # parse arguments
+   usage_text = (
+      "Generates synthetic directory trees and measures dir_cmp.py on them (files/s, MB/s, peak RSS,\n"
+      "optionally syscall counts), appending the results to a JSON file.")
+   epilog_text= (
+      "Typical usage cases:\n"
+      "  %(prog)s --files 20000 --results bench.json\n"
+      "                        : Benchmark all modes on a generated tree of 20000 files\n"
+      "  %(prog)s --files 5000 --dup-ratio 0.5 --modes identify --label blake2b -- --hash blake2b -j 4\n"
+      "                        : Benchmark one mode, passing extra arguments to dir_cmp.py\n"
+      "  %(prog)s --generate-only /tmp/tree --files 1000\n"
+      "                        : Just generate a tree (candidate dir in /tmp/tree/dir, repository in /tmp/tree/repo)\n"
+      "Size distribution: 'lognormal:MEDIAN:SIGMA' (bytes; default lognormal:16384:2) or 'uniform:MIN:MAX'.")
+   parser = argparse.ArgumentParser(description=usage_text,epilog=epilog_text,formatter_class=argparse.RawDescriptionHelpFormatter)
+   parser.add_argument("dir_cmp_args", metavar="DIR_CMP_ARG", nargs="*", help="extra arguments for dir_cmp.py (after --)")
+   tree = parser.add_argument_group("generated tree")
+   tree.add_argument("--files", action="store", type=int, dest="files", default=10000, help="number of files in the repository tree (default: 10000)")
+   tree.add_argument("--size-dist", action="store", dest="size_dist", default="lognormal:16384:2", help="file size distribution")
+   tree.add_argument("--max-size", action="store", type=int, dest="max_size", default=64*1024*1024, help="upper limit of file size (default: 64 MiB)")
+   tree.add_argument("--depth", action="store", type=int, dest="depth", default=3, help="directory depth (default: 3)")
+   tree.add_argument("--fanout", action="store", type=int, dest="fanout", default=8, help="subdirectories per directory (default: 8)")
+   tree.add_argument("--dup-ratio", action="store", type=float, dest="dup_ratio", default=0.2, help="fraction of files that duplicate another file (default: 0.2)")
+   tree.add_argument("--group-size", action="store", type=int, dest="group_size", default=3, help="max. number of copies in a duplicate group (default: 3)")
+   tree.add_argument("--tricky-ratio", action="store", type=float, dest="tricky_ratio", default=0.1, help="fraction of files with the same size as another file, but different contents - half of them also with identical head & tail (default: 0.1)")
+   tree.add_argument("--new-ratio", action="store", type=float, dest="new_ratio", default=0.1, help="fraction of candidate dir files absent from the repository (default: 0.1)")
+   tree.add_argument("--candidate-ratio", action="store", type=float, dest="candidate_ratio", default=0.3, help="size of the candidate dir relative to the repository (default: 0.3)")
+   tree.add_argument("--seed", action="store", type=int, dest="seed", default=1, help="random seed (default: 1)")
+   parser.add_argument("--workdir", action="store", dest="workdir", help="where to generate trees, in a new subdirectory that is kept (default: temporary directory, removed afterwards)")
+   parser.add_argument("--generate-only", action="store", dest="generate_only", metavar="DIR", help="only generate the trees in DIR (new or empty)")
+   parser.add_argument("--modes", action="store", nargs="+", dest="modes", choices=MODES, default=MODES, help="modes to benchmark (default: all)")
+   parser.add_argument("--repeat", action="store", type=int, dest="repeat", default=1, help="runs per mode; the fastest is reported (default: 1)")
+   parser.add_argument("--drop-caches", action="store_true", dest="drop_caches", help="drop the page cache before each run (requires root)")
+   parser.add_argument("--strace", action="store_true", dest="strace", help="count syscalls with strace (slows runs down; times are then reported from separate runs)")
+   parser.add_argument("--results", action="store", dest="results", default="dir_cmp_bench.json", help="JSON file the results are appended to (default: dir_cmp_bench.json)")
+   parser.add_argument("--label", action="store", dest="label", help="label of this run (default: git revision of dir_cmp.py)")
+   parser.add_argument("--debug", action="store_true", dest="debug", help="Print lots of debugging information")
+   _result = parser.parse_args()
+
+   # argument logic check
+   try :
+      _result.size_sampler = size_sampler(_result.size_dist,_result.max_size)
+   except ValueError :
+      error("Unrecognized size distribution '{0}'".format(_result.size_dist),True)
+   if _result.strace and not shutil.which("strace") :
+      error("--strace requires strace to be installed",True)
+   if _result.generate_only and os.path.isdir(_result.generate_only) and os.listdir(_result.generate_only) :
+      error("{0} is not empty; trees are only generated into a new or empty directory".format(_result.generate_only),True)
+   if _result.workdir and not os.path.isdir(_result.workdir) :
+      error("Work directory {0} does not exist".format(_result.workdir),True)
+   for _ratio in (_result.dup_ratio,_result.tricky_ratio,_result.new_ratio) :
+      if not 0 <= _ratio <= 1 :
+         error("Ratios must be between 0 and 1",True)
+
+   return _result
+
+
+def error(msg,is_fatal = False) :
+   sys.stderr.write("{0:s} error: {1:s}\n".format("Fatal" if is_fatal else "Non-fatal",msg))
+   if is_fatal : exit (1)
+
+def debug_msg(msg) :
+   if options.debug :
+      sys.stdout.write("[debug] {0:s}\n".format(msg))
+
+
+def size_sampler(spec,max_size) :
+   """Function returning random file sizes according to spec"""
+   _kind,_param1,_param2 = spec.split(":")
+   if _kind == "lognormal" :
+      _mu,_sigma = math.log(float(_param1)),float(_param2)
+      return lambda _rng: min(int(_rng.lognormvariate(_mu,_sigma)),max_size)
+   if _kind == "uniform" :
+      _min,_max = int(_param1),int(_param2)
+      return lambda _rng: min(_rng.randint(_min,_max),max_size)
+   raise ValueError(spec)
+
+
+def generate_contents(rng,size) :
+   return rng.getrandbits(size * 8).to_bytes(size,"little") if size else b""
+
+
+def generate_trees(basedir,rng) :
+   """Generate repository tree (basedir/repo) and candidate tree (basedir/dir); returns their total sizes"""
+   _dirs = [""]
+   _level = [""]
+   for _ in range(options.depth) :
+      _level = [os.path.join(_parent,"d{0:d}".format(_idx)) for _parent in _level for _idx in range(options.fanout)]
+      _dirs.extend(_level)
+   _written = {"repo": 0, "dir": 0}
+
+   def _path(tree) :
+      _path = os.path.join(basedir,tree,rng.choice(_dirs),"f{0:d}".format(rng.getrandbits(48)))
+      os.makedirs(os.path.dirname(_path),exist_ok=True)
+      return _path
+
+   def _write(tree,contents) :
+      _filename = _path(tree)
+      with open(_filename,"wb") as _output :
+         _output.write(contents)
+      _written[tree] += len(contents)
+      return _filename
+
+   def _copy(tree,original) :
+      shutil.copyfile(original,_path(tree))
+      _written[tree] += os.path.getsize(original)
+
+   _originals = []  # a sample of repository files, for duplicates and candidate dir
+   _count = 0
+   while _count < options.files :
+      _roll = rng.random()
+      if _originals and _roll < options.dup_ratio :
+         # duplicate group: several identical copies
+         _original = rng.choice(_originals)
+         for _ in range(rng.randint(1,max(options.group_size - 1,1))) :
+            _copy("repo",_original)
+            _count += 1
+         continue
+      _contents = generate_contents(rng,options.size_sampler(rng))
+      _original = _write("repo",_contents)
+      _count += 1
+      if _roll < options.dup_ratio + options.tricky_ratio and len(_contents) > 0 :
+         # same size, different contents; if large enough, half of them differ only in the middle
+         _middle = len(_contents) // 2
+         if len(_contents) > 2 * BLOCK and rng.random() < 0.5 :
+            _write("repo",_contents[:_middle] + bytes([_contents[_middle] ^ 0xff]) + _contents[_middle+1:])
+         else :
+            _write("repo",generate_contents(rng,len(_contents)))
+         _count += 1
+      if len(_originals) < 10000 :
+         _originals.append(_original)
+      elif rng.random() < 0.01 :
+         _originals[rng.randrange(len(_originals))] = _original
+
+   # candidate dir: mostly copies of repository files, some new ones
+   for _ in range(int(options.files * options.candidate_ratio)) :
+      if _originals and rng.random() >= options.new_ratio :
+         _copy("dir",rng.choice(_originals))
+      else :
+         _write("dir",generate_contents(rng,options.size_sampler(rng)))
+   return _written
+
+
+def dir_cmp_command(mode,basedir) :
+   _repo = os.path.join(basedir,"repo")
+   _dir = os.path.join(basedir,"dir")
+   _args = {
+      "identify": ["--identify-duplicates","--dir",_repo],
+      "new-files": ["--identify-duplicates","--dir",_dir,"--repository",_repo],
+      "suggest": ["--suggest","--dir",_dir,"--repository",_repo],
+      "store-hashes": ["--store-hashes",os.path.join(basedir,"hashes.manifest"),"--dir",_repo],
+   }[mode]
+   return [sys.executable,DIR_CMP] + _args + options.dir_cmp_args
+
+
+def drop_caches() :
+   subprocess.call(["sync"])
+   try :
+      with open("/proc/sys/vm/drop_caches","w") as _control :
+         _control.write("3\n")
+   except OSError as _exc :
+      error("Cannot drop page cache ({0:s})".format(_exc.strerror))
+
+
+# Peak RSS of a process started directly from this one would include this process' own peak RSS (the kernel
+# carries it over on exec), so the command is run from a small intermediate process that reports it.
+RUSAGE_WRAPPER = (
+   "import os,sys\n"
+   "_pid = os.fork()\n"
+   "if _pid == 0 : os.execv(sys.argv[2],sys.argv[2:])\n"
+   "_,_status,_rusage = os.wait4(_pid,0)\n"
+   "with open(sys.argv[1],'w') as _output : _output.write(str(_rusage.ru_maxrss))\n"
+   "sys.exit(os.waitstatus_to_exitcode(_status))\n")
+
+
+def run_measured(command) :
+   """Run command; returns (wall time [s], peak RSS [KiB]) of the process"""
+   with tempfile.NamedTemporaryFile("r",suffix=".rss") as _rss :
+      _start = time.perf_counter()
+      _returncode = subprocess.call([sys.executable,"-c",RUSAGE_WRAPPER,_rss.name] + command,stdout=subprocess.DEVNULL)
+      _elapsed = time.perf_counter() - _start
+      if _returncode != 0 :
+         error("Command failed ({0:d}): {1:s}".format(_returncode," ".join(command)))
+      return _elapsed,int(_rss.read() or 0)
+
+
+def count_syscalls(command) :
+   """Run command under strace; returns {syscall: count} including a 'total' entry"""
+   with tempfile.NamedTemporaryFile("r",suffix=".strace") as _trace :
+      subprocess.call(["strace","-f","-c","-o",_trace.name] + command,stdout=subprocess.DEVNULL)
+      _counts = {}
+      for _line in _trace :
+         # % time  seconds  usecs/call  calls  [errors]  syscall
+         # (the format of the final "total" line differs between strace versions, so the total is summed up here)
+         _fields = _line.split()
+         if len(_fields) >= 5 and re.match(r"^[\d.]+$",_fields[0]) and _fields[-1] != "total" :
+            _counts[_fields[-1]] = int(_fields[3])
+   _counts["total"] = sum(_counts.values())
+   return _counts
+
+
+def git_revision() :
+   try :
+      return subprocess.check_output(["git","describe","--always","--dirty"],cwd=os.path.dirname(DIR_CMP),
+                                     stderr=subprocess.DEVNULL).decode().strip()
+   except (OSError,subprocess.CalledProcessError) :
+      return "unknown"
+
+
+###############################################
+#
+# the program starts here
+#
+###############################################
+if __name__ == "__main__" :
+   options = parse_args()
+   _rng = random.Random(options.seed)
+
+   if options.generate_only :
+      _written = generate_trees(options.generate_only,_rng)
+      print("repository: {0:d} bytes, candidate dir: {1:d} bytes".format(_written["repo"],_written["dir"]))
+      exit(0)
+
+   # always a new directory, so that trees are never generated on top of those of an earlier run
+   _basedir = tempfile.mkdtemp(prefix="dir_cmp_bench-",dir=options.workdir)
+   if options.workdir :
+      print("trees generated in {0}".format(_basedir))
+   try :
+      _start = time.perf_counter()
+      _written = generate_trees(_basedir,_rng)
+      debug_msg("trees generated in {0:.1f} s".format(time.perf_counter() - _start))
+      _files = {_tree: sum(len(_names) for _,_,_names in os.walk(os.path.join(_basedir,_tree))) for _tree in ("repo","dir")}
+
+      _results = {}
+      for _mode in options.modes :
+         _command = dir_cmp_command(_mode,_basedir)
+         debug_msg("running {0:s}".format(" ".join(_command)))
+         _runs = []
+         for _ in range(options.repeat) :
+            if options.drop_caches : drop_caches()
+            _runs.append(run_measured(_command))
+         _elapsed = min(_run[0] for _run in _runs)
+         _trees = ["repo"] if _mode in ("identify","store-hashes") else ["repo","dir"]
+         _mode_files = sum(_files[_tree] for _tree in _trees)
+         _mode_bytes = sum(_written[_tree] for _tree in _trees)
+         _results[_mode] = {
+            "wall_time_s": round(_elapsed,4),
+            "files": _mode_files,
+            "bytes": _mode_bytes,
+            "files_per_s": round(_mode_files / _elapsed,1),
+            "mb_per_s": round(_mode_bytes / _elapsed / 1e6,2),
+            "peak_rss_kib": max(_run[1] for _run in _runs),
+         }
+         if options.strace :
+            if options.drop_caches : drop_caches()
+            _results[_mode]["syscalls"] = count_syscalls(_command)
+         print("{0:<14s} {1:9.3f} s {2:11.1f} files/s {3:9.2f} MB/s {4:9d} KiB peak RSS".format(
+            _mode,_elapsed,_results[_mode]["files_per_s"],_results[_mode]["mb_per_s"],_results[_mode]["peak_rss_kib"]))
+
+      _record = {
+         "label": options.label or git_revision(),
+         "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+         "dir_cmp_args": options.dir_cmp_args,
+         "tree": {_name: getattr(options,_name) for _name in ("files","size_dist","max_size","depth","fanout","dup_ratio",
+                                                               "group_size","tricky_ratio","new_ratio","candidate_ratio","seed")},
+         "results": _results,
+      }
+      # results file is a JSON list of records, one per benchmark run
+      _history = []
+      if os.path.exists(options.results) :
+         with open(options.results) as _input :
+            _history = json.load(_input)
+      _history.append(_record)
+      with open(options.results,"w") as _output :
+         json.dump(_history,_output,indent=1)
+   finally :
+      if not options.workdir :
+         shutil.rmtree(_basedir)
@@ -0,0 +1,411 @@
+#!/usr/bin/python3
+# vim: set ts=3 sw=3 tw=0 et :
+#
+# Spatially indexed archive of runs (GPX files), for finding archived tracks by place, route and date
+#
+# The archive is an SQLite database built incrementally from directories of GPX files: only new or modified
+# files are parsed. Each run is stored with its bounds, date and a simplified track (a numpy blob), and every
+# grid cell its track passes is recorded in an indexed table, so queries read only the runs in the cells
+# concerned and never parse any GPX file.
+#
+import os
+import sys
+import argparse
+import collections
+import concurrent.futures
+import functools
+import math
+import sqlite3
+import numpy
+import gpxstream
+import gpxgeometry
+
+
+DEFAULT_PATH = os.path.join(os.path.expanduser("~"),".cache","gpxarchive","runs.sqlite")
+CELL_SIZE = 0.001  # degrees; grid cells are about 111 m (north-south) by 111 m * cos(latitude)
+LAT_CELLS = int(round(90 / CELL_SIZE))
+LON_CELLS = int(round(180 / CELL_SIZE))
+TOLERANCE = 5.0  # metres by which stored tracks may deviate from the recorded ones
+COMMIT_INTERVAL = 100  # runs stored per transaction
+QUERY_CHUNK = 500  # runs read per query
+
+# start, finish: seconds since epoch (None without time stamps); length: metres; cells: number of grid cells
+Run = collections.namedtuple("Run","id path start finish points length cells")
+
+
+def parse_args() :
+   # parse arguments
+   usage_text = (
+      "Maintains and queries an archive of runs (GPX files), indexed by place, route and date.")
+   epilog_text= (
+      "Typical usage cases:\n"
+      "  %(prog)s --add DIR...\n"
+      "                        : Add new or modified GPX files (*.gpx) from DIRs and their subdirectories, forget\n"
+      "                          runs whose files are gone\n"
+      "  %(prog)s --near LAT,LON [--radius METRES]\n"
+      "                        : List runs passing within METRES (default: 50) of a point\n"
+      "  %(prog)s --bbox LAT1,LON1,LAT2,LON2 [--radius METRES]\n"
+      "                        : List runs passing through a box (extended by METRES)\n"
+      "  %(prog)s --route GPXFILE [--similarity FRACTION]\n"
+      "                        : List runs on the route of GPXFILE (an archived run, or any other GPX file)\n"
+      "  %(prog)s --after DATE --before DATE\n"
+      "                        : List runs started in a period\n"
+      "Queries can be combined (runs matching all are listed), and follow --add if given.\n"
+      "Expected date/time format: YYYY-mm-dd or YYYY-mm-ddTHH:MM:SS, e.g. 2018-01-12T21:23:12 (UTC)\n"
+   )
+   parser = argparse.ArgumentParser(description=usage_text,epilog=epilog_text,\
+                                    formatter_class=argparse.RawDescriptionHelpFormatter)
+   parser.add_argument("--db", metavar="FILE", action="store", dest="db", default=DEFAULT_PATH, help="archive database (default: {0})".format(DEFAULT_PATH))
+   parser.add_argument("--add", metavar="DIR", nargs="+", action="store", dest="add_dirs", help="directories of GPX files to add to the archive")
+   query = parser.add_argument_group("queries")
+   query.add_argument("--near", metavar="LAT,LON", action="store", dest="near", help="point the runs pass")
+   query.add_argument("--bbox", metavar="LAT1,LON1,LAT2,LON2", action="store", dest="bbox", help="box the runs pass through")
+   query.add_argument("--radius", metavar="METRES", action="store", type=float, dest="radius", help="max. distance of runs from the point or box (default: 50 from a point, 0 from a box)")
+   query.add_argument("--route", metavar="GPXFILE", action="store", dest="route", help="run (or GPX file) whose route the runs follow")
+   query.add_argument("--similarity", metavar="FRACTION", action="store", type=float, dest="similarity", default=0.6, help="min. share of the grid cells of two runs passed by both, for the same route (default: 0.6)")
+   query.add_argument("--after", metavar="DATE", action="store", dest="after", help="earliest start of the runs")
+   query.add_argument("--before", metavar="DATE", action="store", dest="before", help="latest start of the runs")
+   parser.add_argument("-j","--jobs", action="store", type=int, dest="jobs", default=os.cpu_count() or 1, metavar="N", help="Number of files parsed concurrently (default: number of CPUs)")
+   parser.add_argument("--debug", action="store_true", dest="debug", help="Print lots of debugging information")
+   _result = parser.parse_args()
+
+   # argument logic check
+   if not _result.add_dirs and not (_result.near or _result.bbox or _result.route or _result.after or _result.before) :
+      error("Nothing to do, specify directories to add or a query", True)
+   if _result.near and _result.bbox :
+      error("Specifying a point and a box together makes no sense", True)
+   if _result.jobs < 1 :
+      error("Number of jobs must be positive", True)
+
+   return _result
+
+
+def error(msg,is_fatal = False) :
+   sys.stderr.write("{0:s} error: {1:s}\n".format("Fatal" if is_fatal else "Non-fatal",msg))
+   if is_fatal : exit (1)
+
+
+def debug_msg(msg) :
+   if options.debug :
+      sys.stdout.write("[debug] {0:s}\n".format(msg))
+
+
+def cell_keys(lat,lon) :
+   """Grid cell keys (int64) of points"""
+   return ((numpy.floor(numpy.asarray(lat) / CELL_SIZE).astype(numpy.int64) + LAT_CELLS) * (2 * LON_CELLS + 1)
+           + numpy.floor(numpy.asarray(lon) / CELL_SIZE).astype(numpy.int64) + LON_CELLS)
+
+
+def track_cells(lat,lon) :
+   """Sorted keys of the grid cells a track passes: its segments are sampled at least twice per cell"""
+   if len(lat) > 1 :
+      _dlat = numpy.diff(lat)
+      _dlon = numpy.diff(lon)
+      _samples = numpy.maximum(numpy.ceil(numpy.maximum(numpy.abs(_dlat),numpy.abs(_dlon)) * 2 / CELL_SIZE),1).astype(numpy.int64)
+      _segment = numpy.repeat(numpy.arange(len(_samples)),_samples)
+      _t = (numpy.arange(len(_segment)) - numpy.repeat(numpy.cumsum(_samples) - _samples,_samples)) / _samples[_segment]
+      lat = numpy.append(lat[_segment] + _t * _dlat[_segment],lat[-1])
+      lon = numpy.append(lon[_segment] + _t * _dlon[_segment],lon[-1])
+   return numpy.unique(cell_keys(lat,lon))
+
+
+def box_cell_ranges(lat_min,lon_min,lat_max,lon_max) :
+   """(first, last) cell keys of each grid row covering a box, extended by one cell to each side (the cells of a
+   track are found by sampling its segments, which may miss the corner of a cell)"""
+   _first = cell_keys(lat_min - CELL_SIZE,lon_min - CELL_SIZE)
+   _last = cell_keys(lat_min - CELL_SIZE,lon_max + CELL_SIZE)
+   _rows = int(cell_keys(lat_max + CELL_SIZE,lon_min - CELL_SIZE) - _first) // (2 * LON_CELLS + 1)
+   return [(int(_first) + _row * (2 * LON_CELLS + 1),int(_last) + _row * (2 * LON_CELLS + 1)) for _row in range(_rows + 1)]
+
+
+def read_run(path) :
+   """Row values and cell keys of a run, for Archive.store(); parses the GPX file (run by Archive.update() workers)"""
+   _stat = os.stat(path)  # before reading, so that a file modified meanwhile is read again next time
+   _lat = []
+   _lon = []
+   _time = []
+   for _point in gpxstream.read_points(path) :
+      _lat.append(_point.lat)
+      _lon.append(_point.lon)
+      _time.append(_point.time if _point.time is not None else math.nan)
+   _lat = numpy.array(_lat,dtype=numpy.float64)
+   _lon = numpy.array(_lon,dtype=numpy.float64)
+   _time = numpy.array(_time,dtype=numpy.float64)
+   _values = {"path" : os.path.abspath(path),"size" : _stat.st_size,"mtime" : _stat.st_mtime_ns,"points" : len(_lat),
+              "start" : None,"finish" : None,"length" : 0.0,"lat_min" : None,"lat_max" : None,"lon_min" : None,"lon_max" : None,
+              "track" : b"","track_index" : b""}
+   if not len(_lat) :
+      return _values,numpy.zeros(0,dtype=numpy.int64)
+   _x,_y = gpxgeometry.project(_lat,_lon,float(_lat.mean()))
+   _kept = gpxgeometry.simplified_indices([(_y,_x)],TOLERANCE)[0]
+   _timed = _time[~numpy.isnan(_time)]
+   _values.update(start=float(_timed.min()) if len(_timed) else None,finish=float(_timed.max()) if len(_timed) else None,
+                  length=float(numpy.hypot(numpy.diff(_x),numpy.diff(_y)).sum()),
+                  lat_min=float(_lat.min()),lat_max=float(_lat.max()),lon_min=float(_lon.min()),lon_max=float(_lon.max()),
+                  track=numpy.column_stack((_lat[_kept],_lon[_kept],_time[_kept])).tobytes(),
+                  track_index=_kept.astype(numpy.int32).tobytes())
+   return _values,track_cells(_lat[_kept],_lon[_kept])
+
+
+class Archive :
+   """Archive of runs (SQLite database) with a grid index: table cells holds (cell, run) for each grid cell a run
+   passes, so runs near a place are found by range scans of the primary key"""
+
+   def __init__(self,path = DEFAULT_PATH) :
+      _dir = os.path.dirname(path)
+      if _dir and not os.path.isdir(_dir) :
+         os.makedirs(_dir)
+      self._db = sqlite3.connect(path)
+      self._db.execute("CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, path TEXT UNIQUE, size INTEGER, "
+                       "mtime INTEGER, start REAL, finish REAL, points INTEGER, length REAL, cells INTEGER, "
+                       "lat_min REAL, lat_max REAL, lon_min REAL, lon_max REAL, track BLOB, track_index BLOB)")
+      self._db.execute("CREATE INDEX IF NOT EXISTS runs_start ON runs (start)")
+      self._db.execute("CREATE TABLE IF NOT EXISTS cells (cell INTEGER, run INTEGER, PRIMARY KEY (cell, run)) WITHOUT ROWID")
+      self._db.execute("CREATE INDEX IF NOT EXISTS cells_run ON cells (run)")
+
+   def __enter__(self) :
+      return self
+
+   def __exit__(self,exc_type,exc_value,traceback) :
+      self.close()
+
+   def close(self) :
+      self._db.commit()
+      self._db.close()
+
+   def update(self,dirs,jobs = 1) :
+      """Add new and modified GPX files of dirs (recursively), parsed by jobs processes, and forget runs whose
+      files are gone from dirs; yields (path, exception) for files that cannot be read"""
+      _files = []
+      for _dir in dirs :
+         for _root,_subdirs,_names in os.walk(_dir) :
+            _subdirs.sort()
+            _files.extend(os.path.abspath(os.path.join(_root,_name)) for _name in sorted(_names) if _name.lower().endswith(".gpx"))
+      _known = {_path : (_size,_mtime) for _path,_size,_mtime in self._db.execute("SELECT path, size, mtime FROM runs")}
+      _to_read = []
+      for _path in _files :
+         try :
+            _stat = os.stat(_path)
+         except OSError as _exc :
+            yield _path,_exc
+            continue
+         if _known.get(_path) != (_stat.st_size,_stat.st_mtime_ns) :
+            _to_read.append(_path)
+      _prefixes = tuple(os.path.join(os.path.abspath(_dir),"") for _dir in dirs)
+      _present = set(_files)
+      self.removed = 0
+      for _path in _known :
+         if _path.startswith(_prefixes) and _path not in _present :
+            self._remove(_path)
+            self.removed += 1
+      self.added = self.updated = 0
+      _stored = 0
+      if jobs > 1 and len(_to_read) > 1 :
+         _executor = concurrent.futures.ProcessPoolExecutor(min(jobs,len(_to_read)))
+         _futures = {_executor.submit(read_run,_path) : _path for _path in _to_read}
+         _results = ((_futures[_future],_future.result) for _future in concurrent.futures.as_completed(_futures))
+      else :
+         _executor = None
+         _results = ((_path,functools.partial(read_run,_path)) for _path in _to_read)
+      try :
+         for _path,_result in _results :
+            try :
+               _values,_cells = _result()
+            except (OSError,ValueError) as _exc :
+               yield _path,_exc
+               continue
+            if _path in _known :
+               self.updated += 1
+            else :
+               self.added += 1
+            self.store(_values,_cells)
+            _stored += 1
+            if _stored % COMMIT_INTERVAL == 0 :
+               self._db.commit()
+      finally :
+         if _executor : _executor.shutdown()
+         self._db.commit()
+
+   def store(self,values,cells) :
+      """Store a run (replacing a run of the same path) with the keys of the grid cells it passes"""
+      self._remove(values["path"])
+      _values = dict(values,cells=len(cells))
+      _columns = sorted(_values)
+      _cursor = self._db.execute("INSERT INTO runs ({0:s}) VALUES ({1:s})".format(", ".join(_columns),", ".join("?" * len(_columns))),
+                                 [_values[_column] for _column in _columns])
+      self._db.executemany("INSERT INTO cells VALUES (?, ?)",((int(_cell),_cursor.lastrowid) for _cell in cells))
+
+   def _remove(self,path) :
+      for (_id,) in self._db.execute("SELECT id FROM runs WHERE path = ?",(path,)).fetchall() :
+         self._db.execute("DELETE FROM cells WHERE run = ?",(_id,))
+         self._db.execute("DELETE FROM runs WHERE id = ?",(_id,))
+
+   def run(self,run_id) :
+      _row = self._db.execute("SELECT id, path, start, finish, points, length, cells FROM runs WHERE id = ?",(run_id,)).fetchone()
+      return Run(*_row) if _row else None
+
+   def find(self,path) :
+      """Archived run of a GPX file, or None"""
+      _row = self._db.execute("SELECT id, path, start, finish, points, length, cells FROM runs WHERE path = ?",
+                              (os.path.abspath(path),)).fetchone()
+      return Run(*_row) if _row else None
+
+   def track(self,run_id) :
+      """(lat, lon, time, index) arrays of the stored (simplified) track of a run; time: seconds since epoch or nan,
+      index: number of the point among all track points of the GPX file"""
+      return self._decode_track(*self._db.execute("SELECT track, track_index FROM runs WHERE id = ?",(run_id,)).fetchone())
+
+   def tracks(self,run_ids) :
+      """{id: track(id)} of several runs, read together"""
+      _ids = list(run_ids)
+      _tracks = {}
+      for _chunk in range(0,len(_ids),QUERY_CHUNK) :
+         _part = _ids[_chunk:_chunk + QUERY_CHUNK]
+         for _id,_track,_index in self._db.execute("SELECT id, track, track_index FROM runs WHERE id IN ({0:s})".format(
+                                                      ", ".join("?" * len(_part))),_part) :
+            _tracks[_id] = self._decode_track(_track,_index)
+      return _tracks
+
+   @staticmethod
+   def _decode_track(track,index) :
+      _track = numpy.frombuffer(track,dtype=numpy.float64).reshape(-1,3)
+      return _track[:,0],_track[:,1],_track[:,2],numpy.frombuffer(index,dtype=numpy.int32)
+
+   def runs(self,run_ids = None,after = None,before = None) :
+      """Runs (of run_ids, if given), started in [after, before) (seconds since epoch, if given), by start time"""
+      _conditions = []
+      _params = []
+      if after is not None :
+         _conditions.append("start >= ?")
+         _params.append(after)
+      if before is not None :
+         _conditions.append("start < ?")
+         _params.append(before)
+      _rows = self._db.execute("SELECT id, path, start, finish, points, length, cells FROM runs" +
+                               (" WHERE " + " AND ".join(_conditions) if _conditions else "") + " ORDER BY start, path",_params)
+      return [Run(*_row) for _row in _rows if run_ids is None or _row[0] in run_ids]
+
+   def _runs_in_cells(self,ranges) :
+      _ids = set()
+      for _first,_last in ranges :
+         _ids.update(_id for (_id,) in self._db.execute("SELECT DISTINCT run FROM cells WHERE cell BETWEEN ? AND ?",(_first,_last)))
+      return _ids
+
+   def candidates_near(self,lat,lon,radius) :
+      """Ids of runs passing the grid cells within radius (metres) of a point, from the index only (a superset of
+      runs_near())"""
+      _dlat = radius / gpxgeometry.METRES_PER_DEGREE
+      _dlon = _dlat / max(math.cos(math.radians(lat)),1e-6)
+      return self._runs_in_cells(box_cell_ranges(lat - _dlat,lon - _dlon,lat + _dlat,lon + _dlon))
+
+   def runs_near(self,lat,lon,radius) :
+      """Ids of runs passing within radius (metres) of a point"""
+      _px,_py = gpxgeometry.project(lat,lon,lat)
+      _found = set()
+      for _id,(_lat,_lon,_,_) in self.tracks(self.candidates_near(lat,lon,radius)).items() :
+         _x,_y = gpxgeometry.project(_lat,_lon,lat)
+         if len(_x) == 1 :
+            _x,_y = numpy.append(_x,_x),numpy.append(_y,_y)
+         if gpxgeometry.segment_distances(_px,_py,_x[:-1],_y[:-1],_x[1:],_y[1:]).min() <= radius :
+            _found.add(_id)
+      return _found
+
+   def runs_in_box(self,lat_min,lon_min,lat_max,lon_max,radius = 0.0) :
+      """Ids of runs passing through a box, extended by radius (metres) to each side"""
+      _dlat = radius / gpxgeometry.METRES_PER_DEGREE
+      _dlon = _dlat / max(math.cos(math.radians(max(abs(lat_min),abs(lat_max)))),1e-6)
+      lat_min,lon_min,lat_max,lon_max = lat_min - _dlat,lon_min - _dlon,lat_max + _dlat,lon_max + _dlon
+      _found = set()
+      for _id,(_lat,_lon,_,_) in self.tracks(self._runs_in_cells(box_cell_ranges(lat_min,lon_min,lat_max,lon_max))).items() :
+         # Liang-Barsky clipping of all segments: a segment hits the box if some t in [0, 1] lies within all 4 sides
+         _x0,_y0,_dx,_dy = _lon[:-1],_lat[:-1],numpy.diff(_lon),numpy.diff(_lat)
+         if not len(_dx) :
+            _x0,_y0,_dx,_dy = _lon,_lat,numpy.zeros(1),numpy.zeros(1)
+         _t0 = numpy.zeros(len(_dx))
+         _t1 = numpy.ones(len(_dx))
+         _outside = numpy.zeros(len(_dx),dtype=bool)
+         with numpy.errstate(divide="ignore",invalid="ignore") :
+            for _p,_q in ((-_dx,_x0 - lon_min),(_dx,lon_max - _x0),(-_dy,_y0 - lat_min),(_dy,lat_max - _y0)) :
+               _outside |= (_p == 0) & (_q < 0)
+               _r = _q / _p
+               _t0 = numpy.where(_p < 0,numpy.maximum(_t0,_r),_t0)
+               _t1 = numpy.where(_p > 0,numpy.minimum(_t1,_r),_t1)
+         if numpy.any(~_outside & (_t0 <= _t1)) :
+            _found.add(_id)
+      return _found
+
+   def similar_runs(self,cells,similarity) :
+      """{id: share} of the runs whose grid cells overlap cells (keys of a route) by at least similarity (Jaccard
+      index: cells passed by both / cells passed by either)"""
+      self._db.execute("CREATE TEMP TABLE IF NOT EXISTS route (cell INTEGER PRIMARY KEY)")
+      self._db.execute("DELETE FROM route")
+      self._db.executemany("INSERT OR IGNORE INTO route VALUES (?)",((int(_cell),) for _cell in cells))
+      _found = {}
+      for _id,_common,_cells in self._db.execute("SELECT cells.run, COUNT(*), runs.cells FROM route JOIN cells ON cells.cell = route.cell "
+                                                 "JOIN runs ON runs.id = cells.run GROUP BY cells.run") :
+         _share = _common / (len(cells) + _cells - _common)
+         if _share >= similarity :
+            _found[_id] = _share
+      return _found
+
+   def route_cells(self,path) :
+      """Grid cell keys of a GPX file: from the archive if it is archived (and unmodified), otherwise parsed"""
+      _run = self.find(path)
+      if _run :
+         _stat = os.stat(path)
+         if self._db.execute("SELECT size, mtime FROM runs WHERE id = ?",(_run.id,)).fetchone() == (_stat.st_size,_stat.st_mtime_ns) :
+            return numpy.array([_cell for (_cell,) in self._db.execute("SELECT cell FROM cells WHERE run = ?",(_run.id,))],dtype=numpy.int64)
+      return read_run(path)[1]
+
+
+def parse_coordinates(text,count) :
+   try :
+      _values = [float(_value) for _value in text.split(",")]
+   except ValueError :
+      _values = []
+   if len(_values) != count :
+      error("Expected {0:d} comma-separated numbers, got '{1:s}'".format(count,text),True)
+   return _values
+
+
+def parse_date(text) :
+   try :
+      return gpxstream.parse_time(text if "T" in text else text + "T00:00:00")
+   except ValueError as exc :
+      error(str(exc),True)
+
+
+###############################################
+#
+# the program starts here
+#
+###############################################
+
+if __name__ == "__main__" :
+   options = parse_args()
+
+   with Archive(options.db) as archive :
+      if options.add_dirs :
+         for path,exc in archive.update(options.add_dirs,options.jobs) :
+            error("Cannot read {0}, skipping ({1})".format(path,exc))
+         debug_msg("{0:d} runs added, {1:d} updated, {2:d} removed".format(archive.added,archive.updated,archive.removed))
+
+      run_ids = None  # all
+      if options.near :
+         lat,lon = parse_coordinates(options.near,2)
+         run_ids = archive.runs_near(lat,lon,options.radius if options.radius is not None else 50.0)
+      elif options.bbox :
+         lat1,lon1,lat2,lon2 = parse_coordinates(options.bbox,4)
+         run_ids = archive.runs_in_box(min(lat1,lat2),min(lon1,lon2),max(lat1,lat2),max(lon1,lon2),
+                                       options.radius or 0.0)
+      if options.route :
+         try :
+            route = archive.similar_runs(archive.route_cells(options.route),options.similarity)
+         except (OSError,ValueError) as exc :
+            error("Cannot read {0}: {1}".format(options.route,exc),True)
+         run_ids = set(route) if run_ids is None else run_ids & set(route)
+      if run_ids is not None or options.after or options.before :
+         for run in archive.runs(run_ids,parse_date(options.after) if options.after else None,
+                                 parse_date(options.before) if options.before else None) :
+            print("{0:s}\t{1:s}\t{2:.2f} km".format(run.path,gpxstream.format_time(run.start) if run.start is not None else "-",
+                                                    run.length / 1000))
@@ -1,17 +1,36 @@
 #!/usr/bin/python3
 import sys
-import gpxpy
-import datetime
+import os
+import re
 import argparse
+import collections
+import csv
+import gpxstream
+import gpxgeometry
+try :
+   import numpy
+except ImportError :
+   numpy = None
+try :
+   import gpxarchive  # gap filling; needs numpy
+except ImportError :
+   gpxarchive = None
 
 
-TIMEFORMAT = "%Y-%m-%dT%H:%M:%S"  # acc. to datetime.strptime requirements
-DURATIONFORMAT = "%H:%M:%S"  # acc. to datetime.strptime requirements
+MICROSECONDS = 1000000  # time stamps are handled as int64 microseconds since epoch
+NUMPY_UNITS = {0:"s", 3:"ms", 6:"us"}  # fraction digits numpy.datetime_as_string() writes for these units
+HR_RE = re.compile(rb"(<(?:[\w.-]+:)?hr\s*>)\s*[0-9.]+\s*(</(?:[\w.-]+:)?hr\s*>)")
+EXTENSIONS_RE = re.compile(rb"<(?:[\w.-]+:)?extensions[\s>].*?</(?:[\w.-]+:)?extensions\s*>",re.S)
+LENGTH_WEIGHT = 0.1  # metres of fragment score per metre of difference between fragment and expected length
+
+# settings of gap filling: archive database; min. time (s) and distance (m) between points for a gap;
+# max. distance (m) of archived points matched to the points before and after a gap
+GapSettings = collections.namedtuple("GapSettings","archive gap_time gap_distance radius")
 
 def parse_args() :
    # parse arguments
    usage_text = (
-      "Modifies a GPX file (GPS track data).")
+      "Modifies GPX files (GPS track data).")
    epilog_text= (
       "Typical usage cases:\n"
       "  %(prog)s --input INFILE --start STARTTIME --output OUTFILE\n"
@@ -22,23 +41,50 @@ def parse_args() :
       "                        : Scale GPX file so that the track starts at STARTTIME and ends at ENDTIME.\n"
       "  %(prog)s --input INFILE --duration TOTALTIME --output OUTFILE\n"
       "                        : Scale GPX file so that the track starts at original time and lasts TOTALTIME.\n"
+      "  %(prog)s --input INFILE|DIR... --start STARTTIME --output-dir DIR\n"
+      "                        : Time-shift many GPX files (all *.gpx files of DIR) so that each starts at STARTTIME\n"
+      "  %(prog)s --input INFILE|DIR... --targets CSVFILE --output-dir DIR\n"
+      "                        : Re-time many GPX files, each as given by its row of CSVFILE, with columns\n"
+      "                          file,start,finish,duration (file: name or path of the input file, empty fields\n"
+      "                          are not used; files without a row get --start/--finish/--duration)\n"
+      "  %(prog)s --input INFILE|DIR... --fill-gaps --output OUTFILE|--output-dir DIR\n"
+      "                        : Fill gaps in GPX files with fragments of archived runs (see gpxarchive.py) of\n"
+      "                          the same route, re-timed to fit each gap, with heart rate interpolated\n"
+      "Files are processed concurrently (see --jobs); output files may replace the input files.\n"
       "Expected date/time format: YYYY-mm-ddTHH:MM:SS, e.g. 2018-01-12T21:23:12\n"
       "Expected duration format: HH:MM:SS, e.g. 01:15:46\n"
    )
    parser = argparse.ArgumentParser(description=usage_text,epilog=epilog_text,\
                                     formatter_class=argparse.RawDescriptionHelpFormatter)
-   parser.add_argument("-i","--input", required=True, metavar="INFILE", action="store", dest="infile", help="input GPX file to read")
-   parser.add_argument("-o","--output", required=True, metavar="OUTFILE", action="store", dest="outfile", help="output GPX file to write")
+   parser.add_argument("-i","--input", required=True, nargs="+", metavar="INFILE", action="store", dest="infiles", help="input GPX files (or directories of them) to read")
+   parser.add_argument("-o","--output", metavar="OUTFILE", action="store", dest="outfile", help="output GPX file to write (single input file)")
+   parser.add_argument("--output-dir", metavar="DIR", action="store", dest="output_dir", help="directory to write output GPX files to, under the input file names")
+   parser.add_argument("--targets", metavar="CSVFILE", action="store", dest="targets", help="CSV file with per-file start/finish/duration")
    time = parser.add_argument_group("time")
    time.add_argument("--start", metavar="STARTTIME", action="store", dest="starttime", help="desired track start time")
    time.add_argument("--finish", metavar="ENDTIME", action="store", dest="endtime", help="desired track end time")
    time.add_argument("--duration", metavar="DURATION", action="store", dest="duration", help="desired track duration")
+   gaps = parser.add_argument_group("gap filling")
+   gaps.add_argument("--fill-gaps", action="store_true", dest="fill_gaps", help="fill gaps with fragments of archived runs")
+   gaps.add_argument("--archive", metavar="FILE", action="store", dest="archive", help="archive database (default: that of gpxarchive.py)")
+   gaps.add_argument("--gap-time", metavar="SECONDS", action="store", type=float, dest="gap_time", default=30.0, help="min. time between points for a gap (default: 30)")
+   gaps.add_argument("--gap-distance", metavar="METRES", action="store", type=float, dest="gap_distance", default=100.0, help="min. distance between points for a gap (default: 100)")
+   gaps.add_argument("--match-radius", metavar="METRES", action="store", type=float, dest="radius", default=30.0, help="max. distance of archived points matched to the ends of a gap (default: 30)")
+   parser.add_argument("-j","--jobs", action="store", type=int, dest="jobs", default=os.cpu_count() or 1, metavar="N", help="Number of files processed concurrently (default: number of CPUs)")
    parser.add_argument("--debug", action="store_true", dest="debug", help="Print lots of debugging information")
    _result = parser.parse_args()
 
    # argument logic check
    if _result.starttime and _result.endtime and _result.duration :
       error("Specifying start time, end time and duration together makes no sense", True)
+   if bool(_result.outfile) == bool(_result.output_dir) :
+      error("Specify either an output file or an output directory", True)
+   if _result.jobs < 1 :
+      error("Number of jobs must be positive", True)
+   if _result.fill_gaps and (_result.starttime or _result.endtime or _result.duration or _result.targets) :
+      error("Filling gaps and re-timing cannot be combined", True)
+   if _result.fill_gaps and gpxarchive is None :
+      error("Filling gaps needs numpy", True)
 
    return _result
 
@@ -53,19 +99,341 @@ def debug_msg(msg) :
       sys.stdout.write("[debug] {0:s}\n".format(msg))
 
 
-def get_time_bounds(gpx) :
-   tz = datetime.timezone(datetime.timedelta(0))
-   start_time = datetime.datetime(year=2099, month=1, day=1, hour=0, minute=0, second=0, tzinfo=tz)
-   finish_time = datetime.datetime(year=2000, month=1, day=1, hour=0, minute=0, second=0, tzinfo = tz)
-   
-   for track in gpx.tracks:
-      for segment in track.segments:
-         for point in segment.points:
-            if point.time < start_time:
-               start_time = point.time
-            elif point.time > finish_time:
-               finish_time = point.time
-   return start_time,finish_time
+def read_targets(filename) :
+   """{file name or path: (start,finish,duration)} from a CSV file with these columns"""
+   _targets = {}
+   with open(filename,newline="") as _input :
+      for _row in csv.DictReader(_input) :
+         if not _row.get("file") : continue
+         _targets[_row["file"].strip()] = tuple((_row.get(_column) or "").strip() or None
+                                                 for _column in ("start","finish","duration"))
+   return _targets
+
+
+def read_times(gpx) :
+   """(time spans, time stamps, time stamp suffixes) of the track points of gpx that have a time
+
+   Time stamps are int64 microseconds since epoch (a numpy array, or a list without numpy); suffixes are the
+   parts of the original time stamps after the seconds (fraction and zone, e.g. ".000Z"), to write them alike."""
+   _spans = []
+   _times = []
+   _suffixes = []
+   for _point in gpx.points() :
+      if _point.time is None : continue
+      _spans.append(_point.time_span)
+      _times.append(_point.time)
+      _suffixes.append(gpx.time_text(_point).strip()[19:])
+   if numpy is not None :
+      _times = numpy.rint(numpy.array(_times,dtype=numpy.float64) * MICROSECONDS).astype(numpy.int64)
+   else :
+      _times = [int(round(_time * MICROSECONDS)) for _time in _times]
+   return _spans,_times,_suffixes
+
+
+def get_time_transform(target,start_time_original,finish_time_original) :
+   """(start time, time scaling factor) for target (start,finish,duration), times in microseconds since epoch"""
+   _starttime,_endtime,_duration = target
+   duration_original = finish_time_original - start_time_original
+   _start_time = int(round(gpxstream.parse_time(_starttime) * MICROSECONDS)) if _starttime else None
+   _finish_time = int(round(gpxstream.parse_time(_endtime) * MICROSECONDS)) if _endtime else None
+   if _start_time is not None and not _duration and _finish_time is None :
+      # time-shift only
+      return _start_time,1
+   elif _start_time is None and not _duration and _finish_time is not None :
+      # time-shift only by finish time
+      return _finish_time - duration_original,1
+   elif _duration and _finish_time is None :
+      # time-shift by start time (or none) & time scaling
+      if _start_time is None : _start_time = start_time_original
+      duration = int(round(gpxstream.parse_duration(_duration) * MICROSECONDS))
+   elif _start_time is not None and not _duration and _finish_time is not None :
+      # time-shift by start time & time scaling to fit into explicit period
+      duration = _finish_time - _start_time
+   else :
+      raise ValueError("Unrecognized time argument combination")
+   if duration_original <= 0 :
+      raise ValueError("Track has no duration, it cannot be scaled")
+   return _start_time,duration / duration_original
+
+
+def transform_times(times,start_time_original,start_time,time_scaling_factor) :
+   """New time stamps: start_time + (time - start_time_original) * time_scaling_factor"""
+   if numpy is not None :
+      if time_scaling_factor == 1 :
+         return times + numpy.int64(start_time - start_time_original)
+      return numpy.int64(start_time) + numpy.rint((times - start_time_original) * time_scaling_factor).astype(numpy.int64)
+   return [start_time + int(round((_time - start_time_original) * time_scaling_factor)) for _time in times]
+
+
+def zone_offset(zone) :
+   """Microseconds to add to UTC for a time zone designator (Z, +HH:MM, -HHMM or empty)"""
+   if not zone or zone == "Z" : return 0
+   _offset = (int(zone[1:3]) * 3600 + int(zone[-2:]) * 60) * MICROSECONDS
+   return -_offset if zone[0] == "-" else _offset
+
+
+def format_times(times,suffixes) :
+   """Time stamp texts (bytes) for times (microseconds since epoch), each with the fraction digits and zone of
+   its suffix; with numpy, each group of equal suffixes (usually one group per file) is formatted at once"""
+   _texts = [None] * len(suffixes)
+   _groups = {}
+   for _idx,_suffix in enumerate(suffixes) :
+      _groups.setdefault(_suffix,[]).append(_idx)
+   for _suffix,_indexes in _groups.items() :
+      _fraction,_zone = _split_suffix(_suffix)
+      _digits = len(_fraction)
+      _scale = 10 ** max(6 - _digits,0)
+      if numpy is not None and _digits in NUMPY_UNITS :
+         _local = numpy.asarray(times)[_indexes] + numpy.int64(zone_offset(_zone))
+         _local = (_local + _scale // 2) // _scale * _scale  # round to the digits written
+         _group_texts = numpy.datetime_as_string(_local.astype("datetime64[us]"),unit=NUMPY_UNITS[_digits])
+         for _idx,_text in zip(_indexes,_group_texts.tolist()) :
+            _texts[_idx] = (_text + _zone).encode("ascii")
+      else :
+         _like = "2000-01-01T00:00:00" + _suffix
+         for _idx in _indexes :
+            _time = (int(times[_idx]) + _scale // 2) // _scale * _scale
+            _texts[_idx] = gpxstream.format_time(_time / MICROSECONDS,_like).encode("ascii")
+   return _texts
+
+
+def _split_suffix(suffix) :
+   """(fraction digits, zone) of a time stamp suffix, e.g. ".000Z" -> ("000","Z")"""
+   _digits = suffix[1:] if suffix.startswith(".") else ""
+   _length = 0
+   while _length < len(_digits) and _digits[_length].isdigit() :
+      _length += 1
+   return _digits[:_length],(_digits[_length:] if suffix.startswith(".") else suffix)
+
+
+def retime_file(infile,outfile,target) :
+   """Write infile re-timed to target (start,finish,duration) to outfile; returns messages for debugging
+
+   All time stamps are read into one array, transformed and formatted together, and written back in one
+   streaming pass; everything else (incl. heart rate extensions) is copied verbatim. outfile may be infile."""
+   _messages = []
+   with gpxstream.GpxFile(infile) as _gpx :
+      _spans,_times,_suffixes = read_times(_gpx)
+      if not len(_times) :
+         raise ValueError("No time stamps in " + infile)
+      start_time_original,finish_time_original = int(min(_times)),int(max(_times))
+      _messages.append("{0}: original start/end: {1} - {2}".format(infile,
+         gpxstream.format_time(start_time_original / MICROSECONDS),gpxstream.format_time(finish_time_original / MICROSECONDS)))
+      start_time,time_scaling_factor = get_time_transform(target,start_time_original,finish_time_original)
+      _messages.append("{0}: new start/end: {1} - {2}, time scaling factor = {3}".format(infile,
+         gpxstream.format_time(start_time / MICROSECONDS),
+         gpxstream.format_time((start_time + (finish_time_original - start_time_original) * time_scaling_factor) / MICROSECONDS),
+         time_scaling_factor))
+      _texts = format_times(transform_times(_times,start_time_original,start_time,time_scaling_factor),_suffixes)
+      _gpx.rewrite(outfile,((_start,_end,_text) for (_start,_end),_text in zip(_spans,_texts)))
+   return _messages
+
+
+def find_gaps(points,gap_time,gap_distance) :
+   """(indices i of points followed by a gap to point i + 1, lengths (m) of all steps between points)"""
+   _lat = numpy.array([_point.lat for _point in points])
+   _x,_y = gpxgeometry.project(_lat,[_point.lon for _point in points],_lat[0])
+   _steps = numpy.hypot(numpy.diff(_x),numpy.diff(_y))
+   _durations = numpy.diff([_point.time for _point in points])
+   return numpy.flatnonzero((_durations > gap_time) | (_steps > gap_distance)),_steps
+
+
+def find_fragment(archive,before,after,expected_length,radius,exclude = None) :
+   """(run id, first range, last range, score) of the archived fragment best filling the gap between points before
+   and after, or None; the ranges are the numbers (among the track points of the run's GPX file) of the end points
+   of the stored segments matched to before and after, see refine_fragment()
+
+   Candidate runs pass the grid cells around both points (found by the grid index of the archive). Stored tracks
+   are simplified, with vertices often much further apart than radius, so before and after are matched to their
+   segments: all segments within radius of before are paired with those of the same run within radius of after,
+   further along it, and all pairs are scored at once: the distances of both points, plus LENGTH_WEIGHT times the
+   difference between the fragment length and expected_length (m)."""
+   _ids = sorted(archive.candidates_near(before.lat,before.lon,radius) & archive.candidates_near(after.lat,after.lon,radius) - {exclude})
+   _tracks = archive.tracks(_ids)
+   _ids = [_id for _id in _ids if len(_tracks[_id][0])]
+   if not _ids :
+      return None
+   _tracks = [_tracks[_id] for _id in _ids]
+   _x,_y = gpxgeometry.project(numpy.concatenate([_track[0] for _track in _tracks]),
+                               numpy.concatenate([_track[1] for _track in _tracks]),before.lat)
+   _time = numpy.concatenate([_track[2] for _track in _tracks])
+   _index = numpy.concatenate([_track[3] for _track in _tracks])
+   _run = numpy.repeat(numpy.arange(len(_ids)),[len(_track[0]) for _track in _tracks])
+   # segments from each stored point to the next one of the same run, and distance along each run to their start
+   _segments = numpy.flatnonzero(_run[1:] == _run[:-1])
+   _steps = numpy.hypot(numpy.diff(_x),numpy.diff(_y))
+   _steps[_run[1:] != _run[:-1]] = 0
+   _along = numpy.concatenate(([0],numpy.cumsum(_steps)))
+
+   def _near(point) :
+      """(segments within radius of point, their distances, distances along the run of the closest points)"""
+      _px,_py = gpxgeometry.project(point.lat,point.lon,before.lat)
+      _distance,_t = gpxgeometry.segment_projections(float(_px),float(_py),_x[_segments],_y[_segments],
+                                                     _x[_segments + 1],_y[_segments + 1])
+      _close = _distance <= radius
+      return _segments[_close],_distance[_close],_along[_segments[_close]] + _t[_close] * _steps[_segments[_close]]
+
+   _near_before,_distance_before,_along_before = _near(before)
+   _near_after,_distance_after,_along_after = _near(after)
+   # pair each segment near before with all segments of the same run near after (both sorted by run)
+   _after_start = numpy.searchsorted(_run[_near_after],_run[_near_before],side="left")
+   _counts = numpy.searchsorted(_run[_near_after],_run[_near_before],side="right") - _after_start
+   _pair_before = numpy.repeat(numpy.arange(len(_near_before)),_counts)
+   _pair_after = numpy.arange(len(_pair_before)) + numpy.repeat(_after_start - (numpy.cumsum(_counts) - _counts),_counts)
+   _first,_last = _near_before[_pair_before],_near_after[_pair_after]
+   _length = _along_after[_pair_after] - _along_before[_pair_before]
+   _score = _distance_before[_pair_before] + _distance_after[_pair_after] + LENGTH_WEIGHT * numpy.abs(_length - expected_length)
+   # further along the run, with time stamps
+   _score[(_length <= 0) | ~(_time[_last + 1] > _time[_first])] = numpy.inf
+   if not len(_score) or numpy.isinf(_score.min()) :
+      return None
+   _best = int(numpy.argmin(_score))
+   _first,_last = _first[_best],_last[_best]
+   return (_ids[_run[_first]],(int(_index[_first]),int(_index[_first + 1])),(int(_index[_last]),int(_index[_last + 1])),
+           float(_score[_best]))
+
+
+def refine_fragment(source,before,after,first_range,last_range) :
+   """(first, last): numbers of the track points of GPX file source closest to points before and after, among points
+   first_range[0] .. first_range[1] and last_range[0] .. last_range[1] (from find_fragment(), which only knows the
+   simplified track); there is at least one point between first and last"""
+   _numbers = []
+   _lat = []
+   _lon = []
+   with gpxstream.GpxFile(source) as _source :
+      for _number,_point in enumerate(_source.points()) :
+         if _number > last_range[1] : break
+         if _number >= first_range[0] and _point.time is not None :
+            _numbers.append(_number)
+            _lat.append(_point.lat)
+            _lon.append(_point.lon)
+   _numbers = numpy.array(_numbers,dtype=numpy.int64)
+   _lat = numpy.array(_lat)
+   _lon = numpy.array(_lon)
+   _firsts = _numbers <= first_range[1]
+   if not _firsts.any() or _numbers[-1] < last_range[0] :
+      raise ValueError("{0} was modified since it was archived".format(source))
+   _distance = gpxgeometry.haversine(before.lat,before.lon,_lat,_lon)
+   _first = int(_numbers[_firsts][numpy.argmin(_distance[_firsts])])
+   _lasts = (_numbers >= last_range[0]) & (_numbers > _first + 1)
+   if not _lasts.any() :
+      raise ValueError("no track points of {0} between the ends of the gap".format(source))
+   _distance = gpxgeometry.haversine(after.lat,after.lon,_lat[_lasts],_lon[_lasts])
+   return _first,int(_numbers[_lasts][numpy.argmin(_distance)])
+
+
+def fragment_text(gpx,before,after,source,first,last) :
+   """Track points first + 1 .. last - 1 of GPX file source (their original text), re-timed to fit between points
+   before and after of gpx, heart rate interpolated between theirs; to be inserted after before
+
+   Time stamps are written in the format of those of gpx; points that would get the same time stamp as the point
+   before them (a fragment compressed in time, whole seconds) are left out. If only one of before and after has a
+   heart rate, all points get that one; points of source without extensions get those of that point."""
+   _points = []
+   _first_time = _last_time = None
+   with gpxstream.GpxFile(source) as _source :
+      for _number,_point in enumerate(_source.points()) :
+         if _number == first :
+            _first_time = _point.time
+         elif first < _number < last and _point.time is not None :
+            _points.append((_point,bytes(_source.data[_point.span[0]:_point.span[1]])))
+         elif _number == last :
+            _last_time = _point.time
+            break
+   if _first_time is None or _last_time is None :
+      raise ValueError("{0} was modified since it was archived".format(source))
+   _scale = (after.time - before.time) / (_last_time - _first_time)
+   _indent_start = gpx.data.rfind(b"\n",0,before.span[0]) + 1
+   _indent = bytes(gpx.data[_indent_start:before.span[0]])
+   if _indent.strip() : _indent = b""
+   _like = gpx.time_text(before)
+   _hr_before,_hr_after = heart_rate(before),heart_rate(after)
+   _extensions = None
+   if _hr_before is not None or _hr_after is not None :
+      _edge = before if _hr_before is not None else after
+      _hr_before = _hr_before if _hr_before is not None else _hr_after
+      _hr_after = _hr_after if _hr_after is not None else _hr_before
+      _match = EXTENSIONS_RE.search(gpx.data,_edge.span[0],_edge.span[1])
+      _extensions = bytes(gpx.data[_match.start():_match.end()]) if _match else None
+   _text = []
+   _previous_time_text = gpxstream.format_time(before.time,_like)
+   _after_time_text = gpxstream.format_time(after.time,_like)
+   for _point,_raw in _points :
+      _time = before.time + (_point.time - _first_time) * _scale
+      _time_text = gpxstream.format_time(_time,_like)
+      if _time_text in (_previous_time_text,_after_time_text) : continue
+      _previous_time_text = _time_text
+      _raw = (_raw[:_point.time_span[0] - _point.span[0]] + _time_text.encode("ascii")
+              + _raw[_point.time_span[1] - _point.span[0]:])
+      if _hr_before is not None :
+         if _extensions and not EXTENSIONS_RE.search(_raw) :
+            _raw = with_extensions(_raw,_extensions)
+         _hr = _hr_before + (_hr_after - _hr_before) * (_time - before.time) / (after.time - before.time)
+         _raw = HR_RE.sub(lambda _match : _match.group(1) + str(int(round(_hr))).encode("ascii") + _match.group(2),_raw,count=1)
+      _text.append(b"\n" + _indent + _raw)
+   return b"".join(_text)
+
+
+def heart_rate(point) :
+   """Heart rate of point (TrackPoint), or None"""
+   try :
+      return float(point.extensions["hr"])
+   except (TypeError,KeyError,ValueError) :
+      return None
+
+
+def with_extensions(raw,extensions) :
+   """Text of a track point (raw) with the text of an <extensions> element added before its end tag, on a line of
+   its own, indented like the line before, if the end tag is on a line of its own"""
+   _end = gpxstream.TRKPT_END_RE.search(raw)
+   if not _end : return raw  # <trkpt .../>
+   _line_start = raw.rfind(b"\n",0,_end.start()) + 1
+   if not _line_start or raw[_line_start:_end.start()].strip() :
+      return raw[:_end.start()] + extensions + raw[_end.start():]
+   _previous_line = raw[raw.rfind(b"\n",0,_line_start - 1) + 1:_line_start - 1]
+   _indent = _previous_line[:len(_previous_line) - len(_previous_line.lstrip())]
+   return raw[:_line_start] + _indent + extensions + b"\n" + raw[_line_start:]
+
+
+def fill_gaps_file(infile,outfile,settings) :
+   """Write infile with its gaps filled from the archive to outfile; returns messages for debugging"""
+   _messages = []
+   with gpxarchive.Archive(settings.archive) as _archive,gpxstream.GpxFile(infile) as _gpx :
+      _points = [_point for _point in _gpx.points() if _point.time is not None]
+      if len(_points) < 2 :
+         raise ValueError("No track in " + infile)
+      _gaps,_steps = find_gaps(_points,settings.gap_time,settings.gap_distance)
+      # expected length of a fragment: the gap's duration at the median speed elsewhere
+      _durations = numpy.diff([_point.time for _point in _points])
+      _moving = numpy.ones(len(_steps),dtype=bool)
+      _moving[_gaps] = False
+      _moving &= _durations > 0
+      _speed = float(numpy.median(_steps[_moving] / _durations[_moving])) if _moving.any() else 0.0
+      _self = _archive.find(infile)
+      _patches = []
+      for _gap in _gaps :
+         _before,_after = _points[_gap],_points[_gap + 1]
+         _description = "{0}: gap {1} - {2} ({3:.0f} s, {4:.0f} m)".format(infile,_gpx.time_text(_before).strip(),
+                                                                          _gpx.time_text(_after).strip(),_after.time - _before.time,_steps[_gap])
+         if _after.time <= _before.time :
+            _messages.append(_description + ": not filled, time does not advance")
+            continue
+         _match = find_fragment(_archive,_before,_after,max((_after.time - _before.time) * _speed,_steps[_gap]),
+                                settings.radius,_self.id if _self else None)
+         if not _match :
+            _messages.append(_description + ": no archived run passes both ends")
+            continue
+         _run = _archive.run(_match[0])
+         try :
+            _first,_last = refine_fragment(_run.path,_before,_after,_match[1],_match[2])
+            _patches.append((_before.span[1],_before.span[1],fragment_text(_gpx,_before,_after,_run.path,_first,_last)))
+         except (OSError,ValueError) as _exc :
+            _messages.append(_description + ": not filled, cannot use archived run ({0})".format(_exc))
+            continue
+         _messages.append(_description + ": filled with points {0:d} - {1:d} of {2} (score {3:.1f})".format(
+            _first + 1,_last - 1,_run.path,_match[3]))
+      _gpx.rewrite(outfile,_patches)
+   return _messages
 
 
 ###############################################
@@ -74,59 +442,40 @@ def get_time_bounds(gpx) :
 #
 ###############################################
 
-options = parse_args()
-
-gpx_file = open(options.infile,"r")
-gpx = gpxpy.parse(gpx_file)
-
-lat = []
-lon = []
-timestamps = []
-
-# not really needed for time-shift only, but who cares...
-start_time_original, finish_time_original = get_time_bounds(gpx)
-debug_msg("Original start/end: " + str(start_time_original) + " - " + str(finish_time_original))
-duration_original = finish_time_original - start_time_original
-debug_msg("Original duration = " + str(duration_original))
-
-if options.starttime and not options.duration and not options.endtime :
-   # time-shift only
-   start_time = datetime.datetime.strptime(options.starttime,TIMEFORMAT)
-   debug_msg("Computed finish time = " + str(start_time + duration_original))
-   time_scaling_factor = 1
-elif not options.starttime and not options.duration and options.endtime :
-   # time-shift only by finish time
-   finish_time = datetime.datetime.strptime(options.endtime,TIMEFORMAT)
-   start_time = finish_time - duration_original
-   debug_msg("Computed start time = " + str(start_time))
-   time_scaling_factor = 1
-elif options.starttime and options.duration and not options.endtime :
-   # time-shift by start time & time scaling
-   start_time = datetime.datetime.strptime(options.starttime,TIMEFORMAT)
-   duration = datetime.datetime.strptime(options.duration,"%H:%M:%S") - datetime.datetime.strptime("00:00:00","%H:%M:%S")
-   debug_msg("Desired duration = " + str(duration))
-   time_scaling_factor = duration / duration_original
-   debug_msg("Computed finish time = " + str(start_time + duration_original * time_scaling_factor))
-elif options.starttime and not options.duration and options.endtime :
-   # time-shift by start time & time scaling to fit into explicit period
-   start_time = datetime.datetime.strptime(options.starttime,TIMEFORMAT)
-   finish_time = datetime.datetime.strptime(options.endtime,TIMEFORMAT)
-   duration = finish_time - start_time
-   debug_msg("Desired duration = " + str(duration))
-   time_scaling_factor = duration / duration_original
-else :
-   error("Unrecognized time argument combination",True)
-
-debug_msg("Time scaling factor = " + str(time_scaling_factor))
-
-
-
-
-for track in gpx.tracks:
-   for segment in track.segments:
-      for point in segment.points:
-         offset = point.time - start_time_original
-         point.time = start_time + offset*time_scaling_factor
-
-with open(options.outfile, 'w') as outfile :
-   outfile.write(gpx.to_xml())
+if __name__ == "__main__" :
+   options = parse_args()
+
+   try :
+      files = gpxstream.batch_files(options.infiles,options.outfile,options.output_dir)
+   except (OSError,ValueError) as exc :
+      error(str(exc),True)
+
+   if options.fill_gaps :
+      process = fill_gaps_file
+      settings = GapSettings(options.archive or gpxarchive.DEFAULT_PATH,options.gap_time,options.gap_distance,options.radius)
+      if not os.path.exists(settings.archive) :
+         error("Archive {0} does not exist, see gpxarchive.py".format(settings.archive),True)
+   else :
+      process = retime_file
+   shared_target = (options.starttime,options.endtime,options.duration)
+   try :
+      targets = read_targets(options.targets) if options.targets else {}
+   except (OSError,csv.Error) as exc :
+      error("Cannot read {0}: {1}".format(options.targets,exc),True)
+
+   jobs = []
+   for infile,outfile in files :
+      if options.fill_gaps :
+         jobs.append((infile,outfile,settings))
+         continue
+      target = targets.get(infile) or targets.get(os.path.basename(infile)) or shared_target
+      if not any(target) :
+         error("No start time, end time or duration for " + infile)
+         continue
+      jobs.append((infile,outfile,target))
+   debug_msg("{0:d} files to process, {1:s}".format(len(jobs),"with numpy" if numpy is not None else "without numpy"))
+
+   failed = len(files) - len(jobs)
+   failed += gpxstream.process_files(process,jobs,options.jobs,error,debug_msg)
+   if failed :
+      error("{0:d} of {1:d} files not processed".format(failed,len(files)),True)
@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+# vim: set ts=3 sw=3 tw=0 et :
+#
+# Track geometry shared by the running tools (needs numpy; the module can be imported without it, so that the
+# tools check for numpy only in the modes using it)
+#
+# Computations work on whole tracks (numpy arrays of coordinates) at once. Distances are computed in a local
+# plane: lat/lon projected to metres around a reference latitude, which is accurate to well under 1% over
+# the extent of a run.
+#
+import math
+try :
+   import numpy
+except ImportError :
+   numpy = None
+
+
+EARTH_RADIUS = 6371008.8  # metres, mean radius
+METRES_PER_DEGREE = EARTH_RADIUS * math.pi / 180
+
+
+def project(lat,lon,lat0) :
+   """(x, y) in metres of lat/lon (degrees) in the equirectangular projection around latitude lat0"""
+   return (numpy.asarray(lon) * (METRES_PER_DEGREE * math.cos(math.radians(lat0))),
+           numpy.asarray(lat) * METRES_PER_DEGREE)
+
+
+def haversine(lat1,lon1,lat2,lon2) :
+   """Great-circle distances in metres between points (lat1, lon1) and (lat2, lon2), degrees; arrays broadcast"""
+   _lat1,_lon1,_lat2,_lon2 = (numpy.radians(_value) for _value in (lat1,lon1,lat2,lon2))
+   _a = numpy.sin((_lat2 - _lat1) / 2) ** 2 + numpy.cos(_lat1) * numpy.cos(_lat2) * numpy.sin((_lon2 - _lon1) / 2) ** 2
+   return 2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.minimum(_a,1.0)))
+
+
+def segment_projections(px,py,x0,y0,x1,y1) :
+   """(distances, t) of points (px, py) from segments (x0, y0)-(x1, y1): the closest point of each segment is
+   (x0, y0) + t * (x1 - x0, y1 - y0), 0 <= t <= 1; all arguments broadcast together"""
+   _dx = x1 - x0
+   _dy = y1 - y0
+   _px = px - x0
+   _py = py - y0
+   _length2 = _dx * _dx + _dy * _dy
+   _t = numpy.clip(numpy.divide(_px * _dx + _py * _dy,_length2,out=numpy.zeros(numpy.broadcast(_px,_length2).shape),
+                                where=_length2 > 0),0,1)
+   return numpy.hypot(_px - _t * _dx,_py - _t * _dy),_t
+
+
+def segment_distances(px,py,x0,y0,x1,y1) :
+   """Distances of points (px, py) from segments (x0, y0)-(x1, y1); all arguments broadcast together"""
+   return segment_projections(px,py,x0,y0,x1,y1)[0]
+
+
+def simplified_indices(tracks,tolerance) :
+   """Indices of the points of each track (y, x; not empty) left by Ramer-Douglas-Peucker simplification: no
+   point removed is further than tolerance (in the unit of x and y) from its simplified track
+
+   Instead of recursing, all sections still to be simplified (of all tracks) are processed together, one level
+   at a time: the distances of all their inner points are computed at once, and each section that is not yet
+   close enough is split at its most distant point. Every level costs O(n), and there are about log(n) levels."""
+   _lengths = numpy.array([len(_y) for _y,_x in tracks],dtype=numpy.int64)
+   if tolerance <= 0 :
+      return [numpy.arange(_length) for _length in _lengths]
+   _y = numpy.concatenate([_track[0] for _track in tracks])
+   _x = numpy.concatenate([_track[1] for _track in tracks])
+   _keep = numpy.zeros(len(_y),dtype=bool)
+   _ends = numpy.cumsum(_lengths) - 1
+   _starts = _track_starts = _ends - _lengths + 1
+   _keep[_starts] = _keep[_ends] = True
+   _tolerance2 = tolerance * tolerance
+   while len(_starts) :
+      _inner = _ends - _starts - 1  # inner points of each section
+      _starts,_ends,_inner = _starts[_inner > 0],_ends[_inner > 0],_inner[_inner > 0]
+      if not len(_starts) : break
+      _offsets = numpy.cumsum(_inner) - _inner
+      _section = numpy.repeat(numpy.arange(len(_starts)),_inner)
+      _points = numpy.arange(len(_section)) + numpy.repeat(_starts + 1 - _offsets,_inner)
+      # (squared) distance of each inner point from the segment between the end points of its section
+      _x0,_y0 = numpy.repeat(_x[_starts],_inner),numpy.repeat(_y[_starts],_inner)
+      _dx,_dy = numpy.repeat(_x[_ends],_inner) - _x0,numpy.repeat(_y[_ends],_inner) - _y0
+      _px,_py = _x[_points] - _x0,_y[_points] - _y0
+      _length2 = _dx * _dx + _dy * _dy
+      _t = numpy.clip(numpy.divide(_px * _dx + _py * _dy,_length2,out=numpy.zeros_like(_length2),where=_length2 > 0),0,1)
+      _px -= _t * _dx
+      _py -= _t * _dy
+      _distance2 = _px * _px + _py * _py
+      _max_distance2 = numpy.maximum.reduceat(_distance2,_offsets)
+      # first point with the max. distance of each section to split
+      _split = _max_distance2 > _tolerance2
+      _is_max = _split[_section] & (_distance2 == _max_distance2[_section])
+      _sections,_first = numpy.unique(_section[_is_max],return_index=True)
+      _middles = _points[_is_max][_first]
+      _keep[_middles] = True
+      _starts,_ends = numpy.concatenate((_starts[_sections],_middles)),numpy.concatenate((_middles,_ends[_sections]))
+   _indices = numpy.flatnonzero(_keep)
+   _bounds = numpy.cumsum(numpy.add.reduceat(_keep.astype(numpy.int64),_track_starts))[:-1]
+   return [_kept - _start for _kept,_start in zip(numpy.split(_indices,_bounds),_track_starts)]
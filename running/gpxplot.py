@@ -1,29 +1,38 @@
 #!/usr/bin/python3
 
-from os import listdir
-from os.path import isfile, join
+import os
 import sys
+import hashlib
+import concurrent.futures
+import numpy
 import matplotlib.pyplot as plt
-import gpxpy
+import matplotlib.collections
+import matplotlib.colors
 import argparse
+import gpxstream
+import gpxgeometry
+
+
+FIGURE_SIZE = (6.4,4.8)  # inches, matplotlib default; the plot is fitted into it
+TRACK_COLOR = "deepskyblue"
+BACKGROUND_COLOR = "0.05"
+RASTER_CHUNK = 1 << 24  # pixel indices collected before they are added to the heatmap
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"),".cache"),"gpxplot")
 
 
 def parse_args() :
    # parse arguments
    usage_text = (
-      "Plots all GPX tracks from a specified directory.")
+      "Plots all GPX tracks from specified directories.")
    epilog_text= (
       "Typical usage cases:\n"
-      "  %(prog)s --input INFILE --start STARTTIME --output OUTFILE\n"
-      "                        : Time-shift GPX file so that the track starts at STARTTIME\n"
-      "  %(prog)s --input INFILE --finish ENDTIME --output OUTFILE\n"
-      "                        : Time-shift GPX file so that the track ends at ENDTIME\n"
-      "  %(prog)s --input INFILE --start STARTTIME  --finish ENDTIME --output OUTFILE\n"
-      "                        : Scale GPX file so that the track starts at STARTTIME and ends at ENDTIME.\n"
-      "  %(prog)s --input INFILE --duration TOTALTIME --output OUTFILE\n"
-      "                        : Scale GPX file so that the track starts at original time and lasts TOTALTIME.\n"
-      "Expected date/time format: YYYY-mm-ddTHH:MM:SS, e.g. 2018-01-12T21:23:12\n"
-      "Expected duration format: HH:MM:SS, e.g. 01:15:46\n"
+      "  %(prog)s --output OUTFILE DIR...\n"
+      "                        : Plot all tracks of all *.gpx files in DIRs to OUTFILE\n"
+      "  %(prog)s --render heatmap --output OUTFILE DIR...\n"
+      "                        : Plot a heatmap of how many tracks pass through each pixel (fast for any number of tracks)\n"
+      "Tracks are simplified (Ramer-Douglas-Peucker) to --simplify pixels of the output before plotting.\n"
+      "Parsed tracks are cached (one file per track, see --cache), so only new or modified GPX files are parsed\n"
+      "again; files to parse are processed concurrently (see --jobs).\n"
    )
    parser = argparse.ArgumentParser(description=usage_text,epilog=epilog_text,\
                                     formatter_class=argparse.RawDescriptionHelpFormatter)
@@ -31,10 +40,26 @@ def parse_args() :
    parser.add_argument("-o","--output", required=True, metavar="OUTFILE", action="store", dest="outfile", help="output image file")
    parser.add_argument("-f","--format", required=False, metavar="FORMAT", action="store", dest="outformat", \
                        choices=["png","svg","pdf","ps","eps"], default="png", help="output image file format")
+   parser.add_argument("-r","--render", action="store", dest="render", choices=["lines","heatmap"], default="lines", \
+                       help="lines: draw all tracks as lines (one line collection); heatmap: rasterise tracks into a density image (default: lines)")
+   parser.add_argument("--scale", action="store", dest="scale", choices=["log","equalize","linear"], default="log", \
+                       help="heatmap brightness scaling of track counts (default: log)")
+   parser.add_argument("--dpi", action="store", type=int, dest="dpi", default=300, help="output resolution, dots per inch (default: 300)")
+   parser.add_argument("--simplify", metavar="PIXELS", action="store", type=float, dest="simplify", default=0.5, \
+                       help="max. deviation of simplified tracks from the original ones, in output pixels; 0: no simplification (default: 0.5)")
+   parser.add_argument("--cache", metavar="DIR", action="store", dest="cache_dir", default=CACHE_DIR, help="directory of cached parsed tracks (default: {0})".format(CACHE_DIR))
+   parser.add_argument("--no-cache", action="store_const", const=None, dest="cache_dir", help="parse all GPX files, without using or updating the cache")
+   parser.add_argument("-j","--jobs", action="store", type=int, dest="jobs", default=os.cpu_count() or 1, metavar="N", help="Number of files parsed concurrently (default: number of CPUs)")
    parser.add_argument("--debug", action="store_true", dest="debug", help="Print lots of debugging information")
    _result = parser.parse_args()
 
    # argument logic check
+   if _result.jobs < 1 :
+      error("Number of jobs must be positive", True)
+   if _result.dpi < 1 :
+      error("Resolution must be positive", True)
+   if _result.simplify < 0 :
+      error("Simplification tolerance cannot be negative", True)
 
    return _result
 
@@ -49,44 +74,203 @@ def debug_msg(msg) :
       sys.stdout.write("[debug] {0:s}\n".format(msg))
 
 
+def list_gpx_files(dirs) :
+   """All *.gpx files in dirs"""
+   _files = []
+   for _dir in dirs :
+      for _name in sorted(os.listdir(_dir)) :
+         _path = os.path.join(_dir,_name)
+         if _name.lower().endswith(".gpx") and os.path.isfile(_path) :
+            _files.append(_path)
+   return _files
+
+
+def cache_file(cache_dir,path) :
+   """Cache file of the GPX file path: named by a digest of its absolute path"""
+   return os.path.join(cache_dir,hashlib.sha1(os.path.abspath(path).encode("utf-8","surrogateescape")).hexdigest() + ".npz")
+
+
+def file_key(path) :
+   """(size, mtime in ns) of a file; a cached track is valid while its GPX file has the same key"""
+   _stat = os.stat(path)
+   return _stat.st_size,_stat.st_mtime_ns
+
+
+def load_cached_track(cache_dir,path) :
+   """(lat, lon) arrays of path from the cache, or None if not cached or out of date"""
+   try :
+      with numpy.load(cache_file(cache_dir,path)) as _cached :
+         if str(_cached["path"]) != os.path.abspath(path) or tuple(_cached["key"].tolist()) != file_key(path) :
+            return None
+         return _cached["lat"],_cached["lon"]
+   except (OSError,ValueError,KeyError) :
+      return None
+
+
+def parse_track(path,cache_dir) :
+   """(lat, lon) arrays of all track points of a GPX file, stored to the cache unless cache_dir is None"""
+   _key = file_key(path)  # before reading, so that a file modified meanwhile is parsed again next time
+   _lat = []
+   _lon = []
+   for _point in gpxstream.read_points(path) :
+      _lat.append(_point.lat)
+      _lon.append(_point.lon)
+   _lat = numpy.array(_lat,dtype=numpy.float64)
+   _lon = numpy.array(_lon,dtype=numpy.float64)
+   if cache_dir is not None :
+      _cache_file = cache_file(cache_dir,path)
+      _part_file = "{0:s}.{1:d}.part.npz".format(_cache_file[:-4],os.getpid())
+      try :
+         numpy.savez(_part_file,path=os.path.abspath(path),key=numpy.array(_key,dtype=numpy.int64),lat=_lat,lon=_lon)
+         os.replace(_part_file,_cache_file)
+      except OSError :
+         pass  # the track is just parsed again next time
+   return _lat,_lon
+
+
+def load_tracks(files,cache_dir,jobs) :
+   """Yield (path, (lat, lon)) for all files that can be read: cached tracks first, then the others as parsed
+   by a pool of processes (or right here with jobs = 1)"""
+   _to_parse = []
+   for _path in files :
+      _track = load_cached_track(cache_dir,_path) if cache_dir is not None else None
+      if _track is not None :
+         yield _path,_track
+      else :
+         _to_parse.append(_path)
+   debug_msg("{0:d} tracks cached, {1:d} to parse".format(len(files) - len(_to_parse),len(_to_parse)))
+   if cache_dir is not None and _to_parse :
+      os.makedirs(cache_dir,exist_ok=True)
+   if jobs > 1 and len(_to_parse) > 1 :
+      with concurrent.futures.ProcessPoolExecutor(min(jobs,len(_to_parse))) as _executor :
+         _futures = {_executor.submit(parse_track,_path,cache_dir) : _path for _path in _to_parse}
+         for _future in concurrent.futures.as_completed(_futures) :
+            try :
+               yield _futures[_future],_future.result()
+            except (OSError,ValueError) as _exc :
+               error("Cannot read {0}, skipping ({1})".format(_futures[_future],_exc))
+   else :
+      for _path in _to_parse :
+         try :
+            yield _path,parse_track(_path,cache_dir)
+         except (OSError,ValueError) as _exc :
+            error("Cannot read {0}, skipping ({1})".format(_path,_exc))
+
+
+def get_bbox(tracks) :
+   """(lon_min, lat_min, lon_max, lat_max) of all tracks"""
+   return (min(_lon.min() for _lat,_lon in tracks),min(_lat.min() for _lat,_lon in tracks),
+           max(_lon.max() for _lat,_lon in tracks),max(_lat.max() for _lat,_lon in tracks))
+
+
+def get_pixel_size(bbox,dpi) :
+   """Degrees per output pixel when bbox is fitted into the figure (as plotted: equal aspect, lon and lat as is)"""
+   _width,_height = FIGURE_SIZE[0] * dpi,FIGURE_SIZE[1] * dpi
+   return max((bbox[2] - bbox[0]) / _width,(bbox[3] - bbox[1]) / _height) or 1.0 / dpi
+
+
+def rasterize_track(x,y,width) :
+   """Flat indices (row * width + column) of all pixels the polyline through (x, y) passes, in pixel coordinates
+
+   Every segment is sampled at least once per pixel along its longer axis; the samples of all segments are
+   computed at once, so the cost is linear in the number of pixels crossed."""
+   if len(x) > 1 :
+      _dx = numpy.diff(x)
+      _dy = numpy.diff(y)
+      # samples per segment, from its start point up to (excluding) its end point
+      _samples = numpy.maximum(numpy.ceil(numpy.maximum(numpy.abs(_dx),numpy.abs(_dy))),1).astype(numpy.int64)
+      _segment = numpy.repeat(numpy.arange(len(_samples)),_samples)
+      _step = numpy.arange(len(_segment)) - numpy.repeat(numpy.cumsum(_samples) - _samples,_samples)
+      _t = _step / _samples[_segment]
+      x = numpy.append(x[_segment] + _t * _dx[_segment],x[-1])
+      y = numpy.append(y[_segment] + _t * _dy[_segment],y[-1])
+   return numpy.rint(y).astype(numpy.int64) * width + numpy.rint(x).astype(numpy.int64)
+
+
+def accumulate_tracks(tracks,bbox,pixel_size) :
+   """Grid (rows from south to north) of the number of tracks passing through each pixel"""
+   _width = int(numpy.rint((bbox[2] - bbox[0]) / pixel_size)) + 1
+   _height = int(numpy.rint((bbox[3] - bbox[1]) / pixel_size)) + 1
+   _grid = numpy.zeros(_width * _height,dtype=numpy.int64)
+   _pending = []
+   _pending_size = 0
+   for _lat,_lon in tracks :
+      # a track counts once per pixel, however long it stays there
+      _pixels = numpy.unique(rasterize_track((_lon - bbox[0]) / pixel_size,(_lat - bbox[1]) / pixel_size,_width))
+      _pending.append(_pixels)
+      _pending_size += len(_pixels)
+      if _pending_size >= RASTER_CHUNK :
+         _grid += numpy.bincount(numpy.concatenate(_pending),minlength=len(_grid))
+         _pending = []
+         _pending_size = 0
+   if _pending :
+      _grid += numpy.bincount(numpy.concatenate(_pending),minlength=len(_grid))
+   return _grid.reshape(_height,_width)
+
+
+def scale_counts(grid,scale) :
+   """Brightness 0..1 for track counts: linear, logarithmic, or equalized (by rank among the non-empty pixels)"""
+   _max = grid.max()
+   if _max == 0 :
+      return numpy.zeros(grid.shape)
+   if scale == "linear" :
+      return grid / _max
+   if scale == "log" :
+      return numpy.log1p(grid) / numpy.log1p(_max)
+   _image = numpy.zeros(grid.shape)
+   _nonzero = grid > 0
+   _,_inverse,_counts = numpy.unique(grid[_nonzero],return_inverse=True,return_counts=True)
+   _image[_nonzero] = (numpy.cumsum(_counts) / _counts.sum())[_inverse]
+   return _image
+
+
+def plot_lines(tracks,outfile,outformat,dpi) :
+   """Draw all tracks as one LineCollection (a single artist, however many tracks there are)"""
+   fig = plt.figure(figsize = FIGURE_SIZE, facecolor = BACKGROUND_COLOR)
+   ax = plt.Axes(fig, [0., 0., 1., 1.], )
+   ax.set_aspect('equal')
+   ax.set_axis_off()
+   fig.add_axes(ax)
+   ax.add_collection(matplotlib.collections.LineCollection([numpy.column_stack((_lon,_lat)) for _lat,_lon in tracks],
+                                                           colors = TRACK_COLOR, linewidths = 0.2, alpha = 0.8))
+   ax.autoscale_view()
+   plt.savefig(outfile, facecolor = fig.get_facecolor(), bbox_inches='tight', pad_inches=0, dpi=dpi, format=outformat)
+
+
+def plot_heatmap(tracks,outfile,outformat,dpi,scale) :
+   """Rasterise all tracks into one density grid and save it as a single image"""
+   _bbox = get_bbox(tracks)
+   _grid = accumulate_tracks(tracks,_bbox,get_pixel_size(_bbox,dpi))
+   debug_msg("Heatmap {0:d}x{1:d} pixels, max. {2:d} tracks per pixel".format(_grid.shape[1],_grid.shape[0],int(_grid.max())))
+   _colormap = matplotlib.colors.LinearSegmentedColormap.from_list("gpxplot",[BACKGROUND_COLOR,TRACK_COLOR,"white"])
+   plt.imsave(outfile, scale_counts(_grid,scale), cmap = _colormap, vmin = 0, vmax = 1, origin = "lower", dpi = dpi, format = outformat)
+
+
 ###############################################
 #
 # the program starts here
 #
 ###############################################
 
-options = parse_args()
-
-data = []
-for data_dir in options.dirs :
-   for data_file in listdir(data_dir) :
-      full_data_path = join(data_dir,data_file)
-      if isfile(full_data_path) :
-         data.append(full_data_path)
-
-lat = []
-lon = []
-
-fig = plt.figure(facecolor = '0.05')
-ax = plt.Axes(fig, [0., 0., 1., 1.], )
-#ax.autoscale(enable=True,tight=True)
-ax.set_aspect('equal')
-ax.set_axis_off()
-fig.add_axes(ax)
-
-for gpx_filename in data:
-    gpx_file = open(gpx_filename, 'r')
-    gpx = gpxpy.parse(gpx_file)
-
-    for track in gpx.tracks:
-        for segment in track.segments:
-            for point in segment.points:
-                lat.append(point.latitude)
-                lon.append(point.longitude)
-    plt.plot(lon, lat, color = 'deepskyblue', lw = 0.2, alpha = 0.8)
-    lat = []
-    lon = []
-
-if not options.outfile.endswith(options.outformat) :
-   options.outfile += "." + options.outformat
-plt.savefig(options.outfile, facecolor = fig.get_facecolor(), bbox_inches='tight', pad_inches=0, dpi=300, format=options.outformat)
\ No newline at end of file
+if __name__ == "__main__" :
+   options = parse_args()
+
+   data = list_gpx_files(options.dirs)
+   debug_msg("{0:d} GPX files".format(len(data)))
+
+   tracks = [_track for _path,_track in load_tracks(data,options.cache_dir,options.jobs) if len(_track[0])]
+   if not tracks :
+      error("No tracks to plot",True)
+   debug_msg("{0:d} tracks, {1:d} points".format(len(tracks),sum(len(_lat) for _lat,_lon in tracks)))
+   if options.simplify :
+      # points closer than a fraction of a pixel to the track make no visible difference, only work
+      tolerance = get_pixel_size(get_bbox(tracks),options.dpi) * options.simplify
+      tracks = [(_lat[_kept],_lon[_kept]) for (_lat,_lon),_kept in zip(tracks,gpxgeometry.simplified_indices(tracks,tolerance))]
+      debug_msg("Simplified by {0:g} degrees to {1:d} points".format(tolerance,sum(len(_lat) for _lat,_lon in tracks)))
+
+   if not options.outfile.endswith(options.outformat) :
+      options.outfile += "." + options.outformat
+   if options.render == "heatmap" :
+      plot_heatmap(tracks,options.outfile,options.outformat,options.dpi,options.scale)
+   else :
+      plot_lines(tracks,options.outfile,options.outformat,options.dpi)
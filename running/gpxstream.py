@@ -0,0 +1,342 @@
+#!/usr/bin/python3
+# vim: set ts=3 sw=3 tw=0 et :
+#
+# Streaming GPX reader/writer shared by the running tools
+#
+# GPX files are parsed incrementally (expat, the parser under ElementTree.iterparse), so memory does not
+# depend on the track length, and every track point is reported as a compact record together with its
+# byte range in the file. Files are written back by copying the original bytes and patching only the
+# ranges that change - formatting, namespaces and extensions (heart rate etc.) survive untouched.
+#
+import collections
+import calendar
+import concurrent.futures
+import mmap
+import os
+import re
+import xml.parsers.expat
+
+
+FEED_SIZE = 1048576  # bytes handed to the parser at a time
+
+# lat, lon: degrees; ele: metres or None; time: seconds since epoch (UTC) or None;
+# extensions: {local tag name: text} of the leaf elements under <extensions>, or None;
+# segment: running number of <trkseg> within the file;
+# span, time_span: (start,end) byte offsets of the whole <trkpt> element and of the text of its <time>
+TrackPoint = collections.namedtuple("TrackPoint","lat lon ele time extensions segment span time_span")
+
+TIME_RE = re.compile(r"\s*(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(\.\d+)?(Z|[+-]\d\d:?\d\d)?\s*$")
+# used to pick the first and last track point out of the raw bytes, without parsing the file
+TRKPT_TAG_RE = re.compile(rb"<(?:[\w.-]+:)?trkpt[\s>/]")
+TRKPT_END_RE = re.compile(rb"</(?:[\w.-]+:)?trkpt\s*>")
+POINT_TIME_RE = re.compile(rb"<(?:[\w.-]+:)?time>([^<]*)</(?:[\w.-]+:)?time\s*>")
+TAIL_SIZE = 65536  # bytes searched for the last track point
+
+
+def parse_time(text) :
+   """Seconds since epoch of an ISO 8601 (xsd:dateTime) time stamp; without time zone, UTC is assumed"""
+   _match = TIME_RE.match(text)
+   if not _match :
+      raise ValueError("Invalid time stamp '{0:s}'".format(text))
+   _year,_month,_day,_hour,_minute,_second,_fraction,_zone = _match.groups()
+   _time = calendar.timegm((int(_year),int(_month),int(_day),int(_hour),int(_minute),int(_second)))
+   if _fraction :
+      _time += float(_fraction)
+   if _zone and _zone != "Z" :
+      _offset = int(_zone[1:3]) * 3600 + int(_zone[-2:]) * 60
+      _time -= _offset if _zone[0] == "+" else -_offset
+   return _time
+
+
+def parse_duration(text) :
+   """Seconds of a duration given as HH:MM:SS (or MM:SS, or SS)"""
+   try :
+      _seconds = 0
+      for _field in text.split(":") :
+         _seconds = _seconds * 60 + float(_field)
+   except ValueError :
+      raise ValueError("Invalid duration '{0:s}'".format(text))
+   return _seconds
+
+
+def format_time(time,like = "2000-01-01T00:00:00Z") :
+   """Time stamp for seconds since epoch, in the style of time stamp like (fraction digits, time zone)"""
+   _match = TIME_RE.match(like)
+   _fraction,_zone = _match.group(7,8) if _match else (None,"Z")
+   _digits = len(_fraction) - 1 if _fraction else 0
+   _offset = 0
+   if _zone and _zone != "Z" :
+      _offset = int(_zone[1:3]) * 3600 + int(_zone[-2:]) * 60
+      if _zone[0] == "-" : _offset = -_offset
+   _scale = 10 ** _digits
+   _ticks = int(round((time + _offset) * _scale))
+   _seconds,_ticks = divmod(_ticks,_scale)
+   _text = "{0:04d}-{1:02d}-{2:02d}T{3:02d}:{4:02d}:{5:02d}".format(*_utc_fields(_seconds))
+   if _digits :
+      _text += ".{0:0{1:d}d}".format(_ticks,_digits)
+   return _text + (_zone or "")
+
+
+def _utc_fields(seconds) :
+   _days,_seconds = divmod(seconds,86400)
+   _year,_month,_day = _civil_from_days(_days)
+   return _year,_month,_day,_seconds // 3600,_seconds // 60 % 60,_seconds % 60
+
+
+def _civil_from_days(days) :
+   """(year, month, day) of a day number counted from 1970-01-01 (proleptic Gregorian calendar)"""
+   _days = days + 719468
+   _era = _days // 146097
+   _doe = _days - _era * 146097
+   _yoe = (_doe - _doe // 1460 + _doe // 36524 - _doe // 146096) // 365
+   _doy = _doe - (365 * _yoe + _yoe // 4 - _yoe // 100)
+   _mp = (5 * _doy + 2) // 153
+   _day = _doy - (153 * _mp + 2) // 5 + 1
+   _month = _mp + 3 if _mp < 10 else _mp - 9
+   return _yoe + _era * 400 + (_month <= 2),_month,_day
+
+
+def _local_name(name) :
+   return name.rpartition(":")[2]
+
+
+class GpxFile :
+   """GPX file opened for streaming; points() yields TrackPoint records, rewrite() writes a patched copy
+
+   The file is memory-mapped: data holds its bytes (e.g. data[slice(*point.span)] is the point's XML)."""
+
+   def __init__(self,filename) :
+      self.filename = filename
+      with open(filename,"rb") as _input :
+         try :
+            self.data = mmap.mmap(_input.fileno(),0,access=mmap.ACCESS_READ)
+         except ValueError :  # empty file
+            raise ValueError("{0:s} is empty".format(filename))
+
+   def __enter__(self) :
+      return self
+
+   def __exit__(self,exc_type,exc_value,traceback) :
+      self.close()
+
+   def close(self) :
+      self.data.close()
+
+   def points(self) :
+      """Yield TrackPoint for every <trkpt> of the file, in file order"""
+      _data = self.data
+      _parser = xml.parsers.expat.ParserCreate()
+      _parser.buffer_text = False
+      _ready = []
+      # state of the point being parsed
+      _point = {}
+      _path = []  # local names of open elements
+      _text = []
+      _text_start = [None]
+      _segment = [-1]
+      _local_names = {}
+
+      def _start(name,attrs) :
+         _name = _local_names.get(name)
+         if _name is None :
+            _name = _local_names[name] = _local_name(name)
+         _path.append(_name)
+         if _name == "trkpt" :
+            _point.clear()
+            try :
+               _point["lat"] = float(attrs.get("lat"))
+               _point["lon"] = float(attrs.get("lon"))
+            except (TypeError,ValueError) :
+               raise ValueError("{0:s}: track point without valid lat/lon at byte {1:d}".format(
+                  self.filename,_parser.CurrentByteIndex))
+            _point["start"] = _parser.CurrentByteIndex
+         elif _name == "trkseg" :
+            _segment[0] += 1
+         elif _point :
+            del _text[:]
+            _text_start[0] = None
+            if _name == "extensions" :
+               _point["extensions"] = {}
+            # text is only collected within elements of a point (not the whitespace between them)
+            _parser.CharacterDataHandler = _characters
+
+      def _characters(text) :
+         if _text_start[0] is None : _text_start[0] = _parser.CurrentByteIndex
+         _text.append(text)
+
+      def _end(name) :
+         _name = _path.pop()
+         _parser.CharacterDataHandler = None
+         if not _point : return
+         if _name == "trkpt" :
+            _end_tag = _parser.CurrentByteIndex
+            _span = (_point["start"],_data.find(b">",_end_tag) + 1)
+            _time_text = _point.get("time")
+            _ready.append(TrackPoint(_point["lat"],_point["lon"],_point.get("ele"),
+                                     parse_time(_time_text) if _time_text else None,_point.get("extensions"),
+                                     max(_segment[0],0),_span,_point.get("time_span")))
+            _point.clear()
+         elif _name == "time" and _path[-1] == "trkpt" :
+            _point["time"] = "".join(_text)
+            _end_tag = _parser.CurrentByteIndex
+            _point["time_span"] = (_text_start[0] if _text_start[0] is not None else _end_tag,_end_tag)
+         elif _name == "ele" and _path[-1] == "trkpt" :
+            _point["ele"] = float("".join(_text))
+         elif "extensions" in _path and _name != "extensions" and _text :
+            _value = "".join(_text).strip()
+            if _value : _point["extensions"][_name] = _value
+         del _text[:]
+         _text_start[0] = None
+
+      _parser.StartElementHandler = _start
+      _parser.EndElementHandler = _end
+      try :
+         for _offset in range(0,len(_data),FEED_SIZE) :
+            _parser.Parse(_data[_offset:_offset + FEED_SIZE],False)
+            yield from _ready
+            del _ready[:]
+         _parser.Parse(b"",True)
+      except xml.parsers.expat.ExpatError as _exc :
+         raise ValueError("{0:s}: {1:s}".format(self.filename,str(_exc)))
+      yield from _ready
+
+   def time_bounds(self,quick = True) :
+      """(first,last) time stamp of the track points, seconds since epoch, or (None,None) if there are none
+
+      quick: only the first track point and the last one (found in the last TAIL_SIZE bytes) are looked at,
+      which is right for recorded tracks (chronological order) and takes no time even for huge files.
+      If either has no time stamp, or they are out of order, all points are scanned instead."""
+      if quick :
+         _first = self._point_time(TRKPT_TAG_RE.search(self.data))
+         _tail_start = max(len(self.data) - TAIL_SIZE,0)
+         _last_tag = None
+         for _last_tag in TRKPT_TAG_RE.finditer(self.data,_tail_start) :
+            pass
+         _last = self._point_time(_last_tag)
+         if _first is not None and _last is not None and _first <= _last :
+            return _first,_last
+      _first = _last = None
+      for _point in self.points() :
+         if _point.time is None : continue
+         if _first is None or _point.time < _first : _first = _point.time
+         if _last is None or _point.time > _last : _last = _point.time
+      return _first,_last
+
+   def _point_time(self,tag_match) :
+      """Time stamp of the track point starting at tag_match (found by TRKPT_TAG_RE), or None"""
+      if not tag_match : return None
+      _tag_end = self.data.find(b">",tag_match.start())
+      if _tag_end < 0 or self.data[_tag_end - 1:_tag_end] == b"/" : return None  # <trkpt .../> has no time
+      _end = TRKPT_END_RE.search(self.data,_tag_end)
+      if not _end : return None
+      _time = POINT_TIME_RE.search(self.data,_tag_end,_end.start())
+      try :
+         return parse_time(_time.group(1).decode("utf-8")) if _time else None
+      except (UnicodeDecodeError,ValueError) :
+         return None
+
+   def time_text(self,point) :
+      """Original text of the point's <time>"""
+      return self.data[point.time_span[0]:point.time_span[1]].decode("utf-8") if point.time_span else None
+
+   def rewrite(self,outfile,patches) :
+      """Write a copy of the file to outfile, verbatim except for patches
+
+      patches: iterable of (start,end,replacement bytes), non-overlapping, in increasing order of start.
+      A range deleted (replaced by b"") that occupies whole lines (e.g. a track point written one tag
+      per line) is removed together with its indentation and line break.
+      The copy is written to outfile.part and renamed when complete, so outfile may be this very file
+      (which stays mapped meanwhile), and a failure leaves outfile untouched."""
+      _data = self.data
+      _position = 0
+      _partfile = outfile + ".part"
+      try :
+         with open(_partfile,"wb",buffering=FEED_SIZE) as _output :
+            for _start,_end,_replacement in patches :
+               if not _replacement :
+                  _start,_end = self._whole_lines(_start,_end)
+               _output.write(_data[_position:_start])
+               _output.write(_replacement)
+               _position = _end
+            _output.write(_data[_position:])
+      except BaseException :
+         if os.path.exists(_partfile) : os.remove(_partfile)
+         raise
+      os.replace(_partfile,outfile)
+
+   def _whole_lines(self,start,end) :
+      _data = self.data
+      _line_start = start
+      while _line_start > 0 and _data[_line_start - 1] in b" \t" :
+         _line_start -= 1
+      if _line_start > 0 and _data[_line_start - 1] != ord("\n") :
+         return start,end
+      _line_end = end
+      while _line_end < len(_data) and _data[_line_end] in b" \t\r" :
+         _line_end += 1
+      if _line_end < len(_data) and _data[_line_end] != ord("\n") :
+         return start,end
+      return _line_start,min(_line_end + 1,len(_data))
+
+
+def read_points(filename) :
+   """Yield TrackPoint for every <trkpt> of a GPX file"""
+   with GpxFile(filename) as _gpx :
+      yield from _gpx.points()
+
+
+def list_input_files(paths) :
+   """Input GPX files: files as given, directories replaced by their *.gpx files"""
+   _files = []
+   for _path in paths :
+      if os.path.isdir(_path) :
+         _files.extend(sorted(os.path.join(_path,_name) for _name in os.listdir(_path)
+                              if _name.lower().endswith(".gpx") and os.path.isfile(os.path.join(_path,_name))))
+      else :
+         _files.append(_path)
+   return _files
+
+
+def batch_files(paths,outfile,output_dir) :
+   """[(input file, output file)] of the batch tools: either a single input file written to outfile, or all
+   input files (see list_input_files) written under their own name to output_dir; ValueError if not possible"""
+   _infiles = list_input_files(paths)
+   if not _infiles :
+      raise ValueError("No input files")
+   if outfile :
+      if len(_infiles) > 1 :
+         raise ValueError("Several input files need --output-dir")
+      return [(_infiles[0],outfile)]
+   if not os.path.isdir(output_dir) :
+      raise ValueError("Output directory {0} does not exist".format(output_dir))
+   _outfiles = [os.path.join(output_dir,os.path.basename(_infile)) for _infile in _infiles]
+   if len(set(_outfiles)) < len(_outfiles) :
+      raise ValueError("Input files with the same name would be written to the same output file")
+   return list(zip(_infiles,_outfiles))
+
+
+def process_files(process,jobs,processes,error,debug_msg) :
+   """Call process(*job) for every job (whose first item is the input file name) and return the number of jobs failed
+
+   Files are processed by a pool of processes (parsing is CPU-bound), a single file right here. process returns
+   a list of messages, passed to debug_msg; OSError and ValueError are passed to error, and count as failed."""
+   _failed = 0
+   _executor = concurrent.futures.ProcessPoolExecutor(min(processes,len(jobs))) if processes > 1 and len(jobs) > 1 else None
+   try :
+      if _executor :
+         _futures = {_executor.submit(process,*_job) : _job[0] for _job in jobs}
+         _results = ((_futures[_future],_future) for _future in concurrent.futures.as_completed(_futures))
+      else :
+         _results = ((_job[0],_job) for _job in jobs)
+      for _infile,_job in _results :
+         try :
+            _messages = _job.result() if _executor else process(*_job)
+         except (OSError,ValueError) as _exc :
+            error("Cannot process {0}: {1}".format(_infile,_exc))
+            _failed += 1
+            continue
+         for _message in _messages :
+            debug_msg(_message)
+   finally :
+      if _executor : _executor.shutdown()
+   return _failed
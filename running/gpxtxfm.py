@@ -1,26 +1,46 @@
 #!/usr/bin/python3
 import sys
+import os
 import re
-import datetime
 import argparse
+import bisect
+import collections
+import itertools
 
 sys.path.append("..")  # valid within full repo only, otherwise just copy the awsutils.py file to the same directory
 import awsutils as aws_utils
+import gpxstream
+import gpxgeometry
+try :
+   import numpy  # glitch removal
+except ImportError :
+   numpy = None
 
-TIMEFORMAT = "%Y-%m-%dT%H:%M:%SZ"  # acc. to datetime.strptime requirements
-DURATIONFORMAT = "%H:%M:%S"  # acc. to datetime.strptime requirements
+
+# --clean: limits of movement on foot; GPS glitches jump tens to hundreds of metres from one point to the next
+MAX_SPEED = 12.0  # m/s
+MAX_ACCELERATION = 10.0  # m/s2
+ACCURACY = 20.0  # m, distance between two fixes of the same position that is still GPS noise, not movement
+MAX_GLITCH = 120.0  # s, longest stretch of bad points removed
+BLOCK_POINTS = 8192  # track points decided at a time
+CONTEXT_POINTS = 32  # points kept already, taken into account with the next block
+LAT_RE = re.compile(rb"\slat\s*=\s*[\"']([^\"']*)")
+LON_RE = re.compile(rb"\slon\s*=\s*[\"']([^\"']*)")
+
+CleanSettings = collections.namedtuple("CleanSettings","max_speed max_acceleration accuracy max_glitch median")
 
 
 def parse_args():
    # parse arguments
    usage_text = (
-      "Modifies a GPX file (GPS track data) using another (Viking-generated) GPX file as reference.\n"
-      "Does not parse the files as GPX or even XML, simply treats them as text files.")
+      "Modifies a GPX file (GPS track data) using another (Viking-generated) GPX file as reference, or removes\n"
+      "GPS glitches automatically.\n"
+      "Files are streamed, and everything but the track points affected is copied verbatim (incl. extensions).")
    epilog_text = (
       "Typical usage cases:\n"
       "  %(prog)s --input INFILE --reference REFERENCE_FILE --output OUTFILE\n"
-      "                        : Filter INFILE, deleting track points not in REFERENCE_FILE\n"
-      "*** not yet implemented beyond this point ***\n"
+      "                        : Filter INFILE, deleting track points not in REFERENCE_FILE (points are matched\n"
+      "                          by time stamp, within --tolerance, regardless of order and time stamp format)\n"
       "  %(prog)s --input INFILE --start STARTTIME --output OUTFILE\n"
       "                        : Time-shift GPX file so that the track starts at STARTTIME\n"
       "  %(prog)s --input INFILE --finish ENDTIME --output OUTFILE\n"
@@ -29,43 +49,217 @@ def parse_args():
       "                        : Scale GPX file so that the track starts at STARTTIME and ends at ENDTIME.\n"
       "  %(prog)s --input INFILE --duration TOTALTIME --output OUTFILE\n"
       "                        : Scale GPX file so that the track starts at original time and lasts TOTALTIME.\n"
-      "Expected date/time format: YYYY-mm-ddTHH:MM:SS, e.g. 2018-01-12T21:23:12\n"
+      "  %(prog)s --input INFILE|DIR... --clean --output OUTFILE|--output-dir DIR\n"
+      "                        : Delete track points that cannot have been reached on foot (faster than --max-speed,\n"
+      "                          or accelerating harder than --max-acceleration), optionally smoothing the rest\n"
+      "                          (--median); many files or directories can be cleaned in one go\n"
+      "Time stamps are rewritten in place, in the format of the original ones; the original start and end times\n"
+      "are taken from the first and last track point, unless --full-scan is given (tracks not in chronological order).\n"
+      "Expected date/time format: YYYY-mm-ddTHH:MM:SS, e.g. 2018-01-12T21:23:12 (UTC unless a zone is given)\n"
       "Expected duration format: HH:MM:SS, e.g. 01:15:46\n"
    )
    parser = argparse.ArgumentParser(description=usage_text, epilog=epilog_text, \
                                     formatter_class=argparse.RawDescriptionHelpFormatter)
-   parser.add_argument("-i", "--input", required=True, metavar="INFILE", action="store", dest="infile",
-                       help="input GPX file to read")
-   parser.add_argument("-o", "--output", required=True, metavar="OUTFILE", action="store", dest="outfile",
+   parser.add_argument("-i", "--input", required=True, nargs="+", metavar="INFILE", action="store", dest="infiles",
+                       help="input GPX file to read (--clean: files, or directories of them)")
+   parser.add_argument("-o", "--output", metavar="OUTFILE", action="store", dest="outfile",
                        help="output GPX file to write")
+   parser.add_argument("--output-dir", metavar="DIR", action="store", dest="output_dir",
+                       help="--clean: directory to write output GPX files to, under the input file names")
    parser.add_argument("-r", "--reference", required=False, metavar="REFERENCE_FILE", action="store", dest="reffile",
                        help="reference GPX file, specifies points to filter")
+   parser.add_argument("--tolerance", metavar="SECONDS", action="store", type=float, dest="tolerance", default=0.5,
+                       help="max. difference of time stamps of a point and its reference point (default: 0.5)")
    time = parser.add_argument_group("time")
    time.add_argument("--start", metavar="STARTTIME", action="store", dest="starttime", help="desired track start time")
    time.add_argument("--finish", metavar="ENDTIME", action="store", dest="endtime", help="desired track end time")
    time.add_argument("--duration", metavar="DURATION", action="store", dest="duration", help="desired track duration")
+   time.add_argument("--full-scan", action="store_true", dest="full_scan",
+                     help="determine the original start and end time from all track points")
+   clean = parser.add_argument_group("clean")
+   clean.add_argument("--clean", action="store_true", dest="clean", help="delete GPS glitches (needs numpy)")
+   clean.add_argument("--max-speed", metavar="M/S", action="store", type=float, dest="max_speed", default=MAX_SPEED,
+                      help="max. speed between points (default: {0:g})".format(MAX_SPEED))
+   clean.add_argument("--max-acceleration", metavar="M/S2", action="store", type=float, dest="max_acceleration",
+                      default=MAX_ACCELERATION, help="max. speed increase per second (default: {0:g})".format(MAX_ACCELERATION))
+   clean.add_argument("--accuracy", metavar="METRES", action="store", type=float, dest="accuracy", default=ACCURACY,
+                      help="GPS accuracy: this much of every hop is not counted as movement (default: {0:g})".format(ACCURACY))
+   clean.add_argument("--max-glitch", metavar="SECONDS", action="store", type=float, dest="max_glitch", default=MAX_GLITCH,
+                      help="max. duration of a glitch, longer stretches are left alone (default: {0:g})".format(MAX_GLITCH))
+   clean.add_argument("--median", metavar="N", action="store", type=int, dest="median", default=0,
+                      help="smooth lat/lon of the points kept with a running median of N points (odd; default: no smoothing)")
+   clean.add_argument("-j","--jobs", action="store", type=int, dest="jobs", default=os.cpu_count() or 1, metavar="N",
+                      help="number of files cleaned concurrently (default: number of CPUs)")
    parser.add_argument("--debug", action="store_true", dest="debug", help="Print lots of debugging information")
    _result = parser.parse_args()
    
    # argument logic check
    if _result.starttime and _result.endtime and _result.duration:
       aws_utils.error("Specifying start time, end time and duration together makes no sense", True)
+   if _result.endtime and _result.duration and not _result.starttime:
+      aws_utils.error("Unrecognized time argument combination: --finish with --duration (give --start instead)", True)
+   if (bool(_result.reffile) + bool(_result.starttime or _result.endtime or _result.duration) + _result.clean) > 1:
+      aws_utils.error("Filtering, time transformation and cleaning cannot be combined", True)
+   if not _result.reffile and not (_result.starttime or _result.endtime or _result.duration) and not _result.clean:
+      aws_utils.error("Nothing to do, specify a reference file, a time transformation or --clean", True)
+   if bool(_result.outfile) == bool(_result.output_dir):
+      aws_utils.error("Specify either an output file or an output directory", True)
+   if _result.clean:
+      if numpy is None:
+         aws_utils.error("--clean needs numpy", True)
+      if _result.median < 0 or (_result.median and _result.median % 2 == 0):
+         aws_utils.error("--median needs an odd number of points", True)
+   else:
+      if _result.output_dir or len(_result.infiles) > 1:
+         aws_utils.error("Only --clean processes several files", True)
+      _result.infile = _result.infiles[0]
    
    return _result
 
 
-def get_time_bounds(gpx):
-   start_time = datetime.datetime(year=2099, month=1, day=1, hour=0, minute=0, second=0)
-   finish_time = datetime.datetime(year=2000, month=1, day=1, hour=0, minute=0, second=0)
+def get_time_transform(start_time_original, finish_time_original):
+   """(start_time, time_scaling_factor) for the time options; new time = start_time + (time - start) * factor"""
+   duration_original = finish_time_original - start_time_original
+   try:
+      if options.starttime and not options.duration and not options.endtime:
+         # time-shift only
+         return gpxstream.parse_time(options.starttime), 1
+      elif not options.starttime and not options.duration and options.endtime:
+         # time-shift only by finish time
+         return gpxstream.parse_time(options.endtime) - duration_original, 1
+      
+      if options.duration:
+         duration = gpxstream.parse_duration(options.duration)
+         start_time = gpxstream.parse_time(options.starttime) if options.starttime else start_time_original
+      else:
+         # time-shift by start time & time scaling to fit into explicit period
+         start_time = gpxstream.parse_time(options.starttime)
+         duration = gpxstream.parse_time(options.endtime) - start_time
+   except ValueError as exc:
+      aws_utils.error(str(exc), True)
    
-   for track in gpx.tracks:
-      for segment in track.segments:
-         for point in segment.points:
-            if point.time < start_time:
-               start_time = point.time
-            elif point.time > finish_time:
-               finish_time = point.time
-   return start_time, finish_time
+   aws_utils.debug_msg("Desired duration = " + str(duration) + " s")
+   if duration_original <= 0:
+      aws_utils.error("Track has no duration, it cannot be scaled", True)
+   return start_time, duration / duration_original
+
+
+def find_glitches(lat,lon,time,fixed,settings) :
+   """Boolean array, True for the points (arrays of lat, lon, time in seconds) to keep; the first fixed points are kept
+
+   Hops between consecutive points that are too fast (counting only the distance beyond GPS accuracy), or that
+   accelerate too hard, split the track into stretches of plausible movement. A glitch is a stretch of at most
+   max_glitch seconds with fewer points than the stretches on either side: all glitches are dropped at once, speeds
+   are recomputed over the points left, and so on until no hop is impossible or no stretch is a glitch."""
+   _keep = numpy.ones(len(time),dtype=bool)
+   while True :
+      _indices = numpy.flatnonzero(_keep)
+      if len(_indices) < 2 : break
+      _lat,_lon,_time = lat[_indices],lon[_indices],time[_indices]
+      _distance = numpy.maximum(gpxgeometry.haversine(_lat[:-1],_lon[:-1],_lat[1:],_lon[1:]) - settings.accuracy,0)
+      _dt = numpy.diff(_time)
+      with numpy.errstate(divide="ignore",invalid="ignore") :
+         _speed = numpy.where(_dt > 0,_distance / _dt,numpy.where(_distance > 0,numpy.inf,0.0))
+         _acceleration = numpy.where(_dt > 0,numpy.diff(_speed,prepend=_speed[:1]) / _dt,0.0)
+      _impossible = (_speed > settings.max_speed) | (_acceleration > settings.max_acceleration)
+      if not _impossible.any() : break
+      # stretches between impossible hops: number of each point, and first/last point, size of each stretch
+      _stretch = numpy.concatenate(([0],numpy.cumsum(_impossible)))
+      _starts = numpy.concatenate(([0],numpy.flatnonzero(_impossible) + 1))
+      _ends = numpy.append(_starts[1:],len(_indices)) - 1
+      _sizes = (_ends - _starts + 1).astype(numpy.float64)
+      _glitch = ((_sizes < numpy.insert(_sizes[:-1],0,numpy.inf)) & (_sizes <= numpy.append(_sizes[1:],numpy.inf)) &
+                 (_time[_ends] - _time[_starts] <= settings.max_glitch) & (_indices[_starts] >= fixed))
+      if not _glitch.any() : break
+      _keep[_indices[_glitch[_stretch]]] = False
+   return _keep
+
+
+def running_median(values,window) :
+   """Median of each value and the window // 2 values on either side (the end values repeated at the ends)"""
+   _padded = numpy.pad(values,window // 2,mode="edge")
+   return numpy.median(numpy.lib.stride_tricks.sliding_window_view(_padded,window),axis=1)
+
+
+def cleaned_points(points,settings) :
+   """Yield (point, keep, lat, lon) for the track points (TrackPoint), in order; lat, lon are the smoothed
+   coordinates of a point kept, or None if not smoothed. Points without time stamp are kept as they are.
+
+   Points are read BLOCK_POINTS at a time. Those within max_glitch seconds of the last one read are decided
+   only with the next block (a glitch may continue there), together with the last points kept as context,
+   so memory does not depend on the track length."""
+   _points = iter(points)
+   _pending = []
+   _context = numpy.empty((3,0))  # lat, lon, time of the last points kept
+   _context_size = max(CONTEXT_POINTS,settings.median)
+   _final = False
+   while not _final :
+      _block = list(itertools.islice(_points,BLOCK_POINTS))
+      _final = len(_block) < BLOCK_POINTS
+      _pending.extend(_block)
+      _positions = [_position for _position,_point in enumerate(_pending) if _point.time is not None]
+      _track = numpy.array([(_pending[_position].lat,_pending[_position].lon,_pending[_position].time)
+                            for _position in _positions]).reshape(-1,3).T
+      if _final or not _positions :
+         _open = len(_positions)
+      else :
+         _open = int(numpy.argmax(_track[2] > _track[2][-1] - settings.max_glitch))
+         if _track[2][-1] - _track[2][0] < 2 * settings.max_glitch : continue
+      _decided = _positions[_open] if _open < len(_positions) else len(_pending)
+      _track = numpy.concatenate((_context,_track),axis=1)
+      _fixed = _context.shape[1]
+      _keep = find_glitches(_track[0],_track[1],_track[2],_fixed,settings)
+      _kept = numpy.flatnonzero(_keep)
+      if settings.median > 1 :
+         _smoothed = numpy.full((2,_track.shape[1]),numpy.nan)
+         _smoothed[0][_kept] = running_median(_track[0][_kept],settings.median)
+         _smoothed[1][_kept] = running_median(_track[1][_kept],settings.median)
+      _timed = iter(range(_fixed,_track.shape[1]))
+      for _point in _pending[:_decided] :
+         if _point.time is None :
+            yield _point,True,None,None
+            continue
+         _index = next(_timed)
+         if settings.median > 1 and _keep[_index] :
+            yield _point,True,_smoothed[0][_index],_smoothed[1][_index]
+         else :
+            yield _point,bool(_keep[_index]),None,None
+      _kept = _kept[_kept < _fixed + _open]
+      _context = _track[:,_kept[-_context_size:]]
+      del _pending[:_decided]
+
+
+def clean_file(infile,outfile,settings) :
+   """Write infile without GPS glitches (smoothed, if settings.median) to outfile; returns messages for debugging
+
+   Points are deleted, and lat/lon attributes of the points smoothed are rewritten in place (with the original
+   number of decimals); everything else (incl. heart rate extensions) is copied verbatim. outfile may be infile."""
+   _counts = collections.Counter()
+
+   def _patches(gpx) :
+      for _point,_keep,_lat,_lon in cleaned_points(gpx.points(),settings) :
+         _counts["points"] += 1
+         if not _keep :
+            _counts["deleted"] += 1
+            yield _point.span[0],_point.span[1],b""
+         elif _lat is not None :
+            _tag_end = gpx.data.find(b">",_point.span[0])
+            _coordinates = []
+            for _attribute_re,_value in ((LAT_RE,_lat),(LON_RE,_lon)) :
+               _match = _attribute_re.search(gpx.data,_point.span[0],_tag_end)
+               _text = _match.group(1).decode("ascii")
+               _new_text = "{0:.{1:d}f}".format(_value,len(_text.partition(".")[2]))
+               if _new_text != _text :
+                  _coordinates.append((_match.start(1),_match.end(1),_new_text.encode("ascii")))
+            if _coordinates : _counts["smoothed"] += 1
+            yield from sorted(_coordinates)
+
+   with gpxstream.GpxFile(infile) as _gpx :
+      _gpx.rewrite(outfile,_patches(_gpx))
+   _message = "{0}: {1:d} track points, {2:d} deleted as glitches".format(infile,_counts["points"],_counts["deleted"])
+   if settings.median > 1 :
+      _message += ", {0:d} moved by smoothing".format(_counts["smoothed"])
+   return [_message]
 
 
 ###############################################
@@ -74,68 +268,89 @@ def get_time_bounds(gpx):
 #
 ###############################################
 
-options = parse_args()
+if __name__ == "__main__" :
+   options = parse_args()
+   aws_utils.options = options
 
-if options.reference :
-   # FILTERING MODE; reference file is used as list of track points to be left in the input file
+   if options.clean :
+      # CLEANING MODE; files are cleaned by a pool of processes (parsing is CPU-bound), a single file right here
+      try :
+         files = gpxstream.batch_files(options.infiles,options.outfile,options.output_dir)
+      except (OSError,ValueError) as exc :
+         aws_utils.error(str(exc),True)
+      settings = CleanSettings(options.max_speed,options.max_acceleration,options.accuracy,options.max_glitch,
+                               options.median)
+      jobs = [(_infile,_outfile,settings) for _infile,_outfile in files]
+      failed = gpxstream.process_files(clean_file,jobs,options.jobs,aws_utils.error,aws_utils.debug_msg)
+      if failed :
+         aws_utils.error("{0:d} of {1:d} files not cleaned".format(failed,len(files)),True)
+   
+   elif options.reffile :
+      # FILTERING MODE; reference file is used as list of track points to be left in the input file
 
-   refpoints = []
+      # sorted reference time stamps; each input point is looked up by binary search, so filtering is O(n log m)
+      try :
+         with gpxstream.GpxFile(options.reffile) as reffile :
+            reftimes = sorted(point.time for point in reffile.points() if point.time is not None)
+      except (OSError,ValueError) as exc :
+         aws_utils.error("Cannot read reference file: {0}".format(exc),True)
    
-   with open(options.reffile) as reffile :
-      is_in_trkpt = False
-      for line in reffile:
-         _line = line.strip()
-         if _line.startswith("<trkpt ") :
-            is_in_trkpt = True
-         elif _line.endswith("</trkpt>") :
-            is_in_trkpt = False
-         elif is_in_trkpt and _line.startswith("<time>") and _line.endswith("</time>"):
-            refpoints.append(_line)
+      if not reftimes :
+         aws_utils.error("Reference GPX file contains no track points",True)
+      aws_utils.debug_msg("{0:d} reference points, {1:s} - {2:s}".format(
+         len(reftimes),gpxstream.format_time(reftimes[0]),gpxstream.format_time(reftimes[-1])))
    
-   if not refpoints :
-      aws_utils.error("Reference GPX file contains no track points",True)
-      
-   print(str(refpoints))
-   refpoints.reverse()
+      def is_referenced(time) :
+         _idx = bisect.bisect_left(reftimes,time - options.tolerance)
+         return _idx < len(reftimes) and reftimes[_idx] <= time + options.tolerance
    
-   # Ye Olde State Machine
-   is_in_trkpt = False
-   trkpt_body = ""
-   next_refpoint = refpoints.pop()
-   is_valid_refpoint = False
+      kept = dropped = 0
+      def dropped_points(infile) :
+         global kept, dropped
+         for point in infile.points() :
+            if point.time is not None and is_referenced(point.time) :
+               kept += 1
+            else :
+               dropped += 1
+               yield point.span[0],point.span[1],b""
    
-   with open(options.outfile,"w") as outfile :
-      with open(options.infile) as infile :
-         for in_line in infile :
-            _in_line = in_line.strip()
-            if is_in_trkpt :
-               if _in_line.startswith("<time>") and _in_line.endswith("</time>") :
-                  if _in_line == next_refpoint :
-                     is_valid_refpoint = True
-            elif _in_line.startswith("<trkpt ") :
-               is_in_trkpt = True
-               
-            if is_in_trkpt :
-               trkpt_body += in_line
+      try :
+         with gpxstream.GpxFile(options.infile) as infile :
+            infile.rewrite(options.outfile,dropped_points(infile))
+      except (OSError,ValueError) as exc :
+         aws_utils.error("Cannot filter {0}: {1}".format(options.infile,exc),True)
+      aws_utils.debug_msg("{0:d} track points kept, {1:d} deleted".format(kept,dropped))
+
+   else :
+      # TIME TRANSFORMATION MODE; one streaming pass rewrites the time stamps, all other bytes are copied verbatim
    
-               if _in_line.startswith("</trkpt>") :
-                  if is_valid_refpoint :
-                     outfile.write(trkpt_body)
-                     is_valid_refpoint = False
-                     next_refpoint = refpoints.pop() if refpoints else "INVALID_TIMESTAMP"
-                  is_in_trkpt = False
-                  trkpt_body = ""
+      try :
+         infile = gpxstream.GpxFile(options.infile)
+         start_time_original,finish_time_original = infile.time_bounds(quick=not options.full_scan)
+      except (OSError,ValueError) as exc :
+         aws_utils.error("Cannot read {0}: {1}".format(options.infile,exc),True)
    
-            else :
-               outfile.write(in_line)
-
-# FOR FUTURE REFERENCE
-#
-# rgx_time = re.compile(r"\s*<time>([^<]+)</time>\s*")
-# with open(options.reffile) as reffile :
-#    for line in reffile :
-#       _time_str = rgx_time.match(line)
-#       if _time_str :
-#          debug_msg(_time_str.group(1))
-#          _time = datetime.datetime.strptime(_time_str.group(1),TIMEFORMAT)
-#          refpoints.append(_time)
+      if start_time_original is None :
+         aws_utils.error("No time stamps in " + options.infile,True)
+      aws_utils.debug_msg("Original start/end: " + gpxstream.format_time(start_time_original) + " - " +
+                          gpxstream.format_time(finish_time_original))
+   
+      start_time,time_scaling_factor = get_time_transform(start_time_original,finish_time_original)
+      aws_utils.debug_msg("Computed start/end: " + gpxstream.format_time(start_time) + " - " +
+                          gpxstream.format_time(start_time + (finish_time_original - start_time_original) * time_scaling_factor))
+      aws_utils.debug_msg("Time scaling factor = " + str(time_scaling_factor))
+   
+      def retimed_points(infile) :
+         for point in infile.points() :
+            if point.time is not None :
+               _time = start_time + (point.time - start_time_original) * time_scaling_factor
+               yield point.time_span[0],point.time_span[1],\
+                     gpxstream.format_time(_time,infile.time_text(point)).encode("ascii")
+   
+      # written through OUTFILE.part, so OUTFILE may be INFILE
+      try :
+         infile.rewrite(options.outfile,retimed_points(infile))
+      except (OSError,ValueError) as exc :
+         aws_utils.error("Cannot transform {0}: {1}".format(options.infile,exc),True)
+      finally :
+         infile.close()